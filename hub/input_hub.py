@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+#
+# Thanhle Bluetooth keyboard/mouse emulation service
+# input hub.
+# Forwards every local keyboard and mouse to the btk_server service from
+# one process: devices are picked up and dropped as udev reports them,
+# all of them share one D-Bus connection and fast path socket, and each
+# wakeup reads every queued event of a device in one batch. The keyboards
+# share one keyboard state and the mice one button state, as the host
+# sees a single keyboard and mouse: a key stays down while any keyboard
+# holds it, and whatever a removed device held is released.
+#
+
+import os
+import sys
+import errno
+import time
+import argparse
+import select
+import logging
+from logging import debug, info, warning, error
+import pyudev
+from evdev import ecodes
+
+# the device classes live with the standalone keyboard and mouse clients
+sys.path.append(os.path.join(sys.path[0], "..", "keyboard"))
+sys.path.append(os.path.join(sys.path[0], "..", "mouse"))
+sys.path.append(os.path.join(sys.path[0], "..", "record"))
+import keymap
+import kb_state
+import report_log
+from mouse_client import InputDevice, MouseInput
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class KeyboardInput(InputDevice):
+    source = report_log.SOURCE_KEYBOARD
+    # send n-key rollover reports instead of 6 key boot reports
+    nkro = False
+
+    def __init__(self, device_node, hub):
+        super().__init__(device_node)
+        self.hub = hub
+        # usages and modifier bits this keyboard holds down
+        self.keys = set()
+        self.modifiers = 0
+
+    def change_state(self, event):
+        # only bother if we hit a key and its an up or down event
+        if event.type != ecodes.EV_KEY or event.value > 1:
+            return
+        state = self.hub.keyboard
+        modmask = keymap.modmask_by_code[event.code]
+        if modmask:
+            if event.value == 1:
+                self.modifiers |= modmask
+                state.press_modifier(modmask)
+            else:
+                self.modifiers &= ~modmask
+                self.hub.release_modifier(modmask)
+        else:
+            usage = keymap.usage_by_code[event.code]
+            if usage == 0:
+                return
+            if event.value == 1:
+                self.keys.add(usage)
+                state.press(usage)
+            else:
+                self.keys.discard(usage)
+                self.hub.release_key(usage)
+        report = state.changed()
+        if report is None:
+            return
+        stamps = None
+        if InputDevice.latency:
+            stamps = (event.sec * 1000000000 + event.usec * 1000, self.read_ns,
+                      time.time_ns())
+        InputDevice.send_report(report, stamps)
+
+    def flush_timeout(self):
+        return None
+
+
+class HubMouseInput(MouseInput):
+
+    def __init__(self, device_node, hub):
+        super().__init__(device_node)
+        self.hub = hub
+
+    def send_current(self, ir):
+        # the buttons of every mouse, this one's motion
+        ir = list(ir)
+        ir[0] = self.hub.buttons()
+        super().send_current(ir)
+
+
+class InputHub():
+    EVENT_NODE = "/event"
+
+    def __init__(self):
+        self.context = pyudev.Context()
+        self.monitor = pyudev.Monitor.from_netlink(self.context)
+        self.monitor.filter_by(subsystem="input")
+        self.epoll = select.epoll()
+        # fd -> input, and device node -> input
+        self.by_fd = {}
+        self.by_node = {}
+        # what the host is sent, merged from all keyboards
+        if KeyboardInput.nkro:
+            self.keyboard = kb_state.NkroKeyboardState()
+        else:
+            self.keyboard = kb_state.KeyboardState()
+        InputDevice.connect()
+
+    def start(self):
+        # start monitoring before listing so no device slips in between
+        self.monitor.start()
+        self.epoll.register(self.monitor.fileno(), select.EPOLLIN)
+        # the host's keyboard LEDs come back on the fast path socket
+        self.socket_fd = None
+        if InputDevice.socket is not None:
+            self.socket_fd = InputDevice.socket.fileno()
+            self.epoll.register(self.socket_fd, select.EPOLLIN)
+        for dev in self.context.list_devices(subsystem="input"):
+            self.add(dev)
+
+    def add(self, dev):
+        node = dev.device_node
+        if node is None or self.EVENT_NODE not in node or node in self.by_node:
+            return
+        try:
+            if "ID_INPUT_KEYBOARD" in dev.properties:
+                device = KeyboardInput(node, self)
+            elif "ID_INPUT_MOUSE" in dev.properties:
+                device = HubMouseInput(node, self)
+            else:
+                return
+        except OSError as err:
+            error("Failed to connect to %s: %s", node, err)
+            return
+        self.by_fd[device.fileno()] = device
+        self.by_node[node] = device
+        InputDevice.inputs.append(device)
+        self.epoll.register(device.fileno(), select.EPOLLIN)
+
+    def remove(self, node):
+        device = self.by_node.pop(node, None)
+        if device is None:
+            return
+        fd = device.fileno()
+        del self.by_fd[fd]
+        InputDevice.inputs.remove(device)
+        try:
+            self.epoll.unregister(fd)
+        except (OSError, ValueError):
+            pass
+        device.close()
+        info("Disconnected %s", node)
+        self.release_device(device)
+
+    def keyboards(self):
+        return [d for d in self.by_fd.values() if isinstance(d, KeyboardInput)]
+
+    def buttons(self):
+        """the mouse buttons held on any mouse"""
+        held = 0
+        for device in self.by_fd.values():
+            if isinstance(device, MouseInput):
+                held |= device.state[0]
+        return held
+
+    def release_key(self, usage):
+        if not any(usage in k.keys for k in self.keyboards()):
+            self.keyboard.release(usage)
+
+    def release_modifier(self, mask):
+        for bit in range(8):
+            if mask & (1 << bit) and \
+                    not any(k.modifiers & (1 << bit) for k in self.keyboards()):
+                self.keyboard.release_modifier(1 << bit)
+
+    def release_device(self, device):
+        """releases what a removed device held, unless another one holds it"""
+        if isinstance(device, KeyboardInput):
+            for usage in device.keys:
+                self.release_key(usage)
+            self.release_modifier(device.modifiers)
+            report = self.keyboard.changed()
+            if report is not None:
+                InputDevice.send_report(report)
+        elif isinstance(device, MouseInput) and device.state[0]:
+            if MouseInput.wide:
+                report = bytes([5, self.buttons()]) + bytes(6)
+            else:
+                report = bytes([2, self.buttons(), 0, 0, 0])
+            InputDevice.send_report(report)
+
+    def handle_monitor(self):
+        for dev in iter(lambda: self.monitor.poll(0), None):
+            if dev.action == "add":
+                self.add(dev)
+            elif dev.action == "remove":
+                self.remove(dev.device_node)
+
+    def read(self, device):
+        try:
+            # one read() returns every event queued on the device
+            device.read_events()
+        except BlockingIOError:
+            pass
+        except OSError as err:
+            if err.errno == errno.ENODEV:
+                self.remove(device.device_node)
+            else:
+                warning(err)
+
+    def timeout(self):
+        """seconds until the first held back mouse motion is due, -1 for none"""
+        timeouts = [t for t in (i.flush_timeout() for i in InputDevice.inputs)
+                    if t is not None]
+        return min(timeouts, default=-1)
+
+    def run(self):
+        monitor_fd = self.monitor.fileno()
+        while True:
+            for fd, mask in self.epoll.poll(self.timeout()):
+                if fd == monitor_fd:
+                    self.handle_monitor()
+                    continue
+                if fd == self.socket_fd:
+                    InputDevice.handle_socket()
+                    if InputDevice.socket is None:
+                        self.epoll.unregister(fd)
+                        self.socket_fd = None
+                    continue
+                device = self.by_fd.get(fd)
+                if device is None:
+                    continue
+                if mask & (select.EPOLLHUP | select.EPOLLERR):
+                    self.remove(device.device_node)
+                else:
+                    self.read(device)
+            for device in InputDevice.inputs:
+                t = device.flush_timeout()
+                if t is not None and t <= 0:
+                    device.send_motion()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Forward all local keyboards and mice to the btk_server service")
+    parser.add_argument(
+        "--nkro", action="store_true",
+        help="send n-key rollover reports (btk_server must run with --nkro)")
+    parser.add_argument(
+        "--rate", type=float, default=MouseInput.rate, metavar="HZ",
+        help="mouse report rate ceiling (default: %(default)s)")
+    parser.add_argument(
+        "--fixed-rate", action="store_true",
+        help="always report mouse motion at --rate")
+    parser.add_argument(
+        "--speed", type=float, default=MouseInput.speed,
+        help="pointer gain (default: %(default)s)")
+    parser.add_argument(
+        "--accel", type=float, default=MouseInput.accel,
+        help="pointer acceleration (default: %(default)s)")
+    parser.add_argument(
+        "--wide", action="store_true",
+        help="send 16 bit mouse motion and high resolution wheel reports")
+    parser.add_argument(
+        "--latency", action="store_true",
+        help="send event timestamps for btk_server --latency")
+    parser.add_argument(
+        "--record", metavar="PATH",
+        help="also record the raw events of all inputs to an events log")
+    parser.add_argument(
+        "--route", metavar="ROUTE",
+        help="send to all, adapter:<hciN>, host:<address> or group:<name> "
+             "instead of the service's route")
+    args = parser.parse_args()
+    InputDevice.latency = args.latency
+    InputDevice.route = args.route
+    if args.record:
+        InputDevice.record(args.record)
+    KeyboardInput.nkro = args.nkro
+    MouseInput.configure(args.rate, args.fixed_rate, args.speed, args.accel,
+                         args.wide)
+
+    hub = InputHub()
+    hub.start()
+    hub.run()
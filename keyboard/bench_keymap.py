@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+#
+# Benchmark for the evdev key code -> HID usage lookup in kb_client.
+#
+# Compares the name based path (ecodes.KEY[code], then the keymap dicts)
+# with the code indexed tables over synthetic key events.
+#
+# Usage: bench_keymap.py [number of events]
+#
+
+import random
+import sys
+import time
+from evdev import ecodes
+import keymap
+
+
+class Event():
+    __slots__ = ("code", "value")
+
+    def __init__(self, code, value):
+        self.code = code
+        self.value = value
+
+
+def by_name(events):
+    for event in events:
+        evdev_code = ecodes.KEY[event.code]
+        modkey_element = keymap.modkey(evdev_code)
+        if modkey_element < 0:
+            keymap.convert(evdev_code)
+
+
+def by_code(events):
+    usage_by_code = keymap.usage_by_code
+    modmask_by_code = keymap.modmask_by_code
+    for event in events:
+        if not modmask_by_code[event.code]:
+            usage_by_code[event.code]
+
+
+def run(label, func, events):
+    start = time.perf_counter()
+    func(events)
+    elapsed = time.perf_counter() - start
+    print("%-8s %8.3f s %12.0f events/s" % (label, elapsed, len(events) / elapsed))
+    return elapsed
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 3000000
+    # every key both paths know about, modifiers included
+    codes = [code for code in range(keymap.KEY_MAX + 1)
+             if keymap.usage_by_code[code] and isinstance(ecodes.KEY.get(code), str)]
+    rng = random.Random(0)
+    events = [Event(rng.choice(codes), rng.randint(0, 1)) for _ in range(number)]
+
+    for event in events[:1000]:
+        name = ecodes.KEY[event.code]
+        assert keymap.usage_by_code[event.code] == keymap.convert(name)
+        if keymap.modkey(name) >= 0:
+            assert keymap.modmask_by_code[event.code] == 1 << (7 - keymap.modkey(name))
+
+    old = run("by name", by_name, events)
+    new = run("by code", by_code, events)
+    print("speedup  %8.2fx" % (old / new))
@@ -2,44 +2,50 @@
 #
 # Thanhle Bluetooth keyboard emulation service
 # keyboard copy client.
-# Reads local key events and forwards them to the btk_server DBUS service
+# Reads local key events and forwards them to the btk_server DBUS service,
+# and lights the keyboard LEDs the host sets (pushed on the report socket)
 #
 import os  # used to all external commands
 import sys  # used to exit the script
+import argparse
 import dbus
 import dbus.service
 import dbus.mainloop.glib
 import time
+from select import select
 import evdev  # used to get input from the keyboard
 from evdev import *
+import atexit
 import keymap  # used to map evdev input to hid keodes
+import kb_state
+
+sys.path.append(os.path.join(sys.path[0], "..", "record"))
+import report_log
+sys.path.append(os.path.join(sys.path[0], "..", "mouse"))
+import report_socket
 
 
 # Define a client to listen to local key events
 class Keyboard():
 
-    def __init__(self):
-        # the structure for a bt keyboard input report (size is 10 bytes)
-
-        self.state = [
-            0xA1,  # this is an input report
-            0x01,  # Usage report = Keyboard
-            # Bit array for Modifier keys
-            [0,  # Right GUI - Windows Key
-             0,  # Right ALT
-             0,  # Right Shift
-             0,  # Right Control
-             0,  # Left GUI
-             0,  # Left ALT
-             0,  # Left Shift
-             0],  # Left Control
-            0x00,  # Vendor reserved
-            0x00,  # rest is space for 6 keys
-            0x00,
-            0x00,
-            0x00,
-            0x00,
-            0x00]
+    def __init__(self, nkro=False, device_node="/dev/input/event0",
+                 latency=False, record_path=None, route=None):
+        # modifier byte and key slots (or usage bitmap) of the input report
+        self.nkro = nkro
+        # where the reports go as set_route takes it, None for the
+        # service's route
+        self.route = route
+        # pass event timestamps along for btk_server's latency statistics
+        self.latency = latency
+        # raw key events are also written to an events log
+        self.recorder = None
+        if record_path:
+            self.recorder = report_log.LogWriter(record_path, report_log.EVENTS)
+            atexit.register(self.recorder.close)
+        if nkro:
+            self.state = kb_state.NkroKeyboardState()
+        else:
+            self.state = kb_state.KeyboardState()
 
         print("setting up DBus Client")
 
@@ -47,66 +53,145 @@ class Keyboard():
         self.btkservice = self.bus.get_object(
             'org.thanhle.btkbservice', '/org/thanhle/btkbservice')
         self.iface = dbus.Interface(self.btkservice, 'org.thanhle.btkbservice')
+        # the host's LED output reports come back on the report socket,
+        # which also carries routed reports
+        self.socket = report_socket.connect(route=route)
         print("waiting for keyboard")
         # keep trying to key a keyboard
         have_dev = False
         while have_dev == False:
             try:
-                # try and get a keyboard - should always be event0 as
-                # we're only plugging one thing in
-                self.dev = InputDevice("/dev/input/event0")
+                # try and get a keyboard - event0 unless told otherwise,
+                # hub/input_hub.py follows any number of keyboards
+                self.dev = InputDevice(device_node)
                 have_dev = True
             except OSError:
                 print("Keyboard not found, waiting 3 seconds and retrying")
                 time.sleep(3)
             print("found a keyboard")
+        self.has_leds = ecodes.EV_LED in self.dev.capabilities()
 
     def change_state(self, event):
-        evdev_code = ecodes.KEY[event.code]
-        modkey_element = keymap.modkey(evdev_code)
+        modmask = keymap.modmask_by_code[event.code]
 
-        if modkey_element > 0:
-            if self.state[2][modkey_element] == 0:
-                self.state[2][modkey_element] = 1
+        if modmask:
+            if event.value == 1:
+                self.state.press_modifier(modmask)
             else:
-                self.state[2][modkey_element] = 0
+                self.state.release_modifier(modmask)
         else:
             # Get the keycode of the key
-            hex_key = keymap.convert(ecodes.KEY[event.code])
-            # Loop through elements 4 to 9 of the inport report structure
-            for i in range(4, 10):
-                if self.state[i] == hex_key and event.value == 0:
-                    # Code 0 so we need to depress it
-                    self.state[i] = 0x00
-                elif self.state[i] == 0x00 and event.value == 1:
-                    # if the current space if empty and the key is being pressed
-                    self.state[i] = hex_key
-                    break
-
-    # poll for keyboard events
+            hex_key = keymap.usage_by_code[event.code]
+            if hex_key == 0:
+                return
+            if event.value == 1:
+                self.state.press(hex_key)
+            else:
+                self.state.release(hex_key)
+
+    def set_leds(self, ledvalue):
+        """lights the keyboard LEDs, HID LED bits are the evdev LED codes"""
+        if not self.has_leds:
+            return
+        try:
+            report_socket.set_leds(self.dev, ledvalue)
+        except OSError as err:
+            print("Could not set the keyboard LEDs:", err)
+
+    def handle_socket(self):
+        """applies the LEDs the server pushed on the report socket"""
+        try:
+            leds = self.socket.read_leds()
+        except OSError as err:
+            print("Report socket failed, no more LED updates:", err)
+            self.socket.close()
+            self.socket = None
+            return
+        if leds is not None:
+            self.set_leds(leds)
+
+    # poll for keyboard events and LED updates
     def event_loop(self):
-        for event in self.dev.read_loop():
-            # only bother if we hit a key and its an up or down event
-            if event.type == ecodes.EV_KEY and event.value < 2:
-                self.change_state(event)
-                self.send_input()
+        while True:
+            descriptors = [self.dev]
+            if self.socket is not None:
+                descriptors.append(self.socket)
+            r, w, x = select(descriptors, [], [])
+            if self.socket is not None and self.socket in r:
+                self.handle_socket()
+            if self.dev in r:
+                for event in self.dev.read():
+                    self.handle_event(event)
+
+    def handle_event(self, event):
+        if self.recorder is not None:
+            self.recorder.evdev_events(report_log.SOURCE_KEYBOARD, (event,))
+        # only bother if we hit a key and its an up or down event
+        if event.type == ecodes.EV_KEY and event.value < 2:
+            read_ns = time.time_ns() if self.latency else 0
+            self.change_state(event)
+            self.send_input(event, read_ns)
 
     # forward keyboard events to the dbus service
-    def send_input(self):
-        bin_str = ""
-        element = self.state[2]
-        for bit in element:
-            bin_str += str(bit)
-        a = self.state
-        print(*a)
-        self.iface.send_keys(int(bin_str, 2), self.state[4:10])
+    def send_input(self, event=None, read_ns=0):
+        report = self.state.changed()
+        if report is None:
+            return
+        print(*report)
+        if self.route is not None:
+            self.send_routed(report, event, read_ns)
+        elif self.latency and event is not None:
+            event_ns = event.sec * 1000000000 + event.usec * 1000
+            self.iface.send_report_timed(
+                report, [event_ns, read_ns, time.time_ns()])
+        elif self.nkro:
+            self.iface.send_keys_nkro(self.state.modifiers, bytes(self.state.bitmap))
+        else:
+            self.iface.send_keys(self.state.modifiers, bytes(self.state.keys))
+
+    def send_routed(self, report, event, read_ns):
+        """sends report to self.route, over D-Bus without the report socket"""
+        if self.socket is not None:
+            stamps = None
+            if self.latency and event is not None:
+                stamps = (event.sec * 1000000000 + event.usec * 1000, read_ns,
+                          time.time_ns())
+            try:
+                self.socket.send(report, stamps)
+                return
+            except OSError as err:
+                print("Report socket failed, falling back to D-Bus:", err)
+                self.socket.close()
+                self.socket = None
+        self.iface.send_report_to(self.route, bytes(report))
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Forward a local keyboard to the btk_server service")
+    parser.add_argument(
+        "--nkro", action="store_true",
+        help="send n-key rollover reports (btk_server must run with --nkro)")
+    parser.add_argument(
+        "--device", default="/dev/input/event0",
+        help="keyboard event device (default: %(default)s)")
+    parser.add_argument(
+        "--latency", action="store_true",
+        help="send event timestamps for btk_server --latency")
+    parser.add_argument(
+        "--record", metavar="PATH",
+        help="also record the raw key events to an events log")
+    parser.add_argument(
+        "--route", metavar="ROUTE",
+        help="send to all, adapter:<hciN>, host:<address> or group:<name> "
+             "instead of the service's route")
+    args = parser.parse_args()
 
     print("Setting up keyboard")
 
-    kb = Keyboard()
+    kb = Keyboard(nkro=args.nkro, device_node=args.device,
+                  latency=args.latency, record_path=args.record,
+                  route=args.route)
 
     print("starting event loop")
     kb.event_loop()
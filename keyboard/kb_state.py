@@ -0,0 +1,133 @@
+#
+# Keyboard state shared by the keyboard clients
+#
+# Holds what a boot keyboard report carries: a modifier byte and 6 key
+# slots. A usage -> slot index makes press and release constant time,
+# and changed() lets a client skip sending a report identical to the
+# last one it sent. Keys pressed while every slot is taken are still
+# held: they get the first slot that frees, oldest first. NkroKeyboardState has the same interface for the
+# n-key rollover report.
+#
+
+# modifier byte bits
+MOD_LEFTCTRL = 0x01
+MOD_LEFTSHIFT = 0x02
+MOD_LEFTALT = 0x04
+MOD_LEFTMETA = 0x08
+MOD_RIGHTCTRL = 0x10
+MOD_RIGHTSHIFT = 0x20
+MOD_RIGHTALT = 0x40
+MOD_RIGHTMETA = 0x80
+
+REPORT_ID_KEYBOARD = 0x01
+REPORT_ID_NKRO = 0x03
+KEY_SLOTS = 6
+# bytes in the n-key rollover usage bitmap, one bit per usage 0..255
+NKRO_BITMAP_SIZE = 32
+
+
+class KeyboardState():
+
+    def __init__(self):
+        self.modifiers = 0
+        self.keys = bytearray(KEY_SLOTS)
+        # usage -> index in keys
+        self.slots = {}
+        # every usage held down, in press order
+        self.held = {}
+        self.last = None
+
+    def press(self, usage):
+        """puts usage in a free slot, returns False if it is full or held
+
+        A usage that found no free slot is sent once one frees."""
+        if usage in self.held:
+            return False
+        self.held[usage] = None
+        slot = self.keys.find(0)
+        if slot < 0:
+            return False
+        self.keys[slot] = usage
+        self.slots[usage] = slot
+        return True
+
+    def release(self, usage):
+        if usage not in self.held:
+            return
+        del self.held[usage]
+        slot = self.slots.pop(usage, None)
+        if slot is None:
+            return
+        self.keys[slot] = 0
+        if len(self.held) >= KEY_SLOTS:
+            # the oldest key still held without a slot takes it
+            for waiting in self.held:
+                if waiting not in self.slots:
+                    self.keys[slot] = waiting
+                    self.slots[waiting] = slot
+                    break
+
+    def press_modifier(self, mask):
+        self.modifiers |= mask
+
+    def release_modifier(self, mask):
+        self.modifiers &= ~mask
+
+    def release_all(self):
+        self.modifiers = 0
+        self.keys[:] = bytes(KEY_SLOTS)
+        self.slots.clear()
+        self.held.clear()
+
+    def report(self):
+        """the state as a pre-encoded report: report id, modifiers, reserved, keys"""
+        return bytes((REPORT_ID_KEYBOARD, self.modifiers, 0)) + self.keys
+
+    def changed(self):
+        """returns the report if it differs from the last one returned, else None"""
+        report = self.report()
+        if report == self.last:
+            return None
+        self.last = report
+        return report
+
+
+class NkroKeyboardState():
+    """keyboard state for the n-key rollover report
+
+    Every usage has its own bit, so no key is ever dropped and press and
+    release are a single bit flip."""
+
+    def __init__(self):
+        self.modifiers = 0
+        self.bitmap = bytearray(NKRO_BITMAP_SIZE)
+        self.last = None
+
+    def press(self, usage):
+        self.bitmap[usage >> 3] |= 1 << (usage & 7)
+        return True
+
+    def release(self, usage):
+        self.bitmap[usage >> 3] &= ~(1 << (usage & 7))
+
+    def press_modifier(self, mask):
+        self.modifiers |= mask
+
+    def release_modifier(self, mask):
+        self.modifiers &= ~mask
+
+    def release_all(self):
+        self.modifiers = 0
+        self.bitmap[:] = bytes(NKRO_BITMAP_SIZE)
+
+    def report(self):
+        """the state as a pre-encoded report: report id, modifiers, bitmap"""
+        return bytes((REPORT_ID_NKRO, self.modifiers)) + self.bitmap
+
+    def changed(self):
+        """returns the report if it differs from the last one returned, else None"""
+        report = self.report()
+        if report == self.last:
+            return None
+        self.last = report
+        return report
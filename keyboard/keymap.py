@@ -196,3 +196,29 @@ def modkey(evdev_keycode):
         return modkeys[evdev_keycode]
     else:
         return -1 # Return an invalid array element
+
+
+# Flat lookup tables indexed directly by evdev key code, so a key event
+# costs an index instead of a code -> name -> usage dict chain. Codes
+# without a mapping are 0 in both tables.
+KEY_MAX = 0x2ff
+
+def _build_code_tables():
+    usage = bytearray(KEY_MAX + 1)
+    modmask = bytearray(KEY_MAX + 1)
+    try:
+        from evdev import ecodes
+    except ImportError:
+        # only the string clients run without evdev, and they go by name
+        return bytes(usage), bytes(modmask)
+    for name, hid_usage in keytable.items():
+        code = ecodes.ecodes.get(name)
+        if code is not None and code <= KEY_MAX:
+            usage[code] = hid_usage
+    for name, bit in modkeys.items():
+        # modkeys counts bits from the most significant end
+        modmask[ecodes.ecodes[name]] = 1 << (7 - bit)
+    return bytes(usage), bytes(modmask)
+
+# evdev key code -> HID usage, and -> modifier byte bit (0 if not a modifier)
+usage_by_code, modmask_by_code = _build_code_tables()
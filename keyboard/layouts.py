@@ -0,0 +1,222 @@
+#
+# Keyboard layout packs
+#
+# Maps characters to the HID key presses that type them on a host using a
+# given layout (US, DE, FR or UK, as the X11/Linux variants of these
+# layouts behave). A layout is compiled into a character -> strokes table,
+# where a stroke is usage | modifier byte << 8: one stroke for characters
+# on a key, two for characters typed with a dead key. Compiled tables are
+# stored with marshal under layout_cache/ and loaded from there, and are
+# rebuilt when missing or older than this file or keymap.py, whose usage
+# tables they are compiled from.
+#
+
+import marshal
+import os
+import unicodedata
+import keymap
+
+MOD_LEFTCTRL = 0x01
+MOD_LEFTSHIFT = 0x02
+# AltGr
+MOD_RIGHTALT = 0x40
+# modifiers for the normal, shift, AltGr and shift+AltGr levels of a key
+LEVELS = (0, MOD_LEFTSHIFT, MOD_RIGHTALT, MOD_LEFTSHIFT | MOD_RIGHTALT)
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "layout_cache")
+# bumped when the compiled table format changes
+FORMAT = 1
+
+# combining mark of every dead key accent
+COMBINING = {
+    "^": "\u0302",
+    "\u00b4": "\u0301",
+    "`": "\u0300",
+    "\u00a8": "\u0308",
+    "~": "\u0303",
+}
+# characters a dead key is combined with
+COMPOSE_BASES = "aeiouyncAEIOUYNC"
+
+
+def _letters():
+    return {"KEY_" + c.upper(): (c, c.upper()) for c in "abcdefghijklmnopqrstuvwxyz"}
+
+
+_BASE = dict(_letters(), **{
+    "KEY_SPACE": (" ",),
+    "KEY_ENTER": ("\n",),
+    "KEY_TAB": ("\t",),
+})
+
+# key name -> characters on its levels, "" for none
+_US = {
+    "KEY_GRAVE": ("`", "~"),
+    "KEY_1": ("1", "!"),
+    "KEY_2": ("2", "@"),
+    "KEY_3": ("3", "#"),
+    "KEY_4": ("4", "$"),
+    "KEY_5": ("5", "%"),
+    "KEY_6": ("6", "^"),
+    "KEY_7": ("7", "&"),
+    "KEY_8": ("8", "*"),
+    "KEY_9": ("9", "("),
+    "KEY_0": ("0", ")"),
+    "KEY_MINUS": ("-", "_"),
+    "KEY_EQUAL": ("=", "+"),
+    "KEY_LEFTBRACE": ("[", "{"),
+    "KEY_RIGHTBRACE": ("]", "}"),
+    "KEY_BACKSLASH": ("\\", "|"),
+    "KEY_SEMICOLON": (";", ":"),
+    "KEY_APOSTROPHE": ("'", "\""),
+    "KEY_COMMA": (",", "<"),
+    "KEY_DOT": (".", ">"),
+    "KEY_SLASH": ("/", "?"),
+}
+
+_UK = dict(_US, **{
+    "KEY_GRAVE": ("`", "¬", "|"),
+    "KEY_2": ("2", "\""),
+    "KEY_3": ("3", "£"),
+    "KEY_4": ("4", "$", "€"),
+    "KEY_APOSTROPHE": ("'", "@"),
+    "KEY_BACKSLASH": ("#", "~"),
+    "KEY_102ND": ("\\", "|"),
+})
+
+_DE = {
+    "KEY_GRAVE": ("", "°"),
+    "KEY_1": ("1", "!", "¹"),
+    "KEY_2": ("2", "\"", "²"),
+    "KEY_3": ("3", "§", "³"),
+    "KEY_4": ("4", "$"),
+    "KEY_5": ("5", "%"),
+    "KEY_6": ("6", "&"),
+    "KEY_7": ("7", "/", "{"),
+    "KEY_8": ("8", "(", "["),
+    "KEY_9": ("9", ")", "]"),
+    "KEY_0": ("0", "=", "}"),
+    "KEY_MINUS": ("ß", "?", "\\"),
+    "KEY_Q": ("q", "Q", "@"),
+    "KEY_E": ("e", "E", "€"),
+    "KEY_Y": ("z", "Z"),
+    "KEY_Z": ("y", "Y"),
+    "KEY_LEFTBRACE": ("ü", "Ü"),
+    "KEY_RIGHTBRACE": ("+", "*", "~"),
+    "KEY_SEMICOLON": ("ö", "Ö"),
+    "KEY_APOSTROPHE": ("ä", "Ä"),
+    "KEY_BACKSLASH": ("#", "'"),
+    "KEY_102ND": ("<", ">", "|"),
+    "KEY_M": ("m", "M", "µ"),
+    "KEY_COMMA": (",", ";"),
+    "KEY_DOT": (".", ":"),
+    "KEY_SLASH": ("-", "_"),
+}
+
+_FR = {
+    "KEY_GRAVE": ("²",),
+    "KEY_1": ("&", "1"),
+    "KEY_2": ("é", "2", "~"),
+    "KEY_3": ("\"", "3", "#"),
+    "KEY_4": ("'", "4", "{"),
+    "KEY_5": ("(", "5", "["),
+    "KEY_6": ("-", "6", "|"),
+    "KEY_7": ("è", "7", "`"),
+    "KEY_8": ("_", "8", "\\"),
+    "KEY_9": ("ç", "9", "^"),
+    "KEY_0": ("à", "0", "@"),
+    "KEY_MINUS": (")", "°", "]"),
+    "KEY_EQUAL": ("=", "+", "}"),
+    "KEY_Q": ("a", "A"),
+    "KEY_W": ("z", "Z"),
+    "KEY_E": ("e", "E", "€"),
+    "KEY_RIGHTBRACE": ("$", "£", "¤"),
+    "KEY_A": ("q", "Q"),
+    "KEY_SEMICOLON": ("m", "M"),
+    "KEY_APOSTROPHE": ("ù", "%"),
+    "KEY_BACKSLASH": ("*", "µ"),
+    "KEY_102ND": ("<", ">"),
+    "KEY_Z": ("w", "W"),
+    "KEY_M": (",", "?"),
+    "KEY_COMMA": (";", "."),
+    "KEY_DOT": (":", "/"),
+    "KEY_SLASH": ("!", "§"),
+}
+
+# name -> (keys, dead keys as accent -> (key name, level))
+LAYOUTS = {
+    "us": (_US, {}),
+    "uk": (_UK, {}),
+    "de": (_DE, {"^": ("KEY_GRAVE", 0), "´": ("KEY_EQUAL", 0),
+                 "`": ("KEY_EQUAL", 1)}),
+    "fr": (_FR, {"^": ("KEY_LEFTBRACE", 0), "¨": ("KEY_LEFTBRACE", 1)}),
+}
+DEFAULT_LAYOUT = "us"
+
+
+def stroke(usage, modifiers):
+    return usage | modifiers << 8
+
+
+def compile_layout(name):
+    """builds the character -> strokes table of a layout
+
+    Characters on more than one key are typed with the fewest modifiers.
+    Dead keys add the accented forms of COMPOSE_BASES and the bare accent
+    (accent, then space)."""
+    keys, dead = LAYOUTS[name]
+    table = {}
+    levels = {}
+    for key, chars in dict(_BASE, **keys).items():
+        usage = keymap.keytable[key]
+        for level, c in enumerate(chars):
+            if c and level < levels.get(c, len(LEVELS)):
+                table[c] = (stroke(usage, LEVELS[level]),)
+                levels[c] = level
+    for accent, (key, level) in dead.items():
+        accent_stroke = stroke(keymap.keytable[key], LEVELS[level])
+        for base in COMPOSE_BASES + " ":
+            if base == " ":
+                composed = accent
+            else:
+                composed = unicodedata.normalize("NFC", base + COMBINING[accent])
+            if len(composed) == 1 and composed not in table and base in table:
+                table[composed] = (accent_stroke,) + table[base]
+    return table
+
+
+def sources_mtime():
+    """newest modification time of the files the tables are compiled from"""
+    return max(os.path.getmtime(__file__), os.path.getmtime(keymap.__file__))
+
+
+def cache_path(name):
+    return os.path.join(CACHE_DIR, name + ".marshal")
+
+
+def load(name):
+    """returns the compiled table of a layout, compiling it if needed"""
+    if name not in LAYOUTS:
+        raise KeyError("unknown layout %r, known: %s" % (
+            name, ", ".join(sorted(LAYOUTS))))
+    path = cache_path(name)
+    try:
+        if os.path.getmtime(path) >= sources_mtime():
+            with open(path, "rb") as fh:
+                version, table = marshal.loads(fh.read())
+            if version == FORMAT:
+                return table
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    table = compile_layout(name)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as fh:
+            marshal.dump((FORMAT, table), fh)
+        os.replace(tmp, path)
+    except OSError:
+        # a read-only install still works, it just compiles every start
+        pass
+    return table
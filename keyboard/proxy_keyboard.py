@@ -2,8 +2,9 @@
 import dbus
 import dbus.service
 import dbus.mainloop.glib
-import time
 import keymap
+import kb_state
+import string_reports
 import sys
 import tty
 import termios
@@ -11,99 +12,52 @@ import termios
 class BtkStringClient():
     KEY_DOWN_TIME = 0.01
     KEY_DELAY = 0.01
+    # let the server send as fast as the link drains instead of the delays
+    PACED = False
 
     def __init__(self):
-        self.state = [
-            0xA1, 0x01, [0, 0, 0, 0, 0, 0, 0, 0], 0x00,
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x00
-        ]
-        self.scancodes = {
-            " ": "KEY_SPACE",
-            "!": "KEY_1",
-            "@": "KEY_2",
-            "#": "KEY_3",
-            "$": "KEY_4",
-            "%": "KEY_5",
-            "^": "KEY_6",
-            "&": "KEY_7",
-            "*": "KEY_8",
-            "(": "KEY_9",
-            ")": "KEY_0",
-            "-": "KEY_MINUS",
-            "_": "KEY_MINUS",
-            "=": "KEY_EQUAL",
-            "+": "KEY_EQUAL",
-            "[": "KEY_LEFTBRACE",
-            "{": "KEY_LEFTBRACE",
-            "]": "KEY_RIGHTBRACE",
-            "}": "KEY_RIGHTBRACE",
-            "\\": "KEY_BACKSLASH",
-            "|": "KEY_BACKSLASH",
-            ";": "KEY_SEMICOLON",
-            ":": "KEY_SEMICOLON",
-            "'": "KEY_APOSTROPHE",
-            "\"": "KEY_APOSTROPHE",
-            "`": "KEY_GRAVE",
-            "~": "KEY_GRAVE",
-            ",": "KEY_COMMA",
-            "<": "KEY_COMMA",
-            ".": "KEY_DOT",
-            ">": "KEY_DOT",
-            "/": "KEY_SLASH",
-            "?": "KEY_SLASH"
-        }
+        self.state = kb_state.KeyboardState()
         self.bus = dbus.SystemBus()
         self.btkservice = self.bus.get_object(
             'org.thanhle.btkbservice', '/org/thanhle/btkbservice')
         self.iface = dbus.Interface(self.btkservice, 'org.thanhle.btkbservice')
-
-    def send_key_state(self):
-        bin_str = "".join(map(str, self.state[2]))
-        self.iface.send_keys(int(bin_str, 2), self.state[4:10])
-
-    def send_key_down(self, scancode, modifiers):
-        self.state[2] = modifiers
-        self.state[4] = scancode
-        self.send_key_state()
-
-    def send_key_up(self):
-        self.state[4] = 0
-        self.send_key_state()
+        # type for the keyboard layout of the connected host
+        try:
+            self.layout, self.fallback = self.iface.get_host_layout()
+        except dbus.exceptions.DBusException:
+            self.layout = string_reports.layouts.DEFAULT_LAYOUT
+            self.fallback = string_reports.SKIP
+
+    def send_key(self, scancode, modifiers=0):
+        """sends key down and key up in one call, paced by the server"""
+        self.state.press_modifier(modifiers)
+        self.state.press(scancode)
+        reports = [self.state.report()]
+        self.state.release_all()
+        reports.append(self.state.report())
+        delays = [int(BtkStringClient.KEY_DOWN_TIME * 1000),
+                  int(BtkStringClient.KEY_DELAY * 1000)]
+        self.iface.send_reports(reports, delays)
 
     def send_char(self, c):
-        modifiers = [0, 0, 0, 0, 0, 0, 0, 0]
-        if c.isupper() or c in "!@#$%^&*()_+{}|:\"~<>?":
-            modifiers = [0, 0, 0, 0, 0, 0, 1, 0]
-        
-        scantablekey = f"KEY_{c.upper()}"
-        if c in self.scancodes:
-            scantablekey = self.scancodes[c]
-
-        try:
-            scancode = keymap.convert(scantablekey)
-            self.send_key_down(scancode, modifiers)
-            time.sleep(BtkStringClient.KEY_DOWN_TIME)
-            self.send_key_up()
-            time.sleep(BtkStringClient.KEY_DELAY)
-        except KeyError:
+        if BtkStringClient.PACED:
+            self.iface.type_string(c, {
+                "pace": True, "layout": self.layout, "fallback": self.fallback})
+            return
+        reports, delays, skipped = string_reports.timed_reports(
+            c, int(BtkStringClient.KEY_DOWN_TIME * 1000),
+            int(BtkStringClient.KEY_DELAY * 1000), self.layout, self.fallback)
+        if skipped:
             print(f"Unsupported character: {c}")
+        else:
+            self.iface.send_reports(reports, delays)
 
     def send_enter(self):
-        scancode = keymap.convert("KEY_ENTER")
-        self.send_key_down(scancode, [0,0,0,0,0,0,0,0])
-        time.sleep(BtkStringClient.KEY_DOWN_TIME)
-        self.send_key_up()
-        time.sleep(BtkStringClient.KEY_DELAY)
+        self.send_key(keymap.convert("KEY_ENTER"))
 
     def send_backspace(self):
         self.send_key(keymap.convert("KEY_BACKSPACE"))
 
-    def send_key(self, scancode):
-        self.send_key_down(scancode, [0,0,0,0,0,0,0,0])
-        time.sleep(BtkStringClient.KEY_DOWN_TIME)
-        self.send_key_up()
-        time.sleep(BtkStringClient.KEY_DELAY)
-
     def send_up(self):
         self.send_key(keymap.convert("KEY_UP"))
 
@@ -129,6 +83,8 @@ def getch():
     return ch
 
 if __name__ == "__main__":
+    if "--pace" in sys.argv[1:]:
+        BtkStringClient.PACED = True
     print("Starting Bluetooth Keyboard Proxy...")
     print("Press Ctrl+C to exit.")
     
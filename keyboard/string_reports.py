@@ -0,0 +1,117 @@
+#
+# Text to HID keyboard report conversion
+#
+# Shared by the string typing clients and by btk_server's type_string.
+# A report here is the pre-encoded form taken by send_reports: report id,
+# modifier byte, reserved byte and 6 key slots. Characters are looked up
+# in the compiled table of the host's keyboard layout (layouts.py).
+#
+
+import functools
+import layouts
+
+# compiled strings kept for repeated macros and snippets; longer texts
+# (long type_string payloads) are compiled uncached so a cache entry
+# stays small
+CACHE_SIZE = 256
+CACHE_MAX_LENGTH = 512
+
+# what to do with characters the layout cannot type
+SKIP = "skip"
+REPLACE = "replace"
+# Ctrl+Shift+U, the code point in hex, space (GTK/IBus on Linux hosts)
+UNICODE = "unicode"
+FALLBACKS = (SKIP, REPLACE, UNICODE)
+# typed for unmapped characters with the replace fallback
+REPLACEMENT = "?"
+
+# all keys and modifiers released
+KEY_UP = bytes([0x01, 0, 0, 0, 0, 0, 0, 0, 0])
+
+
+def key_report(usage, modifiers):
+    """encodes a keyboard report with a single key pressed"""
+    return bytes([0x01, modifiers, 0x00, usage, 0, 0, 0, 0, 0])
+
+
+@functools.lru_cache(maxsize=None)
+def _table(layout):
+    return layouts.load(layout)
+
+
+def _fallback(c, table, fallback):
+    """strokes typing c through the fallback, None to skip it"""
+    if fallback == REPLACE:
+        return table.get(REPLACEMENT)
+    if fallback == UNICODE:
+        try:
+            u = table["u"][-1]
+            digits = [table["%x" % int(d, 16)] for d in "%x" % ord(c)]
+            space = table[" "]
+        except KeyError:
+            return None
+        strokes = [u | (layouts.MOD_LEFTCTRL | layouts.MOD_LEFTSHIFT) << 8]
+        for digit in digits:
+            strokes.extend(digit)
+        strokes.extend(space)
+        return tuple(strokes)
+    return None
+
+
+def compile_string(text, layout=layouts.DEFAULT_LAYOUT, fallback=SKIP):
+    """converts text to a sequence of (report, down, typed) steps
+
+    Texts up to CACHE_MAX_LENGTH characters are cached."""
+    if len(text) <= CACHE_MAX_LENGTH:
+        return _compile_cached(text, layout, fallback)
+    return _compile(text, layout, fallback)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _compile_cached(text, layout, fallback):
+    return _compile(text, layout, fallback)
+
+
+def _compile(text, layout, fallback):
+    """converts text to a sequence of (report, down, typed) steps
+
+    down is True for reports that press a key and False for releases,
+    typed is 1 for the report that completes a character and 0 otherwise.
+    The next key is pressed straight from the previous one; a release is
+    only put in between when the next stroke reuses the key or needs other
+    modifiers, and once at the end. Characters the layout cannot type go
+    through fallback. Returns the steps and the characters that were left
+    out, both as tuples since results are cached."""
+    table = _table(layout)
+    steps = []
+    skipped = []
+    held = None
+    for c in text:
+        strokes = table.get(c)
+        if strokes is None:
+            strokes = _fallback(c, table, fallback)
+            if strokes is None:
+                skipped.append(c)
+                continue
+        last = len(strokes) - 1
+        for i, key in enumerate(strokes):
+            if held is not None and (key & 0xff == held & 0xff or
+                                     key >> 8 != held >> 8):
+                steps.append((KEY_UP, False, 0))
+            steps.append((key_report(key & 0xff, key >> 8), True,
+                          1 if i == last else 0))
+            held = key
+    if held is not None:
+        steps.append((KEY_UP, False, 0))
+    return tuple(steps), tuple(skipped)
+
+
+def timed_reports(text, down_ms, delay_ms, layout=layouts.DEFAULT_LAYOUT,
+                  fallback=SKIP):
+    """compile_string as the report and delay lists taken by send_reports
+
+    A key press is held for down_ms and a release for delay_ms."""
+    steps, skipped = compile_string(text, layout, fallback)
+    reports = [report for report, _, _ in steps]
+    delays = [down_ms if down else delay_ms for _, down, _ in steps]
+    return reports, delays, skipped
@@ -13,15 +13,74 @@ import sys
 from select import select
 import pyudev
 import re
+import math
+import argparse
+import atexit
+import struct
+import report_socket
+
+sys.path.append(os.path.join(sys.path[0], "..", "record"))
+import report_log
 
 logging.basicConfig(level=logging.DEBUG)
 
 
 class InputDevice():
     inputs = []
+    # one D-Bus connection and fast path socket shared by all inputs
+    bus = None
+    iface = None
+    socket = None
+    # pass event timestamps along for btk_server's latency statistics
+    latency = False
+    # report_log.LogWriter the raw events are recorded to, if any
+    recorder = None
+    # keyboard LEDs last set by the host, given to inputs as they appear
+    leds = 0
+    # where the reports go as set_route takes it, None for the service's route
+    route = None
+
+    @staticmethod
+    def connect():
+        InputDevice.bus = dbus.SystemBus()
+        btkservice = InputDevice.bus.get_object(
+            'org.thanhle.btkbservice', '/org/thanhle/btkbservice')
+        InputDevice.iface = dbus.Interface(btkservice, 'org.thanhle.btkbservice')
+        InputDevice.socket = report_socket.connect(route=InputDevice.route)
+
+    @staticmethod
+    def send_report(report, stamps=None):
+        """sends a pre-encoded report over the fast path, or D-Bus without it
+
+        stamps are the (event, read, send) latency timestamps, if any; a
+        routed report sent over D-Bus goes without them."""
+        if InputDevice.socket is not None:
+            try:
+                InputDevice.socket.send(report, stamps)
+                return
+            except OSError as err:
+                warning("Report socket failed, falling back to D-Bus: %s", err)
+                InputDevice.socket.close()
+                InputDevice.socket = None
+        try:
+            if InputDevice.route is not None:
+                InputDevice.iface.send_report_to(InputDevice.route, bytes(report))
+            elif stamps is None:
+                InputDevice.iface.send_report(bytes(report))
+            else:
+                InputDevice.iface.send_report_timed(bytes(report), stamps)
+        except dbus.DBusException as err:
+            error(err)
+
+    @staticmethod
+    def record(path):
+        """records the events of every input to an events log at path"""
+        InputDevice.recorder = report_log.LogWriter(path, report_log.EVENTS)
+        atexit.register(InputDevice.recorder.close)
 
     @staticmethod
     def init():
+        InputDevice.connect()
         context = pyudev.Context()
         devs = context.list_devices(subsystem="input")
         InputDevice.monitor = pyudev.Monitor.from_netlink(context)
@@ -45,15 +104,41 @@ class InputDevice():
     def remove_device(dev):
         if dev.device_node == None or not re.match(".*/event\\d+", dev.device_node):
             return
+        for i in InputDevice.inputs:
+            if i.device_node == dev.device_node:
+                i.close()
         InputDevice.inputs = list(
             filter(lambda i: i.device_node != dev.device_node, InputDevice.inputs))
-        print("Disconnected %s", dev)
+        info("Disconnected %s", dev.device_node)
+
+    @staticmethod
+    def handle_monitor():
+        """applies every pending udev add/remove event"""
+        for dev in iter(lambda: InputDevice.monitor.poll(0), None):
+            if dev.action == "add":
+                InputDevice.add_device(dev)
+            elif dev.action == "remove":
+                InputDevice.remove_device(dev)
 
     @staticmethod
     def set_leds_all(ledvalue):
+        InputDevice.leds = ledvalue
         for dev in InputDevice.inputs:
             dev.set_leds(ledvalue)
 
+    @staticmethod
+    def handle_socket():
+        """applies the LEDs the server pushed on the fast path socket"""
+        try:
+            leds = InputDevice.socket.read_leds()
+        except OSError as err:
+            warning("Report socket failed, falling back to D-Bus: %s", err)
+            InputDevice.socket.close()
+            InputDevice.socket = None
+            return
+        if leds is not None:
+            InputDevice.set_leds_all(leds)
+
     @staticmethod
     def grab(on):
         if on:
@@ -67,53 +152,182 @@ class InputDevice():
         self.device_node = device_node
         self.device = evdev.InputDevice(device_node)
         self.device.grab()
+        self.read_ns = 0
+        self.has_leds = ecodes.EV_LED in self.device.capabilities()
+        if InputDevice.leds:
+            self.set_leds(InputDevice.leds)
         info("Connected %s", self)
 
     def fileno(self):
         return self.device.fd
 
+    def read_events(self):
+        """reads every queued event in one go and feeds it to change_state"""
+        events = list(self.device.read())
+        if InputDevice.latency:
+            self.read_ns = time.time_ns()
+        if InputDevice.recorder is not None:
+            InputDevice.recorder.evdev_events(self.source, events)
+        for event in events:
+            self.change_state(event)
+
+    def set_leds(self, ledvalue):
+        """lights the LEDs of the input, HID LED bits are the evdev LED codes"""
+        if not self.has_leds:
+            return
+        try:
+            report_socket.set_leds(self.device, ledvalue)
+        except OSError as err:
+            warning("Could not set the LEDs of %s: %s", self, err)
+
+    def close(self):
+        try:
+            self.device.close()
+        except OSError:
+            # the device node is already gone
+            pass
+
     def __str__(self):
         return "%s@%s (%s)" % (self.__class__.__name__, self.device_node, self.device.name)
 
 
 class MouseInput(InputDevice):
+    source = report_log.SOURCE_MOUSE
+    # report rate ceiling in Hz
+    rate = 125
+    # keep the report interval at the configured rate instead of adapting it
+    fixed_rate = False
+    # pointer gain, and how much faster motion is amplified on top of it
+    speed = 1.0
+    accel = 0.0
+    # counts of motion per report at which acceleration adds one more speed
+    ACCEL_DISTANCE = 10
+    # the adaptive interval is this many times the measured send latency
+    LATENCY_FACTOR = 2
+    # weight of the newest sample in the send latency average
+    LATENCY_WEIGHT = 0.2
+    # send wide reports (report id 5): 16 bit motion, wheel in 1/8 detents
+    wide = False
+    WIDE_REPORT = struct.Struct("<Bhhh")
+    WHEEL_MULTIPLIER = 8
+    # evdev wheel motion in 1/120 detents, from kernel 5.0 on
+    REL_WHEEL_HI_RES = 11
+    HI_RES_DETENT = 120
+
+    @staticmethod
+    def configure(rate, fixed_rate, speed, accel, wide=False):
+        MouseInput.rate = rate
+        MouseInput.fixed_rate = fixed_rate
+        MouseInput.speed = speed
+        MouseInput.accel = accel
+        MouseInput.wide = wide
+
     def __init__(self, device_node):
         super().__init__(device_node)
         self.state = [0, 0, 0, 0]
+        # motion since the last report, in device counts
         self.x = 0
         self.y = 0
         self.z = 0
+        # scaled motion that did not fit in the last report
+        self.carry_x = 0.0
+        self.carry_y = 0.0
+        self.carry_z = 0
         self.change = False
         self.last = 0
-        self.bus = dbus.SystemBus()
-        self.btkservice = self.bus.get_object(
-            'org.thanhle.btkbservice', '/org/thanhle/btkbservice')
-        self.iface = dbus.Interface(self.btkservice, 'org.thanhle.btkbservice')
-        self.mouse_delay = 20 / 1000
-        self.mouse_speed = 1
+        self.send_latency = 0.0
+        # kernel timestamp of the oldest event in the next report
+        self.event_ns = 0
+        self.mouse_delay = 1 / MouseInput.rate
+        self.mouse_speed = MouseInput.speed
+        if MouseInput.wide:
+            # report id 5 followed by buttons and the 16 bit fields
+            self.frame = bytearray(8)
+            self.frame[0] = 5
+            self.limit = 0x7FFF
+            # take the wheel in 1/120 detents when the mouse reports them
+            rel = self.device.capabilities().get(ecodes.EV_REL, [])
+            self.hi_res_wheel = MouseInput.REL_WHEEL_HI_RES in rel
+        else:
+            # report id 2 followed by the 4 byte state
+            self.frame = bytearray(5)
+            self.frame[0] = 2
+            self.limit = 127
+            self.hi_res_wheel = False
 
     def send_current(self, ir):
-        try:
-            self.iface.send_mouse(0, bytes(ir))
-        except OSError as err:
-            error(err)
+        if MouseInput.wide:
+            MouseInput.WIDE_REPORT.pack_into(self.frame, 1, *ir)
+        else:
+            self.frame[1:] = ir
+        stamps = None
+        if self.event_ns:
+            stamps = (self.event_ns, self.read_ns, time.time_ns())
+            self.event_ns = 0
+        InputDevice.send_report(self.frame, stamps)
+
+    def interval(self):
+        """seconds between two motion reports"""
+        if MouseInput.fixed_rate:
+            return self.mouse_delay
+        return max(self.mouse_delay,
+                   MouseInput.LATENCY_FACTOR * self.send_latency)
+
+    def pending(self):
+        return (self.change or self.x or self.y or self.z
+                or abs(self.carry_x) >= 1 or abs(self.carry_y) >= 1
+                or abs(self.carry_z) >= 1)
+
+    def flush_timeout(self):
+        """seconds until pending motion is due, None if there is none"""
+        if not self.pending():
+            return None
+        return max(0, self.last + self.interval() - time.monotonic())
+
+    def gain(self):
+        gain = self.mouse_speed
+        if MouseInput.accel:
+            distance = math.hypot(self.x, self.y)
+            gain *= 1 + MouseInput.accel * distance / MouseInput.ACCEL_DISTANCE
+        return gain
+
+    def send_motion(self):
+        current = time.monotonic()
+        self.last = current
+        gain = self.gain()
+        # motion beyond the field range (-127..127, or -32767..32767 for
+        # wide reports) is carried to the next report
+        limit = self.limit
+        self.carry_x += self.x * gain
+        self.carry_y += self.y * gain
+        self.carry_z += self.z
+        dx = min(limit, max(-limit, int(self.carry_x)))
+        dy = min(limit, max(-limit, int(self.carry_y)))
+        dz = min(limit, max(-limit, int(self.carry_z)))
+        self.carry_x -= dx
+        self.carry_y -= dy
+        self.carry_z -= dz
+        self.x = 0
+        self.y = 0
+        self.z = 0
+        self.change = False
+        if MouseInput.wide:
+            self.send_current((self.state[0], dx, dy, dz))
+        else:
+            self.state[1] = dx & 255
+            self.state[2] = dy & 255
+            self.state[3] = dz & 255
+            self.send_current(self.state)
+        self.send_latency += MouseInput.LATENCY_WEIGHT * (
+            time.monotonic() - current - self.send_latency)
 
     def change_state(self, event):
+        if InputDevice.latency and not self.event_ns and event.type != ecodes.EV_SYN:
+            self.event_ns = event.sec * 1000000000 + event.usec * 1000
         if event.type == ecodes.EV_SYN:
-            current = time.monotonic()
-            diff = 20/1000
-            if current - self.last < diff and not self.change:
+            if time.monotonic() - self.last < self.interval() and not self.change:
                 return
-            self.last = current
-            speed = 1
-            self.state[1] = min(127, max(-127, int(self.x * speed))) & 255
-            self.state[2] = min(127, max(-127, int(self.y * speed))) & 255
-            self.state[3] = min(127, max(-127, self.z)) & 255
-            self.x = 0
-            self.y = 0
-            self.z = 0
-            self.change = False
-            self.send_current(self.state)
+            self.send_motion()
         if event.type == ecodes.EV_KEY:
             debug("Key event %s %d", ecodes.BTN[event.code], event.value)
             self.change = True
@@ -128,24 +342,73 @@ class MouseInput(InputDevice):
                 self.x += event.value
             if event.code == 1:
                 self.y += event.value
-            if event.code == 8:
-                self.z += event.value
+            if event.code == 8 and not self.hi_res_wheel:
+                self.z += event.value * (
+                    MouseInput.WHEEL_MULTIPLIER if MouseInput.wide else 1)
+            if event.code == MouseInput.REL_WHEEL_HI_RES and self.hi_res_wheel:
+                self.z += event.value * MouseInput.WHEEL_MULTIPLIER / \
+                    MouseInput.HI_RES_DETENT
 
     def get_info(self):
         print("hello")
 
-    def set_leds(self, ledvalue):
-        pass
-
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Forward local mice to the btk_server service")
+    parser.add_argument(
+        "--rate", type=float, default=MouseInput.rate, metavar="HZ",
+        help="report rate ceiling (default: %(default)s)")
+    parser.add_argument(
+        "--fixed-rate", action="store_true",
+        help="always report at --rate instead of adapting to send latency")
+    parser.add_argument(
+        "--speed", type=float, default=MouseInput.speed,
+        help="pointer gain (default: %(default)s)")
+    parser.add_argument(
+        "--accel", type=float, default=MouseInput.accel,
+        help="extra gain per %d counts of motion in a report (default: "
+             "%%(default)s)" % MouseInput.ACCEL_DISTANCE)
+    parser.add_argument(
+        "--wide", action="store_true",
+        help="send 16 bit motion and high resolution wheel reports")
+    parser.add_argument(
+        "--latency", action="store_true",
+        help="send event timestamps for btk_server --latency")
+    parser.add_argument(
+        "--record", metavar="PATH",
+        help="also record the raw mouse events to an events log")
+    parser.add_argument(
+        "--route", metavar="ROUTE",
+        help="send to all, adapter:<hciN>, host:<address> or group:<name> "
+             "instead of the service's route")
+    args = parser.parse_args()
+    InputDevice.latency = args.latency
+    InputDevice.route = args.route
+    if args.record:
+        InputDevice.record(args.record)
+    MouseInput.configure(args.rate, args.fixed_rate, args.speed, args.accel,
+                         args.wide)
+
     InputDevice.init()
     while True:
         desctiptors = [*InputDevice.inputs, InputDevice.monitor]
-        r = select(desctiptors, [], [])
+        if InputDevice.socket is not None:
+            desctiptors.append(InputDevice.socket)
+        timeouts = [t for t in (i.flush_timeout() for i in InputDevice.inputs)
+                    if t is not None]
+        r, w, x = select(desctiptors, [], [], min(timeouts, default=None))
+        if InputDevice.monitor in r:
+            InputDevice.handle_monitor()
+        if InputDevice.socket is not None and InputDevice.socket in r:
+            InputDevice.handle_socket()
         for i in InputDevice.inputs:
-            try:
-                for event in i.device.read():
-                    i.change_state(event)
-            except OSError as err:
-                warning(err)
+            if i in r:
+                try:
+                    i.read_events()
+                except OSError as err:
+                    warning(err)
+            # motion held back by the rate limit or carried over
+            t = i.flush_timeout()
+            if t is not None and t <= 0:
+                i.send_motion()
@@ -1,11 +1,14 @@
 #!/usr/bin/python3
 
 import os
-import sys
+import argparse
 import dbus
 import dbus.service
 import dbus.mainloop.glib
 
+# 绝对坐标的最大值，与服务端 hid_report.ABSOLUTE_MAX 相同
+ABSOLUTE_MAX = 0x7FFF
+
 
 class MouseClient():
 	def __init__(self):
@@ -35,16 +38,51 @@ class MouseClient():
 		except OSError as err:
 			error(err)
 
+	def send_absolute(self, x, y):
+		'''
+		一次把指针移动到绝对坐标 (x, y)，0..32767 对应整个屏幕，
+		不受主机鼠标加速影响
+		'''
+		try:
+			self.iface.send_mouse_absolute(self.state[0], x, y)
+		except dbus.DBusException as err:
+			print(err)
+
+def position(value):
+	'''argparse 类型：0..ABSOLUTE_MAX 之间的绝对坐标'''
+	try:
+		n = int(value)
+	except ValueError:
+		raise argparse.ArgumentTypeError("expected a number, got %r" % value)
+	if not 0 <= n <= ABSOLUTE_MAX:
+		raise argparse.ArgumentTypeError(
+			"position %d is outside 0..%d" % (n, ABSOLUTE_MAX))
+	return n
+
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		usage="%(prog)s button_num dx dy dz\n"
+		      "       %(prog)s --absolute x y [button_num]",
+		description="Send one mouse report to the btkbservice")
+	parser.add_argument(
+		"--absolute", nargs=2, type=position, metavar=("X", "Y"),
+		help="move the pointer to X, Y, 0..%d spans the screen" % ABSOLUTE_MAX)
+	parser.add_argument("values", nargs="*", type=int, help=argparse.SUPPRESS)
+	args = parser.parse_args()
 
-	if (len(sys.argv) < 5):
-		print("Usage: mouse_emulate [button_num dx dy dz]")
+	if args.absolute is not None:
+		if len(args.values) > 1:
+			parser.error("--absolute takes at most a button_num")
+		client = MouseClient()
+		if args.values:
+			client.state[0] = args.values[0]
+		print("position:", *args.absolute)
+		client.send_absolute(*args.absolute)
 		exit()
+	if len(args.values) != 4:
+		parser.error("expected button_num dx dy dz")
 	client = MouseClient()
-	client.state[0] = int(sys.argv[1])
-	client.state[1] = int(sys.argv[2])
-	client.state[2] = int(sys.argv[3])
-	client.state[3] = int(sys.argv[4])
+	client.state[:] = args.values
 	print("state:", client.state)
 	client.send_current()
 
@@ -0,0 +1,91 @@
+#
+# Client side of the btk_server report fast path
+#
+# Sends pre-encoded reports (report ID first) over the server's unix
+# SOCK_SEQPACKET ingress socket, one report per packet. connect() returns
+# None when the server does not offer the socket, so callers can fall
+# back to D-Bus. The server pushes the keyboard LED output report
+# (report ID 1, LED bits) back on the same socket. A route frame sends
+# the reports of the connection to other hosts than the service's route.
+#
+
+import socket
+import struct
+from logging import debug, info, warning, error
+
+DEFAULT_ADDRESS = "@btkbservice"
+REPORT_ID_KEYBOARD = 1
+# first byte of a route frame, followed by the route as set_route takes it
+ROUTE = 0
+# bits of the LED output report, num lock .. kana: bit n is evdev LED code n
+LED_CODES = range(5)
+# optional latency trailer: event, read and send CLOCK_REALTIME ns
+STAMPS = struct.Struct("<QQQ")
+
+
+class ReportSocket():
+
+    def __init__(self, address=DEFAULT_ADDRESS):
+        path = address
+        if address.startswith("@"):
+            path = "\0" + address[1:]
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def send(self, report, stamps=None):
+        if stamps is None:
+            self.sock.send(report)
+        else:
+            self.sock.send(bytes(report) + STAMPS.pack(*stamps))
+
+    def set_route(self, route):
+        """sends the later reports to route, None for the service's route"""
+        self.sock.send(bytes([ROUTE]) + (route or "").encode("ascii"))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_leds(self):
+        """LED bits of the last pushed LED report, None if none is pending"""
+        leds = None
+        while True:
+            try:
+                frame = self.sock.recv(64, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return leds
+            if not frame:
+                raise ConnectionError("btk_server closed the report socket")
+            if len(frame) == 2 and frame[0] == REPORT_ID_KEYBOARD:
+                leds = frame[1]
+
+    def close(self):
+        self.sock.close()
+
+
+def set_leds(device, leds):
+    """lights the LEDs of an evdev device from the LED bits the host set
+
+    Raises OSError if the device refuses them."""
+    for led in LED_CODES:
+        device.set_led(led, (leds >> led) & 1)
+
+
+def connect(address=DEFAULT_ADDRESS, route=None):
+    """the fast path socket, sending to route if given; None without it"""
+    try:
+        sock = ReportSocket(address)
+    except OSError as err:
+        debug("Report socket %s not available: %s", address, err)
+        return None
+    if route is not None:
+        try:
+            sock.set_route(route)
+        except OSError as err:
+            debug("Could not route report socket %s: %s", address, err)
+            sock.close()
+            return None
+    return sock
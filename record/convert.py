@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+#
+# Offline evdev log -> HID report log converter
+#
+# Turns an events log recorded by the input clients into a reports log
+# that replay.py sends without any per-event work. Keyboard events go
+# through the same key state as the clients. Mouse events are summed per
+# SYN_REPORT; with numpy that is done on whole columns of the mmap'ed log
+# at once, without it record by record. Motion beyond the -127..127 field
+# range is split over several reports, nothing is dropped. Unlike the live
+# client the converter applies no speed, acceleration or rate limit: every
+# SYN with motion or a button change becomes a report. Reports come out
+# in the order of the events that completed them in the log (which is not
+# strictly timestamp order when several devices were recorded), so both
+# paths write the same bytes.
+#
+# Usage: convert.py [--nkro] [--no-numpy] events.log reports.log
+#
+
+import argparse
+import os
+import sys
+import time
+from evdev import ecodes
+import report_log
+
+sys.path.append(os.path.join(sys.path[0], "..", "keyboard"))
+import keymap
+import kb_state
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy is not None:
+    # the record layouts of report_log
+    EVENT_DTYPE = numpy.dtype([("ns", "<u8"), ("type", "<u2"), ("code", "<u2"),
+                               ("value", "<i4"), ("source", "u1"), ("pad", "V7")])
+    REPORT_DTYPE = numpy.dtype([("ns", "<u8"), ("length", "u1"),
+                                ("report", "u1", (report_log.MAX_REPORT,))])
+
+REPORT_ID_MOUSE = 2
+# mouse buttons BTN_LEFT .. BTN_EXTRA are report bits 0..4
+BTN_FIRST = 0x110
+BUTTONS = 5
+# relative axes in report field order
+AXES = (ecodes.REL_X, ecodes.REL_Y, ecodes.REL_WHEEL)
+
+
+def mouse_reports(buttons, motion):
+    """reports for one SYN, motion (dx, dy, wheel) split into -127..127 steps"""
+    reports = []
+    left = list(motion)
+    while True:
+        part = [min(127, max(-127, d)) for d in left]
+        left = [d - p for d, p in zip(left, part)]
+        reports.append(bytes([REPORT_ID_MOUSE, buttons] + [p & 0xff for p in part]))
+        if not any(left):
+            return reports
+
+
+class EventConverter():
+    """converts event records to reports one at a time"""
+
+    def __init__(self, nkro=False):
+        if nkro:
+            self.keyboard = kb_state.NkroKeyboardState()
+        else:
+            self.keyboard = kb_state.KeyboardState()
+        self.buttons = 0
+        self.sent_buttons = 0
+        self.motion = [0, 0, 0]
+
+    def feed(self, ns, type, code, value, source):
+        """returns the (ns, report) pairs completed by this event"""
+        if source == report_log.SOURCE_KEYBOARD:
+            return self.key(ns, type, code, value)
+        if type == ecodes.EV_REL and code in AXES:
+            self.motion[AXES.index(code)] += value
+        elif type == ecodes.EV_KEY and value < 2 and \
+                0 <= code - BTN_FIRST < BUTTONS:
+            if value:
+                self.buttons |= 1 << (code - BTN_FIRST)
+            else:
+                self.buttons &= ~(1 << (code - BTN_FIRST))
+        elif type == ecodes.EV_SYN and code == ecodes.SYN_REPORT:
+            if any(self.motion) or self.buttons != self.sent_buttons:
+                reports = mouse_reports(self.buttons, self.motion)
+                self.motion = [0, 0, 0]
+                self.sent_buttons = self.buttons
+                return [(ns, report) for report in reports]
+        return []
+
+    def key(self, ns, type, code, value):
+        if type != ecodes.EV_KEY or value > 1 or code > keymap.KEY_MAX:
+            return []
+        modmask = keymap.modmask_by_code[code]
+        if modmask:
+            if value:
+                self.keyboard.press_modifier(modmask)
+            else:
+                self.keyboard.release_modifier(modmask)
+        else:
+            usage = keymap.usage_by_code[code]
+            if usage == 0:
+                return []
+            if value:
+                self.keyboard.press(usage)
+            else:
+                self.keyboard.release(usage)
+        report = self.keyboard.changed()
+        return [] if report is None else [(ns, report)]
+
+
+def convert_records(reader, nkro=False):
+    """(ns, report) pairs of an events log, record by record"""
+    converter = EventConverter(nkro)
+    for record in reader:
+        yield from converter.feed(*record)
+
+
+def convert_numpy(reader, nkro=False):
+    """report records of an events log, mouse events as whole columns"""
+    events = numpy.frombuffer(reader.map, dtype=EVENT_DTYPE, count=len(reader),
+                              offset=report_log.HEADER.size)
+    is_key = (events["source"] == report_log.SOURCE_KEYBOARD) & \
+        (events["type"] == ecodes.EV_KEY)
+    keys = events[is_key]
+    converter = EventConverter(nkro)
+    pairs = []
+    # index of the event that completed each of pairs, for the log order
+    pair_index = []
+    for index, ns, code, value in zip(numpy.flatnonzero(is_key).tolist(),
+                                      keys["ns"].tolist(), keys["code"].tolist(),
+                                      keys["value"].tolist()):
+        for pair in converter.key(ns, ecodes.EV_KEY, code, value):
+            pairs.append(pair)
+            pair_index.append(index)
+
+    is_mouse = events["source"] == report_log.SOURCE_MOUSE
+    mouse = events[is_mouse]
+    syn = (mouse["type"] == ecodes.EV_SYN) & (mouse["code"] == ecodes.SYN_REPORT)
+    # an event belongs to the first SYN at or after it; events after the
+    # last SYN are incomplete and left out
+    group = numpy.cumsum(syn) - syn
+    count = int(syn.sum())
+    syn_ns = mouse["ns"][syn]
+    syn_index = numpy.flatnonzero(is_mouse)[syn]
+    motion = []
+    for axis in AXES:
+        rel = (mouse["type"] == ecodes.EV_REL) & (mouse["code"] == axis) & \
+              (group < count)
+        motion.append(numpy.bincount(group[rel], weights=mouse["value"][rel],
+                                     minlength=count)[:count].astype(numpy.int64))
+    buttons = numpy.zeros(count, dtype=numpy.int64)
+    for bit in range(BUTTONS):
+        press = (mouse["type"] == ecodes.EV_KEY) & \
+                (mouse["code"] == BTN_FIRST + bit) & (mouse["value"] < 2)
+        if not press.any():
+            continue
+        button_group = group[press]
+        button_value = mouse["value"][press]
+        # button state at every SYN: the last event of the button up to it
+        last = numpy.searchsorted(button_group, numpy.arange(count),
+                                  side="right") - 1
+        held = numpy.where(last >= 0, button_value[numpy.maximum(last, 0)], 0)
+        buttons |= (held != 0).astype(numpy.int64) << bit
+    previous = numpy.concatenate(([0], buttons[:-1]))
+    send = (motion[0] != 0) | (motion[1] != 0) | (motion[2] != 0) | \
+           (buttons != previous)
+    fits = send & (numpy.abs(motion[0]) <= 127) & (numpy.abs(motion[1]) <= 127) & \
+           (numpy.abs(motion[2]) <= 127)
+    # SYNs within the field range become records in one go
+    records = numpy.zeros(int(fits.sum()), dtype=REPORT_DTYPE)
+    records["ns"] = syn_ns[fits]
+    records["length"] = 5
+    records["report"][:, 0] = REPORT_ID_MOUSE
+    records["report"][:, 1] = buttons[fits]
+    for i in range(3):
+        records["report"][:, 2 + i] = motion[i][fits] & 0xff
+    # the rest is split report by report
+    split = send & ~fits
+    for index, ns, b, dx, dy, dz in zip(syn_index[split].tolist(),
+                                        syn_ns[split].tolist(),
+                                        buttons[split].tolist(),
+                                        motion[0][split].tolist(),
+                                        motion[1][split].tolist(),
+                                        motion[2][split].tolist()):
+        for report in mouse_reports(b, (dx, dy, dz)):
+            pairs.append((ns, report))
+            pair_index.append(index)
+    extra = numpy.frombuffer(b"".join(
+        report_log.REPORT_RECORD.pack(ns, len(report), report)
+        for ns, report in pairs), dtype=REPORT_DTYPE)
+    records = numpy.concatenate((records, extra))
+    order = numpy.concatenate((syn_index[fits],
+                               numpy.array(pair_index, dtype=syn_index.dtype)))
+    # log order as convert_records; stable, so the reports of one SYN
+    # keep their order
+    return records[numpy.argsort(order, kind="stable")]
+
+
+def convert(source, target, nkro=False, use_numpy=True):
+    """converts events log source to reports log target, returns the report count"""
+    reader = report_log.LogReader(source)
+    try:
+        if reader.kind != report_log.EVENTS:
+            raise ValueError("%s is not an events log" % source)
+        writer = report_log.LogWriter(target, report_log.REPORTS)
+        count = 0
+        if use_numpy and numpy is not None:
+            records = convert_numpy(reader, nkro)
+            writer.write_records(records.tobytes())
+            count = len(records)
+        else:
+            for ns, report in convert_records(reader, nkro):
+                writer.report(ns, report)
+                count += 1
+        writer.close()
+        return count
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert an evdev events log to a HID reports log")
+    parser.add_argument("source", help="events log from a client --record")
+    parser.add_argument("target", help="reports log to write")
+    parser.add_argument(
+        "--nkro", action="store_true",
+        help="write n-key rollover keyboard reports")
+    parser.add_argument(
+        "--no-numpy", dest="use_numpy", action="store_false",
+        help="convert record by record even if numpy is installed")
+    args = parser.parse_args()
+    start = time.monotonic()
+    try:
+        count = convert(args.source, args.target, args.nkro, args.use_numpy)
+    except (OSError, ValueError) as err:
+        sys.exit(err)
+    print("%d reports written in %.2f s" % (count, time.monotonic() - start))
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+#
+# Streams a recorded input log back into btk_server
+#
+# Reports logs are sent as recorded; events logs are converted to reports
+# on the fly (see convert.py). Records are read from the mmap'ed log as
+# they are due, so a capture of any size replays in constant memory.
+# Reports go over the server's fast path socket, or D-Bus without it.
+#
+# Usage: replay.py [--speed X] [--repeat N] [--nkro] log
+#
+
+import argparse
+import os
+import sys
+import time
+import dbus
+import report_log
+
+sys.path.append(os.path.join(sys.path[0], "..", "mouse"))
+import report_socket
+
+
+class Replayer():
+
+    def __init__(self, address=report_socket.DEFAULT_ADDRESS):
+        self.socket = report_socket.connect(address)
+        self.iface = None
+        if self.socket is None:
+            bus = dbus.SystemBus()
+            self.iface = dbus.Interface(bus.get_object(
+                "org.thanhle.btkbservice", "/org/thanhle/btkbservice"),
+                "org.thanhle.btkbservice")
+
+    def send(self, report):
+        if self.socket is not None:
+            self.socket.send(report)
+        else:
+            # send_report goes out at once, send_reports would add the
+            # server's batch queue to the recorded timing
+            self.iface.send_report(report)
+
+    def replay(self, path, speed=1.0, nkro=False):
+        """sends the reports of a log, speed scales the recorded timing
+
+        speed 2 replays twice as fast, 0 sends as fast as possible. Returns
+        the number of reports sent."""
+        reader = report_log.LogReader(path)
+        try:
+            if reader.kind == report_log.EVENTS:
+                import convert
+                reports = convert.convert_records(reader, nkro)
+            else:
+                reports = reader.reports()
+            start = time.monotonic()
+            first = None
+            count = 0
+            for ns, report in reports:
+                if first is None:
+                    first = ns
+                if speed:
+                    delay = start + (ns - first) / 1e9 / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.send(report)
+                count += 1
+            return count
+        finally:
+            reader.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded input log into btk_server")
+    parser.add_argument("log", help="reports or events log")
+    parser.add_argument(
+        "--speed", type=float, default=1.0,
+        help="timing scale, 2 is twice as fast, 0 as fast as possible "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--repeat", type=int, default=1, metavar="N",
+        help="replay the log N times (default: %(default)s)")
+    parser.add_argument(
+        "--nkro", action="store_true",
+        help="convert the keys of an events log to n-key rollover reports")
+    parser.add_argument(
+        "--ingress", default=report_socket.DEFAULT_ADDRESS, metavar="ADDRESS",
+        help="btk_server fast path socket (default: %(default)s)")
+    args = parser.parse_args()
+
+    replayer = Replayer(args.ingress)
+    try:
+        for _ in range(args.repeat):
+            start = time.monotonic()
+            count = replayer.replay(args.log, args.speed, args.nkro)
+            elapsed = time.monotonic() - start
+            print("%d reports in %.2f s (%.0f reports/s)" % (
+                count, elapsed, count / elapsed if elapsed else 0))
+    except (OSError, ValueError) as err:
+        sys.exit(err)
+    except KeyboardInterrupt:
+        pass
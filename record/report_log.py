@@ -0,0 +1,122 @@
+#
+# Binary input log format
+#
+# A log is a 16 byte header followed by fixed size little endian records,
+# so it can be mmap'ed and indexed without parsing. A log holds one kind
+# of record:
+#
+#   reports  monotonic ns, report length, pre-encoded report (report ID
+#            first, no HIDP header) padded to MAX_REPORT bytes
+#   events   event ns, evdev type, code, value and the source device kind
+#
+# Written by btk_server --record (reports) and the input clients --record
+# (events), read by replay.py and convert.py.
+#
+
+import mmap
+import struct
+import time
+
+MAGIC = b"BTKBLOG\0"
+VERSION = 1
+# magic, version, record size, kind
+HEADER = struct.Struct("<8sHHB3x")
+
+REPORTS = 1
+EVENTS = 2
+KINDS = {REPORTS: "reports", EVENTS: "events"}
+
+# room for the largest report, so a record is 48 bytes
+MAX_REPORT = 39
+REPORT_RECORD = struct.Struct("<QB%ds" % MAX_REPORT)
+EVENT_RECORD = struct.Struct("<QHHiB7x")
+RECORDS = {REPORTS: REPORT_RECORD, EVENTS: EVENT_RECORD}
+
+# device kinds of event records
+SOURCE_KEYBOARD = 0
+SOURCE_MOUSE = 1
+
+
+class LogWriter():
+
+    def __init__(self, path, kind):
+        self.kind = kind
+        self.record = RECORDS[kind]
+        self.fh = open(path, "wb")
+        self.fh.write(HEADER.pack(MAGIC, VERSION, self.record.size, kind))
+
+    def report(self, ns, report):
+        """appends a pre-encoded report taken at monotonic time ns"""
+        self.fh.write(REPORT_RECORD.pack(ns, len(report), bytes(report)))
+
+    def event(self, ns, source, type, code, value):
+        self.fh.write(EVENT_RECORD.pack(ns, type, code, value, source))
+
+    def evdev_events(self, source, events):
+        """appends evdev events, their CLOCK_REALTIME stamps moved to the
+        monotonic clock"""
+        offset = time.time_ns() - time.monotonic_ns()
+        for event in events:
+            self.fh.write(EVENT_RECORD.pack(
+                event.sec * 1000000000 + event.usec * 1000 - offset,
+                event.type, event.code, event.value, source))
+
+    def write_records(self, data):
+        """appends already packed records"""
+        self.fh.write(data)
+
+    def flush(self):
+        self.fh.flush()
+        return True
+
+    def close(self):
+        self.fh.close()
+
+
+class LogReader():
+    """a log mapped into memory, records are unpacked as they are read"""
+
+    def __init__(self, path):
+        self.fh = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.fh.close()
+            raise ValueError("%s is empty" % path)
+        if len(self.map) < HEADER.size:
+            self.close()
+            raise ValueError("%s is not an input log" % path)
+        magic, version, size, self.kind = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or RECORDS.get(self.kind) is None \
+                or RECORDS[self.kind].size != size:
+            self.close()
+            raise ValueError("%s is not a version %d input log" % (path, VERSION))
+        self.record = RECORDS[self.kind]
+        # a record cut short by a crash is ignored
+        self.count = (len(self.map) - HEADER.size) // size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.record.unpack_from(self.map, HEADER.size + i * self.record.size)
+
+    def __iter__(self):
+        end = HEADER.size + self.count * self.record.size
+        for offset in range(HEADER.size, end, self.record.size):
+            yield self.record.unpack_from(self.map, offset)
+
+    def reports(self):
+        """yields (ns, report) of a reports log"""
+        for ns, length, data in self:
+            yield ns, data[:length]
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            # numpy views of the map are still alive, it is unmapped with them
+            pass
+        self.fh.close()
@@ -0,0 +1,113 @@
+#
+# Bluetooth adapter setup without hciconfig
+#
+# Name, power and discoverability are BlueZ org.bluez.Adapter1 properties
+# set over the already open system bus. The class of device is read-only
+# there, so it is written with the HCI Write_Class_of_Device command on a
+# raw HCI socket, the same command hciconfig sends, falling back to
+# hciconfig if the socket cannot be used.
+#
+
+import socket
+import struct
+import subprocess
+from logging import debug, info, warning, error
+import dbus
+
+ADAPTER_INTERFACE = "org.bluez.Adapter1"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+
+# not defined when Python is built without Bluetooth support
+AF_BLUETOOTH = getattr(socket, "AF_BLUETOOTH", 31)
+BTPROTO_HCI = getattr(socket, "BTPROTO_HCI", 1)
+BTPROTO_L2CAP = getattr(socket, "BTPROTO_L2CAP", 0)
+HCI_COMMAND_PKT = 0x01
+# OGF 0x03 (controller and baseband), OCF 0x0024
+OP_WRITE_CLASS_OF_DEVICE = 0x0C24
+
+
+def adapter_path(adapter):
+    return "/org/bluez/" + adapter
+
+
+def list_adapters(bus):
+    """{"hciN": address} of the adapters BlueZ knows, sorted by name"""
+    manager = dbus.Interface(bus.get_object("org.bluez", "/"),
+                             "org.freedesktop.DBus.ObjectManager")
+    adapters = {}
+    for path, interfaces in manager.GetManagedObjects().items():
+        if ADAPTER_INTERFACE in interfaces:
+            adapters[str(path).rsplit("/", 1)[-1]] = \
+                str(interfaces[ADAPTER_INTERFACE]["Address"])
+    return dict(sorted(adapters.items(), key=lambda item: adapter_index(item[0])))
+
+
+def adapter_index(adapter):
+    try:
+        return int(adapter[3:])
+    except ValueError:
+        return -1
+
+
+def adapter_address(bus, adapter):
+    props = dbus.Interface(bus.get_object("org.bluez", adapter_path(adapter)),
+                           PROPERTIES_INTERFACE)
+    return str(props.Get(ADAPTER_INTERFACE, "Address"))
+
+
+def configure(bus, adapter, name):
+    """powers the adapter and makes it connectable and discoverable as name
+
+    Raises dbus.DBusException if BlueZ rejects a property."""
+    props = dbus.Interface(bus.get_object("org.bluez", adapter_path(adapter)),
+                           PROPERTIES_INTERFACE)
+    props.Set(ADAPTER_INTERFACE, "Powered", dbus.Boolean(True))
+    props.Set(ADAPTER_INTERFACE, "Alias", dbus.String(name))
+    # stay discoverable and pairable rather than for the default 3 minutes
+    props.Set(ADAPTER_INTERFACE, "DiscoverableTimeout", dbus.UInt32(0))
+    props.Set(ADAPTER_INTERFACE, "PairableTimeout", dbus.UInt32(0))
+    props.Set(ADAPTER_INTERFACE, "Discoverable", dbus.Boolean(True))
+    props.Set(ADAPTER_INTERFACE, "Pairable", dbus.Boolean(True))
+
+
+def set_device_class(adapter, device_class):
+    """writes the class of device of adapter ("hciN")"""
+    try:
+        dev_id = int(adapter[3:])
+        sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_HCI)
+        try:
+            sock.bind((dev_id,))
+            sock.send(struct.pack("<BHB", HCI_COMMAND_PKT,
+                                  OP_WRITE_CLASS_OF_DEVICE, 3)
+                      + device_class.to_bytes(3, "little"))
+        finally:
+            sock.close()
+    except (OSError, ValueError) as err:
+        warning("Could not set the device class over HCI (%s), using hciconfig",
+                err)
+        hciconfig(adapter, "class", "0x%06x" % device_class)
+
+
+def hciconfig(adapter, *args):
+    """runs hciconfig on adapter without a shell, logging a failure"""
+    command = ["hciconfig", adapter] + list(args)
+    try:
+        result = subprocess.run(command, check=False)
+    except OSError as err:
+        error("Could not run %s: %s", " ".join(command), err)
+        return
+    if result.returncode:
+        error("%s exited with %d", " ".join(command), result.returncode)
+
+
+def bonded_hosts(bus, adapter):
+    """addresses of the devices paired with adapter, known to BlueZ"""
+    manager = dbus.Interface(bus.get_object("org.bluez", "/"),
+                             "org.freedesktop.DBus.ObjectManager")
+    hosts = []
+    for path, interfaces in manager.GetManagedObjects().items():
+        device = interfaces.get("org.bluez.Device1")
+        if device is not None and device.get("Adapter") == adapter_path(adapter) \
+                and device.get("Paired"):
+            hosts.append(str(device["Address"]))
+    return hosts
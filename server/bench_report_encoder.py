@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+#
+# Microbenchmark for the btk_server report encoding path.
+#
+# Compares the original list building send_keys/send_mouse code with the
+# preallocated ReportEncoder. Runs without Bluetooth or D-Bus; the D-Bus
+# byte arrays are stood in for by bytes objects, which is what the service
+# receives with byte_arrays=True.
+#
+# Usage: bench_report_encoder.py [reports per run]
+#
+
+import sys
+import timeit
+from hid_report import ReportEncoder
+
+
+def legacy_keys(modifier_byte, keys):
+    state = [0xA1, 1, 0, 0, 0, 0, 0, 0, 0, 0]
+    state[2] = int(modifier_byte)
+    count = 4
+    for key_code in keys:
+        if(count < 10):
+            state[count] = int(key_code)
+        count += 1
+    return bytes(state)
+
+
+def legacy_mouse(modifier_byte, keys):
+    state = [0xA1, 2, 0, 0, 0, 0]
+    count = 2
+    for key_code in keys:
+        if(count < 6):
+            state[count] = int(key_code)
+        count += 1
+    return bytes(state)
+
+
+def run(label, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    print("%-22s %12.0f reports/s" % (label, number / best))
+    return number / best
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    encoder = ReportEncoder()
+    keys = bytes([4, 5, 0, 0, 0, 0])
+    mouse = bytes([1, 10, 246, 0])
+    # both paths must put the same bytes on the wire
+    assert legacy_keys(2, list(keys)) == encoder.keyboard(2, keys)
+    assert legacy_mouse(0, list(mouse)) == encoder.mouse(mouse)
+
+    keys_list = list(keys)
+    mouse_list = list(mouse)
+    old = run("keyboard (legacy)", lambda: legacy_keys(2, keys_list), number)
+    new = run("keyboard (encoder)", lambda: encoder.keyboard(2, keys), number)
+    print("%-22s %12.2fx" % ("keyboard speedup", new / old))
+    old = run("mouse (legacy)", lambda: legacy_mouse(0, mouse_list), number)
+    new = run("mouse (encoder)", lambda: encoder.mouse(mouse), number)
+    print("%-22s %12.2fx" % ("mouse speedup", new / old))
@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+#
+# Hardware-free throughput/latency benchmark for btk_server
+#
+# Runs BTKbService on a private dbus-daemon, with the L2CAP control and
+# interrupt channels of BTKbDevice replaced by unix SOCK_SEQPACKET
+# sockets connected to a fake HID host in this process. The fake host
+# timestamps every report and decodes it with the descriptor from the SDP
+# record, so malformed reports show up as decode errors.
+#
+# Each workload drives the service at a controlled rate and reports
+# reports/s, service CPU time per report and submit -> host latency
+# percentiles. Results are written as JSON; --compare prints the change
+# against an earlier results file.
+#
+# Usage: bench_server.py [--count N] [--output FILE] [--compare FILE]
+#
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import dbus
+
+import hid_descriptor
+
+SERVER_DIR = sys.path[0]
+sys.path.append(os.path.join(SERVER_DIR, "..", "keyboard"))
+sys.path.append(os.path.join(SERVER_DIR, "..", "mouse"))
+
+SERVICE_NAME = "org.thanhle.btkbservice"
+SERVICE_PATH = "/org/thanhle/btkbservice"
+# seconds to wait for the service to come up, and for reports to arrive
+STARTUP_TIMEOUT = 10
+DRAIN_TIMEOUT = 30
+
+
+def unix_address(address):
+    return "\0" + address[1:] if address.startswith("@") else address
+
+
+def serve(host_address, ingress_address, sdp_record_path):
+    """runs the service with the host channels on unix sockets (child process)"""
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    import send_queue
+    from btk_server import BTKbDevice, BTKbService
+
+    class LoopbackDevice(BTKbDevice):
+        def init_bt_device(self):
+            pass
+
+        def init_bluez_profile(self):
+            pass
+
+        def listen(self):
+            channels = []
+            for suffix in ("-ctrl", "-intr"):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+                sock.connect(unix_address(host_address + suffix))
+                channels.append(sock)
+            self.connect_channels(*channels, host_address)
+            return False
+
+    DBusGMainLoop(set_as_default=True)
+    # nothing may be dropped or merged, the host matches reports 1:1
+    service = BTKbService(ingress_address=ingress_address,
+                          device_class=LoopbackDevice, device_options={
+                              "queue_capacity": 1 << 20,
+                              "keyboard_policy": send_queue.KEEP_ALL,
+                              "mouse_policy": send_queue.KEEP_ALL,
+                              "coalesce_mouse": False,
+                              "sdp_record_path": sdp_record_path,
+                              "host_cache_path": None,
+                          })
+    GLib.MainLoop().run()
+
+
+class FakeHost(threading.Thread):
+    """accepts the two channels and timestamps every interrupt report"""
+
+    def __init__(self, address):
+        super().__init__(daemon=True)
+        self.listeners = []
+        for suffix in ("-ctrl", "-intr"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            sock.bind(unix_address(address + suffix))
+            sock.listen(1)
+            self.listeners.append(sock)
+        self.arrivals = []
+        self.cond = threading.Condition()
+
+    def run(self):
+        self.control, _ = self.listeners[0].accept()
+        self.interrupt, _ = self.listeners[1].accept()
+        while True:
+            report = self.interrupt.recv(256)
+            now = time.monotonic_ns()
+            if not report:
+                return
+            with self.cond:
+                self.arrivals.append((now, report))
+                self.cond.notify()
+
+    def take(self, count, timeout=DRAIN_TIMEOUT):
+        """waits for count reports and returns them, [] on timeout"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while len(self.arrivals) < count:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return []
+                self.cond.wait(left)
+            arrivals = self.arrivals[:count]
+            del self.arrivals[:count]
+        return arrivals
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+class Bench():
+
+    def __init__(self, sdp_record_path):
+        tag = "btkbench-%d" % os.getpid()
+        self.host_address = "@" + tag + "-host"
+        self.ingress_address = "@" + tag + "-ingress"
+        self.decoder = hid_descriptor.Decoder(
+            hid_descriptor.from_sdp_record(sdp_record_path))
+        self.daemon = subprocess.Popen(
+            ["dbus-daemon", "--session", "--nofork", "--print-address"],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        address = self.daemon.stdout.readline().strip()
+        # the service and the clients all use dbus.SystemBus()
+        os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = address
+        self.host = FakeHost(self.host_address)
+        self.host.start()
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--serve",
+             self.host_address, self.ingress_address, sdp_record_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.bus = dbus.SystemBus()
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while not self.bus.name_has_owner(SERVICE_NAME):
+            if time.monotonic() > deadline or self.server.poll() is not None:
+                self.close()
+                sys.exit("btk_server did not come up on the private bus")
+            time.sleep(0.05)
+        self.iface = dbus.Interface(
+            self.bus.get_object(SERVICE_NAME, SERVICE_PATH), SERVICE_NAME)
+
+    def close(self):
+        self.server.terminate()
+        self.daemon.terminate()
+
+    def cpu_seconds(self):
+        with open("/proc/%d/stat" % self.server.pid) as fh:
+            fields = fh.read().rsplit(")", 1)[1].split()
+        # utime and stime, in clock ticks
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def run(self, name, count, submit, rate=0):
+        """calls submit(i) for i in range(count) at rate calls/s (0: flat out)
+
+        submit returns how many reports it handed to the service."""
+        submitted = []
+        cpu = self.cpu_seconds()
+        start = time.monotonic_ns()
+        interval = 1e9 / rate if rate else 0
+        for i in range(count):
+            if interval:
+                delay = start + i * interval - time.monotonic_ns()
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+            now = time.monotonic_ns()
+            submitted.extend([now] * submit(i))
+        arrivals = self.host.take(len(submitted))
+        cpu = self.cpu_seconds() - cpu
+        if not arrivals:
+            print("%-22s timed out" % name)
+            return None
+        errors = 0
+        for _, report in arrivals:
+            try:
+                # strip the HIDP header
+                self.decoder.decode(report[1:])
+            except ValueError:
+                errors += 1
+        latencies = [(arrival - sent) / 1000
+                     for sent, (arrival, _) in zip(submitted, arrivals)]
+        elapsed = (arrivals[-1][0] - start) / 1e9
+        result = {
+            "reports": len(arrivals),
+            "target_rate": rate,
+            "reports_per_sec": len(arrivals) / elapsed,
+            "cpu_us_per_report": cpu * 1e6 / len(arrivals),
+            "latency_us": {
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies),
+            },
+            "decode_errors": errors,
+        }
+        print("%-22s %9.0f reports/s %7.1f us cpu/report  p50 %7.0f us  "
+              "p99 %7.0f us  max %7.0f us  errors %d" % (
+                  name, result["reports_per_sec"], result["cpu_us_per_report"],
+                  result["latency_us"]["p50"], result["latency_us"]["p99"],
+                  result["latency_us"]["max"], errors))
+        return result
+
+    def workloads(self, count, rates):
+        import report_socket
+        import send_string
+        import string_reports
+
+        results = {}
+        keys = [bytes([4 + i % 26]) for i in range(count)]
+
+        def send_keys(i):
+            self.iface.send_keys(i & 0x02, keys[i])
+            return 1
+
+        def send_mouse(i):
+            self.iface.send_mouse(0, bytes([0, 1, 0xff, 0]))
+            return 1
+
+        for rate in rates:
+            label = "%d/s" % rate if rate else "max"
+            results["send_keys@" + label] = self.run(
+                "send_keys@" + label, count, send_keys, rate)
+            results["send_mouse@" + label] = self.run(
+                "send_mouse@" + label, count, send_mouse, rate)
+
+        sock = report_socket.connect(self.ingress_address)
+        if sock is not None:
+            frame = bytes([2, 0, 1, 0xff, 0])
+
+            def ingress_mouse(i):
+                sock.send(frame)
+                return 1
+
+            for rate in rates:
+                label = "%d/s" % rate if rate else "max"
+                results["ingress_mouse@" + label] = self.run(
+                    "ingress_mouse@" + label, count, ingress_mouse, rate)
+            sock.close()
+
+        batch = [bytes([1, 0, 0, 4 + i % 26, 0, 0, 0, 0, 0]) for i in range(256)]
+
+        def send_reports(i):
+            self.iface.send_reports(batch, [])
+            return len(batch)
+
+        results["send_reports"] = self.run(
+            "send_reports", max(1, count // len(batch)), send_reports)
+
+        text = "the quick brown fox jumps over the lazy dog " * (count // 88 + 1)
+        text = text[:count // 2]
+        steps, _ = string_reports.compile_string(text)
+        client = send_string.BtkStringClient()
+        send_string.BtkStringClient.KEY_DOWN_TIME = 0
+        send_string.BtkStringClient.KEY_DELAY = 0
+        send_string.BtkStringClient.PACED = False
+
+        def string_client(i):
+            client.send_string(text)
+            return len(steps)
+
+        results["string_client"] = self.run("string_client", 1, string_client)
+
+        def type_string(i):
+            self.iface.type_string(text, {"key_down_ms": dbus.UInt32(0),
+                                          "key_delay_ms": dbus.UInt32(0)})
+            return len(steps)
+
+        results["type_string"] = self.run("type_string", 1, type_string)
+
+        def type_string_paced(i):
+            self.iface.type_string(text, {"pace": True})
+            return len(steps)
+
+        results["type_string_paced"] = self.run(
+            "type_string_paced", 1, type_string_paced)
+        return {name: result for name, result in results.items() if result}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SERVER_DIR,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare(old, new):
+    print("\n%-22s %12s %12s %10s" % ("workload", "reports/s", "p99 us", "cpu/rep"))
+    for name, result in new["workloads"].items():
+        before = old["workloads"].get(name)
+        if before is None:
+            continue
+
+        def change(key, sub=None):
+            a = before[key] if sub is None else before[key][sub]
+            b = result[key] if sub is None else result[key][sub]
+            return "%+.1f%%" % ((b - a) * 100 / a) if a else "n/a"
+
+        print("%-22s %12s %12s %10s" % (
+            name, change("reports_per_sec"), change("latency_us", "p99"),
+            change("cpu_us_per_report")))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--serve":
+        serve(*sys.argv[2:])
+        sys.exit()
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark btk_server without Bluetooth hardware")
+    parser.add_argument("--count", type=int, default=2000,
+                        help="reports per workload (default: %(default)s)")
+    parser.add_argument("--rates", default="500,2000,0",
+                        help="comma separated submit rates, 0 for flat out "
+                             "(default: %(default)s)")
+    parser.add_argument("--sdp-record",
+                        default=os.path.join(SERVER_DIR, "sdp_record.xml"),
+                        help="SDP record with the descriptor to decode with")
+    parser.add_argument("--output", default="bench_results.json",
+                        help="results file (default: %(default)s)")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    bench = Bench(args.sdp_record)
+    try:
+        workloads = bench.workloads(
+            args.count, [int(rate) for rate in args.rates.split(",")])
+    finally:
+        bench.close()
+    results = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "count": args.count,
+        "workloads": workloads,
+    }
+    with open(args.output, "w") as fh:
+        json.dump(results, fh, indent=2)
+    print("results written to " + args.output)
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(json.load(fh), results)
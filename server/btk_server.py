@@ -4,26 +4,54 @@
 #
 
 from __future__ import absolute_import, print_function
-from optparse import OptionParser, make_option
+import time
+# startup phases are timed from here, imports included
+STARTED = time.monotonic()
+import argparse
+import atexit
+import json
 import os
+import re
 import sys
-import uuid
 import dbus
 import dbus.service
 import dbus.mainloop.glib
-import time
 import socket
+from collections import deque
 from gi.repository import GLib
 from dbus.mainloop.glib import DBusGMainLoop
 import logging
 from logging import debug, info, warning, error
-import bluetooth
-from bluetooth import *
+from hid_report import ReportEncoder, REPORT_ID_KEYBOARD, REPORT_ID_MOUSE, REPORT_ID_NKRO, \
+    REPORT_ID_ABSOLUTE, REPORT_ID_MOUSE16
+import adapter
+from host_connection import HostConnection
+import reconnect
+import report_ingress
+import send_queue
+from latency import LatencyStats
+from pacer import Pacer
+
+# the text to report tables are shared with the keyboard clients
+sys.path.append(os.path.join(sys.path[0], "..", "keyboard"))
+import layouts
+import string_reports
+
+# binary log format shared with the recording clients and replay tools
+# (imported with --record only)
+sys.path.append(os.path.join(sys.path[0], "..", "record"))
 
 logging.basicConfig(level=logging.DEBUG)
 
-# @todo fill your host mac here manually
-TARGET_ADDRESS = "88:A2:9E:3A:34:42"
+# phase name -> seconds since STARTED, in the order reached
+startup_times = {}
+
+
+def startup_phase(name):
+    """records the first time a startup phase is reached"""
+    if name not in startup_times:
+        startup_times[name] = time.monotonic() - STARTED
+        info("Startup: %s after %.3f s", name, startup_times[name])
 
 class BTKbDevice():
     # change these constants
@@ -33,24 +61,115 @@ class BTKbDevice():
     # define some constants
     P_CTRL = 17  # Service port - must match port configured in SDP record
     P_INTR = 19  # Interrupt port - must match port configured in SDP record
-    # dbus path of the bluez profile we will create
+    # dbus path of the bluez profile we will create, owned by this service
+    # and shared by the devices of every adapter
+    PROFILE_DBUS_PATH = "/org/thanhle/btkbprofile"
     # file path of the sdp record to load
     SDP_RECORD_PATH = sys.path[0] + "/sdp_record.xml"
+    # same record with an n-key rollover keyboard collection added
+    SDP_RECORD_NKRO_PATH = sys.path[0] + "/sdp_record_nkro.xml"
     UUID = "00001124-0000-1000-8000-00805f9b34fb"
+    # adapter used when no adapter is given
+    ADAPTER = "hci0"
+    # peripheral, keyboard + pointing device
+    DEVICE_CLASS = 0x002540
+    # pending reports per report type on the interrupt channel
+    QUEUE_CAPACITY = 64
+    # hosts connected at the same time, a new host replaces the oldest
+    MAX_HOSTS = 1
+    # seconds between attempts to set up the listening sockets
+    LISTEN_RETRY = 3
+
+    # connection states
+    DISCONNECTED = "disconnected"
+    LISTENING = "listening"
+    CONNECTED = "connected"
+
+    # what happens to reports while no host is connected
+    BUFFER = "buffer"
+    DROP = "drop"
+    DISCONNECTED_POLICIES = (BUFFER, DROP)
+
+    # routes: every connected host, "adapter:<hciN>", "host:<address>" or
+    # "group:<name>"
+    ROUTE_ALL = "all"
 
-    def __init__(self):
-        print("2. Setting up BT device")
+    def __init__(self, queue_capacity=QUEUE_CAPACITY,
+                 keyboard_policy=send_queue.KEEP_ALL,
+                 mouse_policy=send_queue.LATEST_WINS,
+                 disconnected_policy=DROP, coalesce_mouse=True,
+                 sdp_record_path=SDP_RECORD_PATH, on_state_change=None,
+                 on_leds=None,
+                 host_cache_path=reconnect.DEFAULT_CACHE_PATH, hosts=(),
+                 max_hosts=MAX_HOSTS, adapter_name=ADAPTER, name=MY_DEV_NAME,
+                 class_of_device=DEVICE_CLASS):
+        print("2. Setting up BT device on " + adapter_name)
+        self.adapter_name = adapter_name
+        self.name = name
+        self.class_of_device = class_of_device
+        # the adapter's own address, channels are bound to it once known
+        self.address = None
+        self.state = BTKbDevice.DISCONNECTED
+        # the most recently connected host
+        self.host = ""
+        self.on_state_change = on_state_change
+        # on_leds(host, leds) when a host set the keyboard LEDs
+        self.on_leds = on_leds
+        self.disconnected_policy = disconnected_policy
+        self.max_hosts = max_hosts
+        # address -> HostConnection, connected or with the control channel only
+        self.hosts = {}
+        # connected hosts, oldest first
+        self.connected = []
+        self.route = BTKbDevice.ROUTE_ALL
+        # group name -> host addresses
+        self.groups = {}
+        # hosts the route selects, kept up to date for the send path
+        self.targets = []
+        self.sdp_record_path = sdp_record_path
+        # latency.LatencyStats all hosts record to, if measured
+        self.latency = None
+        self.queue_capacity = queue_capacity
+        self.queue_policies = {
+            REPORT_ID_KEYBOARD: keyboard_policy,
+            REPORT_ID_MOUSE: mouse_policy,
+            REPORT_ID_NKRO: keyboard_policy,
+            REPORT_ID_ABSOLUTE: mouse_policy,
+            REPORT_ID_MOUSE16: mouse_policy,
+        }
+        self.coalesce_mouse = coalesce_mouse
+        # holds the reports sent while no host is connected
+        self.queue = self.new_queue()
+        # hosts that connected before, reconnected to actively
+        self.host_cache = reconnect.HostCache(host_cache_path)
+        self.host_cache.seed(hosts)
+        self.reconnector = reconnect.Reconnector(
+            self.host_cache, self.connect_channels, lambda: self.hosts)
         self.init_bt_device()
         self.init_bluez_profile()
 
     # configure the bluetooth hardware device
     def init_bt_device(self):
-        print("3. Configuring Device name " + BTKbDevice.MY_DEV_NAME)
-        # set the device class to a keybord and set the name
-        os.system("hciconfig hci0 up")
-        os.system("hciconfig hci0 name " + BTKbDevice.MY_DEV_NAME)
-        # make the device discoverable
-        os.system("hciconfig hci0 piscan")
+        print("3. Configuring Device name " + self.name)
+        # power up, set the name and make the device discoverable
+        try:
+            adapter.configure(dbus.SystemBus(), self.adapter_name, self.name)
+        except dbus.DBusException as err:
+            error("Could not configure %s over D-Bus: %s", self.adapter_name, err)
+            adapter.hciconfig(self.adapter_name, "up")
+            adapter.hciconfig(self.adapter_name, "name", self.name)
+            adapter.hciconfig(self.adapter_name, "piscan")
+        startup_phase("adapter configured")
+        try:
+            # with several adapters each one must only take its own hosts
+            self.address = adapter.adapter_address(dbus.SystemBus(),
+                                                   self.adapter_name)
+            self.reconnector.local_address = self.address
+            # hosts bonded before the cache existed are tried after cached ones
+            self.host_cache.seed(adapter.bonded_hosts(dbus.SystemBus(),
+                                                      self.adapter_name))
+        except dbus.DBusException as err:
+            warning("Could not read %s from BlueZ: %s", self.adapter_name, err)
 
     # set up a bluez profile to advertise device capabilities from a loaded service record
     def init_bluez_profile(self):
@@ -65,15 +184,24 @@ class BTKbDevice():
         bus = dbus.SystemBus()
         manager = dbus.Interface(bus.get_object(
             "org.bluez", "/org/bluez"), "org.bluez.ProfileManager1")
-        manager.RegisterProfile("/org/bluez/hci0", BTKbDevice.UUID, opts)
+        try:
+            manager.RegisterProfile(BTKbDevice.PROFILE_DBUS_PATH,
+                                    BTKbDevice.UUID, opts)
+        except dbus.DBusException as err:
+            # the profile serves every adapter, the first device registers it
+            if err.get_dbus_name() != "org.bluez.Error.AlreadyExists":
+                raise
         print("6. Profile registered ")
-        os.system("hciconfig hci0 class 0x002540")
+        startup_phase("profile registered")
+        # set the device class to a keyboard and mouse
+        adapter.set_device_class(self.adapter_name, self.class_of_device)
+        startup_phase("device class set")
 
     # read and return an sdp record from a file
     def read_sdp_service_record(self):
         print("5. Reading service record")
         try:
-            fh = open(BTKbDevice.SDP_RECORD_PATH, "r")
+            fh = open(self.sdp_record_path, "r")
         except:
             sys.exit("Could not open the sdp record. Exiting...")
         return fh.read()
@@ -86,99 +214,989 @@ class BTKbDevice():
         self.scontrol.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sinterrupt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # bind these sockets to a port - port zero to select next available
-        self.scontrol.bind((socket.BDADDR_ANY, self.P_CTRL))
-        self.sinterrupt.bind((socket.BDADDR_ANY, self.P_INTR))
+        address = self.address or socket.BDADDR_ANY
+        self.scontrol.bind((address, self.P_CTRL))
+        self.sinterrupt.bind((address, self.P_INTR))
 
-    # listen for incoming client connections
+    def set_state(self, state, host=""):
+        if state == self.state and host == self.host:
+            return
+        self.state = state
+        self.host = host
+        info("Connection state: %s %s", state, host)
+        if self.on_state_change is not None:
+            self.on_state_change(state, host)
+
+    # listen for incoming client connections, never blocks
     def listen(self):
         print("\033[0;33m7. Waiting for connections\033[0m")
-
-        # key point: use connect to get the host request for the accept() below
-        # it work, I just dont care for having been into it for 2days
-        self.setup_socket()
         try:
-            # must be ahead of listen or 'File descriptor in bad state'
-            self.scontrol.connect((TARGET_ADDRESS, self.P_CTRL))
-        except socket.error as err:
-            # it was expect to failed
-            print("Connect failed: "+str(err))
-
-        # this may not work
-        # os.system("bluetoothctl connect " + TARGET_ADDRESS)
-
-        self.setup_socket()
+            self.setup_socket()
+            # Start listening on the server sockets
+            self.scontrol.listen(5)
+            self.sinterrupt.listen(5)
+        except OSError as err:
+            error("Could not listen: %s, retrying in %d s", err,
+                  BTKbDevice.LISTEN_RETRY)
+            self.set_state(BTKbDevice.DISCONNECTED)
+            GLib.timeout_add_seconds(BTKbDevice.LISTEN_RETRY, self.listen)
+            return False
+        self.scontrol.setblocking(False)
+        self.sinterrupt.setblocking(False)
+        GLib.io_add_watch(self.scontrol, GLib.PRIORITY_DEFAULT, GLib.IO_IN,
+                          self.accept_control)
+        GLib.io_add_watch(self.sinterrupt, GLib.PRIORITY_DEFAULT, GLib.IO_IN,
+                          self.accept_interrupt)
+        self.set_state(BTKbDevice.LISTENING)
+        startup_phase("listening")
+        # the cached hosts are connected to while a host may still
+        # connect to the listening sockets
+        self.reconnect()
+        return False
 
-        # Start listening on the server sockets
-        self.scontrol.listen(5)
-        self.sinterrupt.listen(5)
+    def reconnect(self):
+        """keeps connecting to cached hosts while there is room for more"""
+        if self.state == BTKbDevice.DISCONNECTED:
+            return
+        if len(self.connected) < self.max_hosts:
+            self.reconnector.start()
 
-        self.ccontrol, cinfo = self.scontrol.accept()
+    def accept_control(self, sock, condition):
+        try:
+            conn, cinfo = sock.accept()
+        except BlockingIOError:
+            return True
         print (
             "\033[0;32mGot a connection on the control channel from %s \033[0m" % cinfo[0])
+        old = self.hosts.get(cinfo[0])
+        host = HostConnection(cinfo[0], self.host_closed, self.host_leds)
+        host.set_control(conn)
+        # in self.hosts first, so the reconnect run by host_closed leaves
+        # this host alone while its interrupt channel is on the way
+        self.hosts[host.address] = host
+        if old is not None:
+            # the host came back before we noticed it was gone
+            self.host_closed(old)
+        return True
 
-        self.cinterrupt, cinfo = self.sinterrupt.accept()
+    def accept_interrupt(self, sock, condition):
+        try:
+            conn, cinfo = sock.accept()
+        except BlockingIOError:
+            return True
         print (
             "\033[0;32mGot a connection on the interrupt channel from %s \033[0m" % cinfo[0])
+        host = self.hosts.get(cinfo[0])
+        if host is None or host.connected:
+            warning("Unexpected interrupt channel from %s", cinfo[0])
+            conn.close()
+            return True
+        self.host_connected(host, conn, reconnect.INBOUND)
+        return True
+
+    def connect_channels(self, control, interrupt, address):
+        """takes over the channels the reconnector opened to a host"""
+        host = self.hosts.get(address)
+        if host is not None:
+            if host.connected:
+                # the host was faster and connected itself
+                control.close()
+                interrupt.close()
+                return
+            # drop a control channel the host opened meanwhile
+            self.drop_host(host)
+        host = HostConnection(address, self.host_closed, self.host_leds)
+        host.set_control(control)
+        self.hosts[address] = host
+        self.host_connected(host, interrupt, reconnect.OUTBOUND)
+
+    def host_connected(self, host, interrupt, direction):
+        if len(self.connected) >= self.max_hosts:
+            # the oldest host makes room for the new one
+            self.drop_host(self.connected[0])
+        queue = self.new_queue()
+        if not self.connected and self.queue.entries:
+            # reports held while no host was connected go to this one
+            queue, self.queue = self.queue, queue
+        host.set_interrupt(interrupt, queue)
+        if self.latency is not None:
+            host.latency = queue.latency = LatencyStats(parent=self.latency)
+        self.connected.append(host)
+        self.update_targets()
+        self.reconnector.connected(host.address, direction)
+        self.set_state(BTKbDevice.CONNECTED, host.address)
+        self.reconnect()
+
+    def host_closed(self, host):
+        """a channel of host closed or sending to it failed"""
+        if host in self.connected:
+            self.reconnector.lost(host.address)
+        self.drop_host(host)
+        if host.unplugged:
+            # the host removed the pairing, reconnecting would be refused
+            self.host_cache.forget(host.address)
+            self.reconnector.forget(host.address)
+        if self.connected:
+            self.set_state(BTKbDevice.CONNECTED, self.connected[-1].address)
+        elif self.state == BTKbDevice.CONNECTED:
+            self.set_state(BTKbDevice.LISTENING)
+        self.reconnect()
+
+    def host_leds(self, host):
+        if self.on_leds is not None:
+            self.on_leds(host.address, host.leds)
+
+    def drop_host(self, host):
+        host.close()
+        if self.hosts.get(host.address) is host:
+            del self.hosts[host.address]
+        if host in self.connected:
+            self.connected.remove(host)
+            self.update_targets()
+            if not self.connected and self.disconnected_policy == BTKbDevice.BUFFER \
+                    and host.queue.entries:
+                # the reports the last host did not take wait for the next
+                self.queue = host.queue
+                self.queue.on_error = self.send_failed
+                self.queue.latency = self.latency
 
-    # send a string to the bluetooth host machine
-    def send_string(self, message):
+    def disconnect(self):
+        """drops every host and goes back to listening"""
+        for host in self.connected:
+            self.reconnector.lost(host.address)
+        for host in list(self.hosts.values()):
+            self.drop_host(host)
+        if self.disconnected_policy == BTKbDevice.DROP:
+            self.queue.clear()
+        if self.state == BTKbDevice.CONNECTED:
+            self.set_state(BTKbDevice.LISTENING)
+            self.reconnect()
+
+    def new_queue(self):
+        queue = send_queue.SendQueue(self.queue_capacity, self.queue_policies,
+                                     self.send_failed,
+                                     coalesce=self.coalesce_mouse)
+        queue.latency = self.latency
+        return queue
+
+    def route_hosts(self, route):
+        """connected hosts a route selects
+
+        Raises ValueError for a malformed route or an unknown group."""
+        if route == BTKbDevice.ROUTE_ALL:
+            return list(self.connected)
+        kind, _, name = route.partition(":")
+        if kind == "adapter":
+            return list(self.connected) if name == self.adapter_name else []
+        if kind == "host":
+            addresses = (name.upper(),)
+        elif kind == "group":
+            if name not in self.groups:
+                raise ValueError("unknown group %r" % name)
+            addresses = self.groups[name]
+        else:
+            raise ValueError("unknown route %r, expected %s, adapter:<hciN>, "
+                             "host:<address> or group:<name>"
+                             % (route, BTKbDevice.ROUTE_ALL))
+        return [host for host in self.connected if host.address in addresses]
+
+    def set_route(self, route):
+        """sends the reports without a route to route from now on"""
+        self.route_hosts(route)
+        self.route = route
+        self.update_targets()
+
+    def set_group(self, name, addresses):
+        """defines a group of hosts, an empty one is removed"""
+        if addresses:
+            self.groups[name] = [address.upper() for address in addresses]
+        else:
+            self.groups.pop(name, None)
+        self.update_targets()
+
+    def update_targets(self):
         try:
-            self.cinterrupt.send(bytes(message))
-        except OSError as err:
-            error(err)
-            self.listen()
+            self.targets = self.route_hosts(self.route)
+        except ValueError:
+            # the group of the route was removed
+            self.targets = []
+
+    def queue_for(self, route=None):
+        """send queue of the first host a route selects, else the held reports"""
+        hosts = self.targets if route is None else self.route_hosts(route)
+        return hosts[0].queue if hosts else self.queue
+
+    # send an encoded report (any bytes-like object) to the bluetooth host machine
+    def send_string(self, message, event_ns=0, route=None):
+        """sends message to the hosts of route, the current route if None"""
+        hosts = self.targets if route is None else self.route_hosts(route)
+        if hosts:
+            self.send_hosts(message, event_ns, hosts)
+        elif self.connected or self.disconnected_policy == BTKbDevice.DROP:
+            self.queue.drop(message)
+        else:
+            self.queue.send(message, event_ns)
+
+    def send_hosts(self, message, event_ns, hosts):
+        for host in hosts:
+            try:
+                host.send(message, event_ns)
+            except OSError as err:
+                # only this host is dropped, the others still get message
+                host.send_failed(err)
+
+    def send_failed(self, err):
+        error(err)
+        self.disconnect()
+
+
+class InvalidReport(dbus.DBusException):
+    _dbus_error_name = "org.thanhle.btkbservice.InvalidReport"
+
+
+class InvalidRoute(dbus.DBusException):
+    _dbus_error_name = "org.thanhle.btkbservice.InvalidRoute"
+
+
+class InvalidLayout(dbus.DBusException):
+    _dbus_error_name = "org.thanhle.btkbservice.InvalidLayout"
+
+
+class InvalidOption(dbus.DBusException):
+    _dbus_error_name = "org.thanhle.btkbservice.InvalidOption"
+
+
+class TypingJob():
+    """progress of one type_string call"""
+
+    def __init__(self, job_id, total, reports, max_rate=0):
+        self.job_id = job_id
+        self.total = total
+        self.typed = 0
+        # reports still to send, the last one finishes the job
+        self.reports = reports
+        self.sent = 0
+        # paced jobs: optional reports per second below the server ceiling
+        self.max_rate = max_rate
+        self.started = None
+
+    def stats(self):
+        """characters and reports per second achieved so far"""
+        elapsed = time.monotonic() - self.started if self.started else 0
+        return {
+            "characters": float(self.typed),
+            "reports": float(self.sent),
+            "seconds": elapsed,
+            "chars_per_sec": self.typed / elapsed if elapsed else 0.0,
+            "reports_per_sec": self.sent / elapsed if elapsed else 0.0,
+        }
 
 
 class BTKbService(dbus.service.Object):
+    # characters between two TypingProgress signals
+    PROGRESS_INTERVAL = 32
+    # default type_string timing in ms
+    KEY_DOWN_MS = 10
+    KEY_DELAY_MS = 10
+    # ceiling of paced type_string jobs in reports per second
+    TYPING_MAX_RATE = 500
+
+    # seconds between two writes of the latency textfile
+    TEXTFILE_INTERVAL = 15
+    # seconds between two flushes of the --record log
+    RECORD_FLUSH_INTERVAL = 1
 
-    def __init__(self):
+    def __init__(self, ingress_address=None, device_options=None,
+                 latency=False, latency_textfile=None, device_class=None,
+                 host_layouts_path=None, pace_typing=False,
+                 typing_max_rate=TYPING_MAX_RATE, record_path=None,
+                 adapters=None):
+        """adapters lists per adapter device options, one device each"""
         print("1. Setting up service")
         # set up as a dbus service
         bus_name = dbus.service.BusName(
             "org.thanhle.btkbservice", bus=dbus.SystemBus())
         dbus.service.Object.__init__(
             self, bus_name, "/org/thanhle/btkbservice")
-        # create and setup our device
-        self.device = BTKbDevice()
+        # preallocated report buffers for the send path
+        self.encoder = ReportEncoder()
+        # pre-encoded reports from send_reports waiting for their delay
+        self.pending_reports = deque()
+        self.drain_source = None
+        self.next_job_id = 1
+        # type_string paced by the interrupt channel's backpressure
+        self.pace_typing = pace_typing
+        self.pacer = Pacer(typing_max_rate)
+        self.typing_stats = {}
+        # host address or "default" -> [layout, fallback] for typed text
+        self.host_layouts_path = host_layouts_path
+        self.host_layouts = self.load_host_layouts()
+        # keyboard LEDs last set by any host
+        self.leds = 0
+        # create and setup a device per adapter, all on this main loop
+        self.connection_state = (BTKbDevice.DISCONNECTED, "")
+        self.devices = []
+        adapters = adapters or [{}]
+        for adapter_options in adapters:
+            options = dict(device_options or {}, **adapter_options)
+            device = (device_class or BTKbDevice)(
+                on_state_change=self.device_state_changed,
+                on_leds=self.leds_changed, **options)
+            # without its address a device binds every adapter, taking the
+            # channels of the other devices
+            if device.address is None and len(adapters) > 1:
+                error("Could not read the address of %s, not using it",
+                      device.adapter_name)
+                continue
+            self.devices.append(device)
+        if not self.devices:
+            sys.exit("No usable adapter. Exiting...")
+        # the first adapter holds the reports no host is routed to
+        self.device = self.devices[0]
+        # per stage latency histograms, None when not measured
+        self.latency = None
+        self.latency_textfile = latency_textfile
+        if latency or latency_textfile:
+            self.latency = LatencyStats()
+            for device in self.devices:
+                device.latency = self.latency
+                device.queue.latency = self.latency
+        if latency_textfile:
+            GLib.timeout_add_seconds(BTKbService.TEXTFILE_INTERVAL,
+                                     self.write_latency_textfile)
+        # report_log.LogWriter every report sent is recorded to, if any
+        self.recorder = None
+        if record_path:
+            import report_log
+            self.recorder = report_log.LogWriter(record_path, report_log.REPORTS)
+            GLib.timeout_add_seconds(BTKbService.RECORD_FLUSH_INTERVAL,
+                                     self.recorder.flush)
+            atexit.register(self.recorder.close)
         # start listening for connections
-        self.device.listen()
+        for device in self.devices:
+            device.listen()
+        # optional local socket for high rate producers
+        self.ingress = None
+        if ingress_address:
+            self.ingress = report_ingress.ReportIngress(
+                ingress_address, self.send_frame, self.check_route)
+        startup_phase("service ready")
 
-    @dbus.service.method('org.thanhle.btkbservice', in_signature='yay')
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='yay',
+                         byte_arrays=True)
     def send_keys(self, modifier_byte, keys):
-        print("Get send_keys request through dbus")
-        print("key msg: ", keys)
-        state = [ 0xA1, 1, 0, 0, 0, 0, 0, 0, 0, 0 ]
-        state[2] = int(modifier_byte)
-        count = 4
-        for key_code in keys:
-            if(count < 10):
-                state[count] = int(key_code)
-            count += 1
-        self.device.send_string(state)
-
-    @dbus.service.method('org.thanhle.btkbservice', in_signature='yay')
+        self.send(self.encoder.keyboard(modifier_byte, keys))
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='yay',
+                         byte_arrays=True)
     def send_mouse(self, modifier_byte, keys):
-        state = [0xA1, 2, 0, 0, 0, 0]
-        count = 2
-        for key_code in keys:
-            if(count < 6):
-                state[count] = int(key_code)
-            count += 1
-        self.device.send_string(state)
+        self.send(self.encoder.mouse(keys))
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='yay',
+                         byte_arrays=True)
+    def send_keys_nkro(self, modifier_byte, bitmap):
+        """sends an n-key rollover report, bit n of the 32 byte bitmap is usage n
+
+        Needs the service to be started with --nkro so the host knows the
+        report."""
+        self.send(self.encoder.nkro(modifier_byte, bitmap))
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='yqq')
+    def send_mouse_absolute(self, buttons, x, y):
+        """moves the pointer to x, y in one report, 0..32767 spans the screen"""
+        try:
+            self.send(self.encoder.absolute(buttons, x, y))
+        except ValueError as err:
+            raise InvalidReport(str(err))
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='yiii')
+    def send_mouse16(self, buttons, x, y, wheel):
+        """sends a wide mouse report: 16 bit motion, wheel in 1/8 detents"""
+        self.send(self.encoder.mouse16(buttons, x, y, wheel))
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='a{sd}')
+    def get_startup_times(self):
+        """seconds from process start to each startup phase"""
+        return startup_times
+
+    def send(self, message, event_ns=0, route=None):
+        """sends an encoded report to the hosts of route on every adapter
+
+        Raises ValueError for a malformed route or an unknown group."""
+        if len(self.devices) == 1:
+            targets = None
+        else:
+            targets = [(device, device.targets if route is None
+                        else device.route_hosts(route))
+                       for device in self.devices]
+        if self.recorder is not None:
+            # without the HIDP header, as the reports are sent to us
+            self.recorder.report(time.monotonic_ns(), message[1:])
+        if targets is None or not any(hosts for _, hosts in targets):
+            # held or dropped by the first adapter
+            self.device.send_string(message, event_ns, route)
+            return
+        for device, hosts in targets:
+            if hosts:
+                device.send_hosts(message, event_ns, hosts)
+
+    def connected_hosts(self):
+        """HostConnections of every adapter, oldest first"""
+        hosts = [host for device in self.devices for host in device.connected]
+        hosts.sort(key=lambda host: host.connected_at)
+        return hosts
+
+    def queue_for(self):
+        """send queue of the first routed host of any adapter"""
+        for device in self.devices:
+            if device.targets:
+                return device.targets[0].queue
+        return self.device.queue
+
+    def routed_host(self):
+        """address of the first routed host of any adapter, "" if none"""
+        for device in self.devices:
+            if device.targets:
+                return device.targets[0].address
+        return ""
+
+    def device_state_changed(self, state, host):
+        if state == BTKbDevice.CONNECTED:
+            self.resume_reports()
+        state = self.get_connection_state()
+        if state != self.connection_state:
+            self.connection_state = state
+            self.ConnectionStateChanged(*state)
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='ss')
+    def get_connection_state(self):
+        """returns the connection state and the last connected host address"""
+        hosts = self.connected_hosts()
+        if hosts:
+            return BTKbDevice.CONNECTED, hosts[-1].address
+        if any(device.state == BTKbDevice.LISTENING for device in self.devices):
+            return BTKbDevice.LISTENING, ""
+        return BTKbDevice.DISCONNECTED, ""
+
+    @dbus.service.signal('org.thanhle.btkbservice', signature='ss')
+    def ConnectionStateChanged(self, state, host):
+        pass
+
+    def leds_changed(self, host, leds):
+        """forwards a host's keyboard LEDs to the signal and ingress clients"""
+        self.leds = leds
+        self.LedsChanged(host, leds)
+        if self.ingress is not None:
+            self.ingress.push(bytes([REPORT_ID_KEYBOARD, leds]))
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='y')
+    def get_leds(self):
+        """keyboard LEDs last set by a host, bit 0 num lock, 1 caps lock"""
+        return self.leds
+
+    @dbus.service.signal('org.thanhle.btkbservice', signature='sy')
+    def LedsChanged(self, host, leds):
+        pass
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='a{sas}')
+    def get_adapters(self):
+        """adapters in use and the hosts connected through each"""
+        return {device.adapter_name: [host.address for host in device.connected]
+                for device in self.devices}
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='a{sd}')
+    def get_reconnect_stats(self):
+        """time to reconnect in seconds, connect attempts and directions"""
+        return reconnect.stats([device.reconnector for device in self.devices])
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='as')
+    def get_cached_hosts(self):
+        """host addresses reconnected to, most recently connected first"""
+        hosts = []
+        for device in self.devices:
+            hosts.extend(host for host in device.host_cache.hosts()
+                         if host not in hosts)
+        return hosts
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='a{su}')
+    def get_queue_stats(self):
+        """queue depth, drop and overflow counters of the first routed host"""
+        return self.queue_for().stats()
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='as')
+    def get_hosts(self):
+        """addresses of the connected hosts, oldest first"""
+        return [host.address for host in self.connected_hosts()]
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='a{sa{sd}}')
+    def get_host_stats(self):
+        """throughput, queue and latency counters of every connected host"""
+        return {host.address: host.stats() for host in self.connected_hosts()}
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='s')
+    def set_route(self, route):
+        """sends reports to all hosts, "adapter:<hciN>", "host:<address>" or
+        "group:<name>" """
+        try:
+            self.check_route(route)
+        except ValueError as err:
+            raise InvalidRoute(str(err))
+        for device in self.devices:
+            device.set_route(route)
+        self.resume_reports()
+
+    def check_route(self, route):
+        """raises ValueError for a malformed route, an unknown group or an
+        adapter that is not in use"""
+        for device in self.devices:
+            device.route_hosts(route)
+        kind, _, name = route.partition(":")
+        if kind == "adapter" and \
+                name not in [device.adapter_name for device in self.devices]:
+            raise ValueError("unknown adapter %r, in use: %s" % (
+                name, ", ".join(device.adapter_name for device in self.devices)))
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='s')
+    def get_route(self):
+        return self.device.route
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='sas')
+    def set_host_group(self, name, addresses):
+        """defines the hosts of group name, no addresses remove the group"""
+        for device in self.devices:
+            device.set_group(str(name),
+                             [str(address) for address in addresses])
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='a{sas}')
+    def get_host_groups(self):
+        return self.device.groups
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='ay',
+                         byte_arrays=True)
+    def send_report(self, report):
+        """sends one pre-encoded report at once, on the current route
+
+        Unlike send_reports it does not wait behind queued batches and
+        type_string jobs, for live input."""
+        try:
+            ReportEncoder.check(report)
+        except ValueError as err:
+            raise InvalidReport(str(err))
+        self.send_frame(report)
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='say',
+                         byte_arrays=True)
+    def send_report_to(self, route, report):
+        """sends one pre-encoded report to route, whatever the current route"""
+        try:
+            ReportEncoder.check(report)
+        except ValueError as err:
+            raise InvalidReport(str(err))
+        try:
+            self.check_route(route)
+            self.send(self.encoder.raw(report), route=route)
+        except ValueError as err:
+            raise InvalidRoute(str(err))
+
+    def send_frame(self, frame, stamps=None, route=None):
+        """sends a checked pre-encoded report from the local ingress socket
+
+        route is the ingress client's own route, None for the current one."""
+        event_ns = 0
+        if stamps is not None and self.latency is not None:
+            self.latency.received(frame[0], stamps, time.time_ns())
+            event_ns = stamps[0]
+        try:
+            self.send(self.encoder.raw(frame), event_ns, route)
+        except ValueError as err:
+            # the group of the client's route was removed
+            warning("Dropping ingress report: %s", err)
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='ayat',
+                         byte_arrays=True)
+    def send_report_timed(self, report, stamps):
+        """sends a pre-encoded report with its latency timestamps
+
+        stamps are the CLOCK_REALTIME ns at which the kernel stamped the
+        input event, the client read it and the client sent the report."""
+        try:
+            ReportEncoder.check(report)
+        except ValueError as err:
+            raise InvalidReport(str(err))
+        if len(stamps) != 3:
+            raise InvalidReport("expected 3 timestamps, got %d" % len(stamps))
+        self.send_frame(report, tuple(int(t) for t in stamps))
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='a{sa{sd}}')
+    def get_latency_stats(self):
+        """p50/p99/max latency in seconds, keyed "<report type>.<stage>" """
+        if self.latency is None:
+            return {}
+        return self.latency.summary()
+
+    def write_latency_textfile(self):
+        try:
+            self.latency.write_textfile(self.latency_textfile)
+        except OSError as err:
+            error("Could not write %s: %s", self.latency_textfile, err)
+        return True
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='aayau',
+                         byte_arrays=True)
+    def send_reports(self, reports, delays):
+        """queues pre-encoded reports (report ID first) for sending in order
+
+        delays[i] is the time in ms to wait after sending reports[i]. It may
+        be shorter than reports or empty, missing delays count as 0. Batches
+        from later calls are sent after the ones already queued."""
+        for report in reports:
+            try:
+                ReportEncoder.check(report)
+            except ValueError as err:
+                raise InvalidReport(str(err))
+        for i, report in enumerate(reports):
+            delay = int(delays[i]) if i < len(delays) else 0
+            self.pending_reports.append((report, delay, None, 0))
+        if self.drain_source is None:
+            self.drain_reports()
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='sa{sv}',
+                         out_signature='u')
+    def type_string(self, text, options):
+        """types text on the host and returns a job id at once
+
+        The reports are paced on the server, key_down_ms and key_delay_ms
+        in options override the default timing. With the pace option the
+        reports go out as fast as the link drains them instead, capped by
+        the server ceiling and the optional max_rate option (reports per
+        second, 0 for none). Progress is reported by TypingProgress and
+        TypingFinished; characters without a key are left out of the job."""
+        # checked before anything is queued, a bad value found later would
+        # leave the job half sent
+        down_ms = uint_option(options, "key_down_ms", BTKbService.KEY_DOWN_MS)
+        delay_ms = uint_option(options, "key_delay_ms", BTKbService.KEY_DELAY_MS)
+        paced = bool(options.get("pace", self.pace_typing))
+        max_rate = uint_option(options, "max_rate", 0)
+        layout, fallback = self.get_host_layout()
+        layout = str(options.get("layout", layout))
+        fallback = str(options.get("fallback", fallback))
+        self.check_layout(layout, fallback)
+        steps, skipped = string_reports.compile_string(text, layout, fallback)
+        if skipped:
+            warning("type_string: no key for %r", "".join(skipped))
+        job = TypingJob(self.next_job_id, len(text) - len(skipped), len(steps),
+                        max_rate)
+        self.next_job_id += 1
+        if not steps:
+            self.TypingFinished(job.job_id, 0)
+            return job.job_id
+        for report, down, typed in steps:
+            if paced:
+                # None: released by the pacer
+                delay = None
+            else:
+                delay = down_ms if down else delay_ms
+            self.pending_reports.append((report, delay, job, typed))
+        if self.drain_source is None:
+            self.drain_reports()
+        return job.job_id
+
+    def job_typed(self, job, typed):
+        """counts a sent report of a typing job and signals its progress"""
+        if job.started is None:
+            job.started = time.monotonic()
+        job.sent += 1
+        if typed:
+            job.typed += typed
+            if job.typed % BTKbService.PROGRESS_INTERVAL == 0:
+                self.TypingProgress(job.job_id, job.typed, job.total)
+        job.reports -= 1
+        if job.reports == 0:
+            if job.typed % BTKbService.PROGRESS_INTERVAL:
+                self.TypingProgress(job.job_id, job.typed, job.total)
+            self.typing_stats = job.stats()
+            info("Typing job %d: %d characters at %.1f characters/s",
+                 job.job_id, job.typed, self.typing_stats["chars_per_sec"])
+            self.TypingFinished(job.job_id, job.typed)
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='a{sd}')
+    def get_typing_stats(self):
+        """rate achieved by the last finished type_string job and pacer stalls"""
+        stats = dict(self.typing_stats)
+        stats["pacer_stalls"] = float(self.pacer.stalls)
+        stats["pacer_report_bytes"] = float(self.pacer.report_cost)
+        return stats
+
+    def load_host_layouts(self):
+        host_layouts = {"default": [layouts.DEFAULT_LAYOUT, string_reports.SKIP]}
+        if self.host_layouts_path is None:
+            return host_layouts
+        try:
+            with open(self.host_layouts_path) as fh:
+                host_layouts.update((host_key(host), value)
+                                    for host, value in json.load(fh).items())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as err:
+            error("Could not read %s: %s", self.host_layouts_path, err)
+        return host_layouts
+
+    def check_layout(self, layout, fallback):
+        if layout not in layouts.LAYOUTS:
+            raise InvalidLayout("unknown layout %r, known: %s" % (
+                layout, ", ".join(sorted(layouts.LAYOUTS))))
+        if fallback not in string_reports.FALLBACKS:
+            raise InvalidLayout("unknown fallback %r, known: %s" % (
+                fallback, ", ".join(string_reports.FALLBACKS)))
+
+    @dbus.service.method('org.thanhle.btkbservice', out_signature='ss')
+    def get_host_layout(self):
+        """keyboard layout and unmapped character fallback of the routed host
+
+        That is the host typed text goes to, the first one the route
+        selects."""
+        layout, fallback = self.host_layouts.get(
+            host_key(self.routed_host()), self.host_layouts["default"])
+        return layout, fallback
+
+    @dbus.service.method('org.thanhle.btkbservice', in_signature='sss')
+    def set_host_layout(self, host, layout, fallback):
+        """sets the layout and fallback used for a host, "default" for others"""
+        self.check_layout(layout, fallback)
+        self.host_layouts[host_key(host)] = [layout, fallback]
+        if self.host_layouts_path is None:
+            return
+        try:
+            with open(self.host_layouts_path, "w") as fh:
+                json.dump(self.host_layouts, fh, indent=2)
+        except OSError as err:
+            error("Could not write %s: %s", self.host_layouts_path, err)
+
+    @dbus.service.signal('org.thanhle.btkbservice', signature='uuu')
+    def TypingProgress(self, job_id, typed, total):
+        pass
+
+    @dbus.service.signal('org.thanhle.btkbservice', signature='uu')
+    def TypingFinished(self, job_id, typed):
+        pass
+
+    def drain_reports(self):
+        """sends queued reports until one asks for a delay, then reschedules
+
+        A paced report that would only be held for a host that is not
+        connected stops the queue until resume_reports."""
+        while self.pending_reports:
+            report, delay, job, typed = self.pending_reports[0]
+            if delay is None:
+                queue = self.queue_for()
+                if queue.sock is None and \
+                        self.device.disconnected_policy == BTKbDevice.BUFFER:
+                    # held reports only drain once a host connects, so
+                    # the job waits for resume_reports instead of polling
+                    break
+                # without a host and held reports the report is dropped,
+                # there is nothing to pace against
+                wait = self.pacer.delay(queue, job.max_rate) \
+                    if queue.sock is not None else 0
+                if wait:
+                    self.drain_source = GLib.timeout_add(wait, self.drain_reports)
+                    return False
+            self.pending_reports.popleft()
+            self.send(self.encoder.raw(report))
+            if delay is None:
+                self.pacer.sent(self.queue_for())
+            if job is not None:
+                self.job_typed(job, typed)
+            if delay:
+                self.drain_source = GLib.timeout_add(delay, self.drain_reports)
+                return False
+        self.drain_source = None
+        return False
+
+    def resume_reports(self):
+        """restarts a paced job that waited for a routed host"""
+        if self.pending_reports and self.drain_source is None:
+            self.drain_reports()
+
+
+def uint_option(options, name, default):
+    """type_string option name as an int GLib.timeout_add takes
+
+    Raises InvalidOption for a value that is not an integer or out of
+    0..2**32 - 1."""
+    value = options.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise InvalidOption("%s must be an integer, got %r" % (name, value))
+    if not 0 <= value <= 0xFFFFFFFF:
+        raise InvalidOption("%s must be in 0..%d, got %d"
+                            % (name, 0xFFFFFFFF, value))
+    return int(value)
+
+
+def host_key(host):
+    """host_layouts key of a host address, as BlueZ spells it"""
+    return host if host == "default" else host.upper()
+
+
+def adapter_spec(spec):
+    """--adapter value "hciN[:name[:class]]" -> (adapter, name, class)"""
+    parts = spec.split(":")
+    if len(parts) > 3 or not re.fullmatch(r"hci\d+", parts[0]):
+        raise argparse.ArgumentTypeError(
+            "expected hciN[:name[:class]], got %r" % spec)
+    name = parts[1] if len(parts) > 1 and parts[1] else None
+    try:
+        device_class = int(parts[2], 0) if len(parts) > 2 else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("bad class of device %r" % parts[2])
+    return parts[0], name, device_class
+
+
+def positive_int(value):
+    """argparse type of an int above 0"""
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number, got %r" % value)
+    if n <= 0:
+        raise argparse.ArgumentTypeError("must be above 0, got %d" % n)
+    return n
+
+
+def adapter_options(specs, host_cache_path, all_adapters=False):
+    """device options of every adapter to run a device on
+
+    Without specs the default adapter is used, or with all_adapters every
+    adapter BlueZ knows."""
+    if not specs and all_adapters:
+        try:
+            specs = [(name, None, None)
+                     for name in adapter.list_adapters(dbus.SystemBus())]
+        except dbus.DBusException as err:
+            warning("Could not list the adapters: %s", err)
+    specs = specs or [(BTKbDevice.ADAPTER, None, None)]
+    options = []
+    for i, (name, alias, device_class) in enumerate(specs):
+        if alias is None:
+            # hosts see one device per adapter, the names tell them apart
+            alias = BTKbDevice.MY_DEV_NAME if i == 0 else \
+                "%s_%s" % (BTKbDevice.MY_DEV_NAME, name)
+        options.append({
+            "adapter_name": name,
+            "name": alias,
+            "class_of_device": device_class or BTKbDevice.DEVICE_CLASS,
+            "host_cache_path": reconnect.cache_path(host_cache_path, name),
+        })
+    return options
 
 
 # main routine
 if __name__ == "__main__":
+    startup_phase("imports")
+    parser = argparse.ArgumentParser(
+        description="Bluetooth keyboard/mouse emulator service")
+    parser.add_argument(
+        "--ingress", default=report_ingress.DEFAULT_ADDRESS, metavar="ADDRESS",
+        help="unix socket for the report fast path, @name for the abstract "
+             "namespace (default: %(default)s)")
+    parser.add_argument(
+        "--no-ingress", dest="ingress", action="store_const", const=None,
+        help="disable the report fast path socket")
+    parser.add_argument(
+        "--queue-size", type=int, default=BTKbDevice.QUEUE_CAPACITY,
+        metavar="N", help="pending reports per report type on the interrupt "
+                          "channel (default: %(default)s)")
+    parser.add_argument(
+        "--keyboard-policy", choices=send_queue.POLICIES,
+        default=send_queue.KEEP_ALL,
+        help="keyboard queue overflow policy (default: %(default)s)")
+    parser.add_argument(
+        "--mouse-policy", choices=send_queue.POLICIES,
+        default=send_queue.LATEST_WINS,
+        help="mouse queue overflow policy (default: %(default)s)")
+    parser.add_argument(
+        "--no-coalesce", dest="coalesce", action="store_false",
+        help="send every queued mouse report instead of merging them")
+    parser.add_argument(
+        "--nkro", action="store_true",
+        help="advertise the n-key rollover keyboard report (send_keys_nkro)")
+    parser.add_argument(
+        "--latency", action="store_true",
+        help="record per stage latency histograms (get_latency_stats)")
+    parser.add_argument(
+        "--latency-textfile", metavar="PATH",
+        help="also write the latency histograms to PATH in the Prometheus "
+             "text format, implies --latency")
+    parser.add_argument(
+        "--disconnected-policy", choices=BTKbDevice.DISCONNECTED_POLICIES,
+        default=BTKbDevice.DROP,
+        help="keep reports queued or drop them while no host is connected "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--host-layouts", metavar="PATH",
+        help="JSON file with the keyboard layout of each host, kept up to "
+             "date by set_host_layout")
+    parser.add_argument(
+        "--pace-typing", action="store_true",
+        help="send type_string reports as fast as the link drains them "
+             "instead of with fixed key delays")
+    parser.add_argument(
+        "--typing-max-rate", type=positive_int, default=BTKbService.TYPING_MAX_RATE,
+        metavar="N", help="ceiling of paced typing in reports per second "
+                          "(default: %(default)s)")
+    parser.add_argument(
+        "--record", metavar="PATH",
+        help="record every report sent to the host to a reports log "
+             "(replay with record/replay.py)")
+    parser.add_argument(
+        "--host-cache", default=reconnect.DEFAULT_CACHE_PATH, metavar="PATH",
+        help="JSON file of the hosts that connected, reconnected to at "
+             "startup and after a disconnect; adapters other than hci0 add "
+             "-hciN to the name (default: %(default)s)")
+    parser.add_argument(
+        "--max-hosts", type=int, default=BTKbDevice.MAX_HOSTS, metavar="N",
+        help="hosts connected at the same time, reports go to all of them "
+             "unless routed with set_route (default: %(default)s)")
+    parser.add_argument(
+        "--adapter", dest="adapters", action="append", type=adapter_spec,
+        default=[], metavar="hciN[:NAME[:CLASS]]",
+        help="run a device on this adapter, may be repeated; by default on "
+             "%s. Name and class of device are optional" % BTKbDevice.ADAPTER)
+    parser.add_argument(
+        "--all-adapters", action="store_true",
+        help="run a device on every adapter BlueZ knows, unless --adapter "
+             "is given")
+    parser.add_argument(
+        "--host", dest="hosts", action="append", default=[],
+        metavar="ADDRESS", help="also reconnect to this host, may be repeated")
+    args = parser.parse_args()
     # we an only run as root
     try:
         if not os.geteuid() == 0:
             sys.exit("Only root can run this script")
 
-        if TARGET_ADDRESS == "":
-            sys.exit("Please fill your host mac address in line 26")
-
         DBusGMainLoop(set_as_default=True)
-        myservice = BTKbService()
+        myservice = BTKbService(ingress_address=args.ingress,
+                                latency=args.latency,
+                                latency_textfile=args.latency_textfile,
+                                host_layouts_path=args.host_layouts,
+                                pace_typing=args.pace_typing,
+                                typing_max_rate=args.typing_max_rate,
+                                record_path=args.record,
+                                adapters=adapter_options(args.adapters,
+                                                         args.host_cache,
+                                                         args.all_adapters),
+                                device_options={
+            "queue_capacity": args.queue_size,
+            "keyboard_policy": args.keyboard_policy,
+            "mouse_policy": args.mouse_policy,
+            "disconnected_policy": args.disconnected_policy,
+            "coalesce_mouse": args.coalesce,
+            "sdp_record_path": BTKbDevice.SDP_RECORD_NKRO_PATH if args.nkro
+                               else BTKbDevice.SDP_RECORD_PATH,
+            "hosts": args.hosts,
+            "max_hosts": args.max_hosts,
+        })
         loop = GLib.MainLoop()
         loop.run()
     except KeyboardInterrupt:
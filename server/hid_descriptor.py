@@ -0,0 +1,197 @@
+#
+# Minimal HID report descriptor parser and input report decoder
+#
+# Reads the descriptor out of an SDP record (attribute 0x0206) and works
+# out the input fields of every report ID, so a test host can decode the
+# reports btk_server sends the way a real host would. Only the short items
+# that the descriptors in this project use are handled.
+#
+
+import xml.etree.ElementTree as ElementTree
+
+# main items
+INPUT = 0x80
+OUTPUT = 0x90
+FEATURE = 0xB0
+COLLECTION = 0xA0
+END_COLLECTION = 0xC0
+# global items
+USAGE_PAGE = 0x04
+LOGICAL_MINIMUM = 0x14
+LOGICAL_MAXIMUM = 0x24
+REPORT_SIZE = 0x74
+REPORT_ID = 0x84
+REPORT_COUNT = 0x94
+# local items
+USAGE = 0x08
+USAGE_MINIMUM = 0x18
+USAGE_MAXIMUM = 0x28
+
+# Input item flags
+CONSTANT = 0x01
+VARIABLE = 0x02
+
+KEYBOARD_PAGE = 0x07
+# left control .. right GUI, also covered by an n-key rollover bitmap
+MODIFIER_USAGES = range(0xE0, 0xE8)
+
+
+class Field():
+    """a run of report_count equally sized items in an input report"""
+
+    def __init__(self, bit_offset, size, count, flags, usage_page, usages,
+                 logical_min, logical_max):
+        self.bit_offset = bit_offset
+        self.size = size
+        self.count = count
+        self.flags = flags
+        self.usage_page = usage_page
+        self.usages = usages
+        self.logical_min = logical_min
+        self.logical_max = logical_max
+
+    def is_constant(self):
+        return bool(self.flags & CONSTANT)
+
+    def is_variable(self):
+        return bool(self.flags & VARIABLE)
+
+    def values(self, data):
+        """the raw item values of this field in data (report ID excluded)"""
+        values = []
+        for i in range(self.count):
+            offset = self.bit_offset + i * self.size
+            if offset & 7 == 0 and self.size & 7 == 0:
+                values.append(int.from_bytes(
+                    data[offset >> 3:(offset + self.size) >> 3], "little",
+                    signed=self.logical_min < 0))
+                continue
+            value = 0
+            for bit in range(self.size):
+                byte = (offset + bit) >> 3
+                if data[byte] & (1 << ((offset + bit) & 7)):
+                    value |= 1 << bit
+            if self.logical_min < 0 and value & (1 << (self.size - 1)):
+                value -= 1 << self.size
+            values.append(value)
+        return values
+
+
+def _signed(data, size):
+    value = int.from_bytes(data, "little")
+    if size and value & (1 << (size * 8 - 1)):
+        value -= 1 << (size * 8)
+    return value
+
+
+def parse(descriptor):
+    """returns {report id: [Field]} for the input reports of a descriptor"""
+    reports = {}
+    bits = {}
+    usage_page = 0
+    logical_min = logical_max = 0
+    report_size = report_count = 0
+    report_id = 0
+    usages = []
+    usage_min = None
+    i = 0
+    while i < len(descriptor):
+        prefix = descriptor[i]
+        size = (0, 1, 2, 4)[prefix & 0x03]
+        tag = prefix & 0xFC
+        data = descriptor[i + 1:i + 1 + size]
+        value = int.from_bytes(data, "little")
+        i += 1 + size
+        if tag == USAGE_PAGE:
+            usage_page = value
+        elif tag == LOGICAL_MINIMUM:
+            logical_min = _signed(data, size)
+        elif tag == LOGICAL_MAXIMUM:
+            logical_max = value if logical_min >= 0 else _signed(data, size)
+        elif tag == REPORT_SIZE:
+            report_size = value
+        elif tag == REPORT_COUNT:
+            report_count = value
+        elif tag == REPORT_ID:
+            report_id = value
+            reports.setdefault(report_id, [])
+            bits.setdefault(report_id, 0)
+        elif tag == USAGE:
+            usages.append(value)
+        elif tag == USAGE_MINIMUM:
+            usage_min = value
+        elif tag == USAGE_MAXIMUM:
+            usages.extend(range(usage_min, value + 1))
+        elif tag in (INPUT, OUTPUT, FEATURE):
+            if tag == INPUT:
+                reports.setdefault(report_id, []).append(Field(
+                    bits.get(report_id, 0), report_size, report_count, value,
+                    usage_page, usages, logical_min, logical_max))
+                bits[report_id] = bits.get(report_id, 0) + report_size * report_count
+            usages = []
+        elif tag in (COLLECTION, END_COLLECTION):
+            usages = []
+    return reports
+
+
+def report_sizes(fields):
+    """{report id: input report length in bytes, report ID byte included}"""
+    sizes = {}
+    for report_id, report_fields in fields.items():
+        total = sum(f.size * f.count for f in report_fields)
+        if total:
+            sizes[report_id] = 1 + (total + 7) // 8
+    return sizes
+
+
+def from_sdp_record(path):
+    """reads the HID descriptor (attribute 0x0206) out of an SDP record file"""
+    root = ElementTree.parse(path).getroot()
+    for attribute in root.iter("attribute"):
+        if attribute.get("id") == "0x0206":
+            text = attribute.find(".//text")
+            return bytes.fromhex(text.get("value"))
+    raise ValueError("no HID descriptor in %s" % path)
+
+
+class Decoder():
+
+    def __init__(self, descriptor):
+        self.fields = parse(descriptor)
+        self.sizes = report_sizes(self.fields)
+
+    def decode(self, report):
+        """decodes a report (report ID first, no HIDP header)
+
+        Returns (report id, {usage page: {usage: value}}): variable items by
+        their usage, array items as the set of usages they hold. Raises
+        ValueError for an unknown report ID or a wrong length."""
+        report_id = report[0]
+        if report_id not in self.sizes:
+            raise ValueError("unknown report id %d" % report_id)
+        if len(report) != self.sizes[report_id]:
+            raise ValueError("report id %d is %d bytes, expected %d" % (
+                report_id, len(report), self.sizes[report_id]))
+        data = report[1:]
+        pages = {}
+        for field in self.fields[report_id]:
+            if field.is_constant():
+                continue
+            values = field.values(data)
+            page = pages.setdefault(field.usage_page, {})
+            if field.is_variable():
+                # a key bitmap spanning the modifiers leaves them to the
+                # modifier byte, which the host reads them from
+                bitmap = field.usage_page == KEYBOARD_PAGE and \
+                    len(field.usages) > len(MODIFIER_USAGES)
+                for usage, value in zip(field.usages, values):
+                    if bitmap and usage in MODIFIER_USAGES:
+                        continue
+                    page[usage] = value
+            else:
+                # array: each item holds a usage, 0 for none
+                base = field.usages[0] if field.usages else 0
+                for value in values:
+                    if value:
+                        page[base + value - field.logical_min] = 1
+        return report_id, pages
@@ -0,0 +1,210 @@
+#
+# HID input report encoding for the Bluetooth keyboard/mouse emulator
+#
+# Every report goes out on the interrupt channel as a HIDP DATA|INPUT
+# header followed by the report ID and the report body. The encoder keeps
+# one preallocated buffer per report ID and packs the fields in place, so
+# the send path does not build a list or a bytes object per report.
+#
+
+import struct
+
+# HIDP transaction header: DATA (0xA0) | INPUT report (0x01)
+HIDP_DATA_INPUT = 0xA1
+
+# HIDP transaction types (high nibble of the header)
+HIDP_HANDSHAKE = 0x00
+HIDP_CONTROL = 0x10
+HIDP_GET_REPORT = 0x40
+HIDP_SET_REPORT = 0x50
+HIDP_GET_PROTOCOL = 0x60
+HIDP_SET_PROTOCOL = 0x70
+HIDP_GET_IDLE = 0x80
+HIDP_SET_IDLE = 0x90
+HIDP_DATA = 0xA0
+# report types (low bits of the GET/SET_REPORT and DATA parameter)
+HIDP_OTHER = 0
+HIDP_INPUT = 1
+HIDP_OUTPUT = 2
+HIDP_FEATURE = 3
+# GET_REPORT parameter bit: a 2 byte maximum size follows the report ID
+HIDP_SIZE_FOLLOWS = 0x08
+# HANDSHAKE results
+HANDSHAKE_SUCCESSFUL = 0
+HANDSHAKE_INVALID_REPORT_ID = 2
+HANDSHAKE_UNSUPPORTED_REQUEST = 3
+HANDSHAKE_INVALID_PARAMETER = 4
+# HID_CONTROL operations
+CONTROL_VIRTUAL_CABLE_UNPLUG = 5
+# SET_PROTOCOL parameter
+PROTOCOL_BOOT = 0
+PROTOCOL_REPORT = 1
+
+# keyboard output report bits, in the order of the evdev LED codes
+LED_NUM_LOCK = 0x01
+LED_CAPS_LOCK = 0x02
+LED_SCROLL_LOCK = 0x04
+LED_COMPOSE = 0x08
+LED_KANA = 0x10
+
+REPORT_ID_KEYBOARD = 1
+REPORT_ID_MOUSE = 2
+# n-key rollover keyboard: modifier byte and a bitmap of usages 0..255
+REPORT_ID_NKRO = 3
+NKRO_BITMAP_SIZE = 32
+# absolute pointer: buttons, then x and y as 16 bit screen positions
+REPORT_ID_ABSOLUTE = 4
+ABSOLUTE_MAX = 0x7FFF
+# wide mouse: buttons, then x, y and wheel as signed 16 bit fields
+REPORT_ID_MOUSE16 = 5
+MOUSE16_MAX = 0x7FFF
+# wheel units per detent once the host enabled the resolution multiplier
+# feature (feature report ID 5, bit 0), otherwise the wheel is in detents
+WHEEL_MULTIPLIER = 8
+
+# report length (report ID included, HIDP header excluded) per report ID
+REPORT_SIZES = {
+    REPORT_ID_KEYBOARD: 9,
+    REPORT_ID_MOUSE: 5,
+    REPORT_ID_NKRO: 2 + NKRO_BITMAP_SIZE,
+    REPORT_ID_ABSOLUTE: 6,
+    REPORT_ID_MOUSE16: 8,
+}
+
+# reports with relative fields after the button byte, zero at rest
+RELATIVE_REPORTS = (REPORT_ID_MOUSE, REPORT_ID_MOUSE16)
+
+# report type names used in statistics and configuration
+REPORT_NAMES = {
+    REPORT_ID_KEYBOARD: "keyboard",
+    REPORT_ID_MOUSE: "mouse",
+    REPORT_ID_NKRO: "nkro",
+    REPORT_ID_ABSOLUTE: "absolute",
+    REPORT_ID_MOUSE16: "mouse16",
+}
+
+
+class ReportEncoder():
+    # header, report id, modifier byte, reserved byte, 6 key slots
+    KEYBOARD = struct.Struct("BBBx6s")
+    # header, report id, buttons, x, y, wheel
+    MOUSE = struct.Struct("BB4s")
+    # header, report id, modifier byte, usage bitmap
+    NKRO = struct.Struct("BBB%ds" % NKRO_BITMAP_SIZE)
+    # header, report id, buttons, x, y
+    ABSOLUTE = struct.Struct("<BBBHH")
+    # header, report id, buttons, x, y, wheel
+    MOUSE16 = struct.Struct("<BBBhhh")
+
+    def __init__(self):
+        self.keyboard_buf = bytearray(ReportEncoder.KEYBOARD.size)
+        self.keyboard_view = memoryview(self.keyboard_buf)
+        self.mouse_buf = bytearray(ReportEncoder.MOUSE.size)
+        self.mouse_view = memoryview(self.mouse_buf)
+        self.nkro_buf = bytearray(ReportEncoder.NKRO.size)
+        self.nkro_view = memoryview(self.nkro_buf)
+        self.absolute_buf = bytearray(ReportEncoder.ABSOLUTE.size)
+        self.absolute_view = memoryview(self.absolute_buf)
+        self.mouse16_buf = bytearray(ReportEncoder.MOUSE16.size)
+        self.mouse16_view = memoryview(self.mouse16_buf)
+        # buffers for pre-encoded reports, keyed by report ID
+        self.raw_bufs = {}
+        for report_id, size in REPORT_SIZES.items():
+            buf = bytearray(size + 1)
+            buf[0] = HIDP_DATA_INPUT
+            self.raw_bufs[report_id] = (buf, memoryview(buf))
+
+    @staticmethod
+    def check(report):
+        """raises ValueError unless report is a known, correctly sized report"""
+        if len(report) == 0 or report[0] not in REPORT_SIZES:
+            raise ValueError("unknown report id in %r" % bytes(report))
+        if len(report) != REPORT_SIZES[report[0]]:
+            raise ValueError("report id %d must be %d bytes, got %d" % (
+                report[0], REPORT_SIZES[report[0]], len(report)))
+
+    def keyboard(self, modifiers, keys):
+        """packs a keyboard report and returns a view of it
+
+        keys is a bytes-like object of up to 6 HID usages, missing slots
+        are zero filled. The view aliases the encoder buffer and is only
+        valid until the next keyboard() call."""
+        ReportEncoder.KEYBOARD.pack_into(
+            self.keyboard_buf, 0, HIDP_DATA_INPUT, REPORT_ID_KEYBOARD,
+            modifiers, keys)
+        return self.keyboard_view
+
+    def mouse(self, state):
+        """packs a mouse report from the 4 byte [buttons, x, y, wheel] state"""
+        ReportEncoder.MOUSE.pack_into(
+            self.mouse_buf, 0, HIDP_DATA_INPUT, REPORT_ID_MOUSE, state)
+        return self.mouse_view
+
+    def nkro(self, modifiers, bitmap):
+        """packs an n-key rollover report, bit n of bitmap is usage n"""
+        ReportEncoder.NKRO.pack_into(
+            self.nkro_buf, 0, HIDP_DATA_INPUT, REPORT_ID_NKRO, modifiers, bitmap)
+        return self.nkro_view
+
+    def absolute(self, buttons, x, y):
+        """packs an absolute pointer report, x and y are 0..ABSOLUTE_MAX
+
+        Raises ValueError for a position out of that range."""
+        if not (0 <= x <= ABSOLUTE_MAX and 0 <= y <= ABSOLUTE_MAX):
+            raise ValueError("position %d,%d is outside 0..%d" % (
+                x, y, ABSOLUTE_MAX))
+        ReportEncoder.ABSOLUTE.pack_into(
+            self.absolute_buf, 0, HIDP_DATA_INPUT, REPORT_ID_ABSOLUTE,
+            buttons, x, y)
+        return self.absolute_view
+
+    def mouse16(self, buttons, x, y, wheel):
+        """packs a wide mouse report, motion is clamped to +-MOUSE16_MAX
+
+        wheel is in 1/WHEEL_MULTIPLIER detents."""
+        ReportEncoder.MOUSE16.pack_into(
+            self.mouse16_buf, 0, HIDP_DATA_INPUT, REPORT_ID_MOUSE16, buttons,
+            clamp16(x), clamp16(y), clamp16(wheel))
+        return self.mouse16_view
+
+    def raw(self, report):
+        """prefixes a pre-encoded report (report ID first) with the HIDP header
+
+        The report must already have passed check()."""
+        buf, view = self.raw_bufs[report[0]]
+        buf[1:] = report
+        return view
+
+
+def clamp16(value):
+    return min(MOUSE16_MAX, max(-MOUSE16_MAX, value))
+
+
+# boot keyboard slots reporting more keys than fit (ErrorRollOver)
+ROLLOVER = bytes([1] * 6)
+
+
+def boot_report(message):
+    """boot protocol form of a HIDP input message, None if there is none
+
+    Over Bluetooth the boot reports keep report ID 1 (keyboard) and 2
+    (mouse): the keyboard report is unchanged, the mouse sends buttons, x
+    and y only (wide mouse reports clamped to a byte), and n-key rollover
+    reports become 6 key reports."""
+    report_id = message[1]
+    if report_id == REPORT_ID_KEYBOARD:
+        return message
+    if report_id == REPORT_ID_MOUSE:
+        return bytes(message[:5])
+    if report_id == REPORT_ID_MOUSE16:
+        _, _, buttons, x, y, _ = ReportEncoder.MOUSE16.unpack(message)
+        return bytes([HIDP_DATA_INPUT, REPORT_ID_MOUSE, buttons,
+                      min(127, max(-127, x)) & 0xFF,
+                      min(127, max(-127, y)) & 0xFF])
+    if report_id == REPORT_ID_NKRO:
+        usages = [byte * 8 + bit for byte, bits in enumerate(message[3:])
+                  if bits for bit in range(8) if bits & (1 << bit)]
+        keys = bytes(usages) if len(usages) <= 6 else ROLLOVER
+        return bytes([HIDP_DATA_INPUT, REPORT_ID_KEYBOARD, message[2], 0]) + \
+            keys.ljust(6, b"\0")
+    return None
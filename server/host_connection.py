@@ -0,0 +1,353 @@
+#
+# One connected host of btk_server
+#
+# Every host has its own control and interrupt channels and its own
+# non-blocking send queue: a host that stops draining its interrupt
+# channel only fills (and overflows) its own queue, the reports for the
+# other hosts are still written straight away. Reports and bytes are
+# counted per host, and with latency measurement on, the queue and send
+# stages get per-host histograms too.
+#
+# Requests on the control channel are answered: GET_REPORT from the last
+# report sent to the host, SET_REPORT with the keyboard LEDs, GET/SET
+# _PROTOCOL and GET/SET_IDLE. In boot protocol mode the reports are sent
+# in their shorter boot form (hid_report.boot_report). LED output reports
+# may also come on the interrupt channel.
+#
+# The wide mouse report carries the wheel in 1/WHEEL_MULTIPLIER detents.
+# Hosts that did not enable the resolution multiplier feature get whole
+# detents, with the remainder carried to the next report. In boot
+# protocol mode its motion is sent in the byte range of the boot mouse
+# report the same way, the rest carried to the next wide report.
+#
+
+import time
+from logging import debug, info, warning, error
+from gi.repository import GLib
+import hid_report
+from hid_report import (
+    REPORT_SIZES, REPORT_ID_KEYBOARD, REPORT_ID_MOUSE, REPORT_ID_MOUSE16,
+    RELATIVE_REPORTS, WHEEL_MULTIPLIER, HIDP_DATA_INPUT, HIDP_FEATURE,
+    HIDP_HANDSHAKE, HIDP_CONTROL, HIDP_GET_REPORT, HIDP_SET_REPORT,
+    HIDP_GET_PROTOCOL, HIDP_SET_PROTOCOL, HIDP_GET_IDLE, HIDP_SET_IDLE,
+    HIDP_DATA, HIDP_OTHER, HIDP_INPUT, HIDP_OUTPUT, HIDP_SIZE_FOLLOWS,
+    HANDSHAKE_SUCCESSFUL, HANDSHAKE_INVALID_REPORT_ID,
+    HANDSHAKE_UNSUPPORTED_REQUEST, HANDSHAKE_INVALID_PARAMETER,
+    CONTROL_VIRTUAL_CABLE_UNPLUG, PROTOCOL_BOOT, PROTOCOL_REPORT)
+
+# the default L2CAP MTU, larger than any message a host sends us
+MAX_MESSAGE = 672
+
+
+class HostConnection():
+
+    def __init__(self, address, on_closed, on_leds=None):
+        """on_closed(host) is called when a channel closed or a send failed
+
+        on_leds(host) when the host set other keyboard LEDs."""
+        self.address = address
+        self.on_closed = on_closed
+        self.on_leds = on_leds
+        self.ccontrol = None
+        self.cinterrupt = None
+        # send_queue.SendQueue of the interrupt channel, set once connected
+        self.queue = None
+        self.watches = []
+        self.connected_at = None
+        self.reports = 0
+        self.bytes = 0
+        # latency.LatencyStats of this host when latency is being measured
+        self.latency = None
+        self.protocol = PROTOCOL_REPORT
+        self.idle = 0
+        self.leds = 0
+        # the host set the wheel resolution multiplier, and the wheel
+        # units not sent yet while it did not
+        self.hires_wheel = False
+        self.wheel_rest = 0
+        # wide mouse x and y not sent yet in boot protocol mode
+        self.boot_rest = (0, 0)
+        # the host unplugged the virtual cable: it forgot the pairing
+        self.unplugged = False
+        # report ID -> last report sent (HIDP header first), for GET_REPORT;
+        # one buffer per report ID, overwritten by every send
+        self.last_reports = {}
+
+    @property
+    def connected(self):
+        return self.cinterrupt is not None
+
+    def watch_channel(self, sock):
+        self.watches.append(GLib.io_add_watch(
+            sock, GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self.channel_event))
+
+    def set_control(self, sock):
+        self.ccontrol = sock
+        self.ccontrol.setblocking(False)
+        self.watch_channel(sock)
+
+    def set_interrupt(self, sock, queue):
+        """starts sending on the interrupt channel through queue"""
+        self.cinterrupt = sock
+        self.queue = queue
+        self.queue.on_error = self.send_failed
+        self.watch_channel(sock)
+        self.queue.attach(sock)
+        self.set_protocol(self.protocol)
+        self.connected_at = time.monotonic()
+
+    def channel_event(self, sock, condition):
+        while condition & GLib.IO_IN:
+            try:
+                message = sock.recv(MAX_MESSAGE)
+            except BlockingIOError:
+                return True
+            except OSError as err:
+                warning("Reading from %s failed: %s", self.address, err)
+                break
+            if not message:
+                break
+            if sock is self.ccontrol:
+                self.control_message(message)
+            else:
+                self.interrupt_message(message)
+            if self.unplugged:
+                break
+        info("Host %s closed the connection", self.address)
+        self.on_closed(self)
+        return False
+
+    def control_message(self, message):
+        kind = message[0] & 0xF0
+        param = message[0] & 0x0F
+        debug("Control message from %s: %s", self.address, message.hex())
+        if kind == HIDP_GET_REPORT:
+            self.get_report(param, message[1:])
+        elif kind == HIDP_SET_REPORT:
+            self.set_report(param, message[1:])
+        elif kind == HIDP_GET_PROTOCOL:
+            self.reply(bytes([HIDP_DATA | HIDP_OTHER, self.protocol]))
+        elif kind == HIDP_SET_PROTOCOL:
+            self.set_protocol(param & 1)
+            self.handshake(HANDSHAKE_SUCCESSFUL)
+        elif kind == HIDP_GET_IDLE:
+            self.reply(bytes([HIDP_DATA | HIDP_OTHER, self.idle]))
+        elif kind == HIDP_SET_IDLE:
+            # reports are only sent on change, any idle rate is met
+            self.idle = message[1] if len(message) > 1 else 0
+            self.handshake(HANDSHAKE_SUCCESSFUL)
+        elif kind == HIDP_CONTROL:
+            if param == CONTROL_VIRTUAL_CABLE_UNPLUG:
+                info("Host %s unplugged the virtual cable", self.address)
+                self.unplugged = True
+            # SUSPEND and EXIT_SUSPEND need no answer
+        elif kind not in (HIDP_HANDSHAKE, HIDP_DATA):
+            self.handshake(HANDSHAKE_UNSUPPORTED_REQUEST)
+
+    def interrupt_message(self, message):
+        if message[0] == HIDP_DATA | HIDP_OUTPUT:
+            self.output_report(message[1:])
+
+    def get_report(self, param, data):
+        """answers GET_REPORT with the state the host was last sent"""
+        report_type = param & 3
+        boot = self.protocol == PROTOCOL_BOOT
+        if data:
+            report_id = data[0]
+            data = data[1:]
+        elif boot:
+            # the report ID may be left out in boot protocol mode
+            report_id = REPORT_ID_KEYBOARD
+        else:
+            self.handshake(HANDSHAKE_INVALID_PARAMETER)
+            return
+        if report_type == HIDP_INPUT and report_id in REPORT_SIZES:
+            message = self.last_reports.get(report_id)
+            if message is None:
+                message = bytes([HIDP_DATA_INPUT, report_id]) + \
+                    bytes(REPORT_SIZES[report_id] - 1)
+            elif report_id in RELATIVE_REPORTS:
+                # the buttons are state, motion is not
+                message = message[:3] + bytes(len(message) - 3)
+            else:
+                # a copy, the next send overwrites the buffer
+                message = bytes(message)
+            if boot:
+                message = hid_report.boot_report(message)
+                if message is None:
+                    self.handshake(HANDSHAKE_INVALID_REPORT_ID)
+                    return
+        elif report_type == HIDP_OUTPUT and report_id == REPORT_ID_KEYBOARD:
+            message = bytes([HIDP_DATA | HIDP_OUTPUT, report_id, self.leds])
+        elif report_type == HIDP_FEATURE and report_id == REPORT_ID_MOUSE16:
+            message = bytes([HIDP_DATA | HIDP_FEATURE, report_id,
+                             int(self.hires_wheel)])
+        else:
+            self.handshake(HANDSHAKE_INVALID_REPORT_ID)
+            return
+        if param & HIDP_SIZE_FOLLOWS and len(data) >= 2:
+            message = message[:1 + int.from_bytes(data[:2], "little")]
+        self.reply(message)
+
+    def set_report(self, param, data):
+        if param & 3 == HIDP_OUTPUT and self.output_report(data):
+            self.handshake(HANDSHAKE_SUCCESSFUL)
+        elif param & 3 == HIDP_FEATURE and len(data) == 2 and \
+                data[0] == REPORT_ID_MOUSE16:
+            # the resolution multiplier: 1 for WHEEL_MULTIPLIER, 0 for 1
+            self.hires_wheel = bool(data[1] & 1)
+            debug("Host %s set the wheel multiplier to %d", self.address,
+                  WHEEL_MULTIPLIER if self.hires_wheel else 1)
+            self.update_convert()
+            self.handshake(HANDSHAKE_SUCCESSFUL)
+        else:
+            self.handshake(HANDSHAKE_INVALID_REPORT_ID)
+
+    def output_report(self, data):
+        """takes a keyboard LED output report, False if data is none"""
+        if self.protocol == PROTOCOL_BOOT and len(data) == 1:
+            leds = data[0]
+        elif len(data) == 2 and data[0] == REPORT_ID_KEYBOARD:
+            leds = data[1]
+        else:
+            return False
+        if leds != self.leds:
+            self.leds = leds
+            debug("Host %s set the LEDs to 0x%02x", self.address, leds)
+            if self.on_leds is not None:
+                self.on_leds(self)
+        return True
+
+    def set_protocol(self, protocol):
+        if protocol != self.protocol:
+            info("Host %s switched to the %s protocol", self.address,
+                 "boot" if protocol == PROTOCOL_BOOT else "report")
+        self.protocol = protocol
+        if protocol != PROTOCOL_BOOT:
+            # the report protocol has the range for the motion it was given
+            self.boot_rest = (0, 0)
+        self.update_convert()
+
+    def update_convert(self):
+        """converts only the reports this host needs in another form, the
+        others are written from the encoder buffer as they are"""
+        if self.queue is None:
+            return
+        self.queue.converted = None
+        if self.protocol == PROTOCOL_BOOT:
+            self.queue.convert = self.boot_report
+            self.queue.converted = self.boot_sent
+            # the boot keyboard report is the report protocol one
+            self.queue.convert_ids = \
+                frozenset(REPORT_SIZES) - {REPORT_ID_KEYBOARD}
+        elif not self.hires_wheel:
+            self.queue.convert = self.detent_wheel
+            self.queue.convert_ids = frozenset((REPORT_ID_MOUSE16,))
+            self.queue.converted = self.wheel_sent
+        else:
+            self.queue.convert = None
+            self.queue.convert_ids = frozenset()
+
+    def detents(self, wheel):
+        """whole detents to send for wheel, and the units left over"""
+        total = self.wheel_rest + wheel
+        detents = int(total / WHEEL_MULTIPLIER)
+        return detents, total - detents * WHEEL_MULTIPLIER
+
+    def detent_wheel(self, message):
+        """message with the wheel of a wide mouse report in whole detents"""
+        header, report_id, buttons, x, y, wheel = \
+            hid_report.ReportEncoder.MOUSE16.unpack(message)
+        if not wheel:
+            return message
+        return hid_report.ReportEncoder.MOUSE16.pack(
+            header, report_id, buttons, x, y, self.detents(wheel)[0])
+
+    def wheel_sent(self, message):
+        """keeps the remainder of a wide mouse report the host took"""
+        wheel = hid_report.ReportEncoder.MOUSE16.unpack(message)[5]
+        if wheel:
+            self.wheel_rest = self.detents(wheel)[1]
+
+    def boot_motion(self, x, y):
+        """x and y of a wide mouse report plus the carried rest, clamped to
+        the boot mouse range, and what is left over"""
+        total = (self.boot_rest[0] + x, self.boot_rest[1] + y)
+        sent = tuple(min(127, max(-127, value)) for value in total)
+        return sent, (total[0] - sent[0], total[1] - sent[1])
+
+    def boot_report(self, message):
+        """boot form of message, a wide mouse report with the carried motion"""
+        if message[1] != REPORT_ID_MOUSE16:
+            return hid_report.boot_report(message)
+        _, _, buttons, x, y, _ = hid_report.ReportEncoder.MOUSE16.unpack(message)
+        (x, y), _ = self.boot_motion(x, y)
+        return bytes([HIDP_DATA_INPUT, REPORT_ID_MOUSE, buttons,
+                      x & 0xFF, y & 0xFF])
+
+    def boot_sent(self, message):
+        """keeps the motion of a wide mouse report the boot report left out"""
+        if message[1] == REPORT_ID_MOUSE16:
+            _, _, _, x, y, _ = hid_report.ReportEncoder.MOUSE16.unpack(message)
+            self.boot_rest = self.boot_motion(x, y)[1]
+
+    def handshake(self, result):
+        self.reply(bytes([HIDP_HANDSHAKE | result]))
+
+    def reply(self, message):
+        try:
+            self.ccontrol.send(message)
+        except OSError as err:
+            # the host retries or gives up, the channel watch sees a close
+            warning("Could not answer %s: %s", self.address, err)
+
+    def send_failed(self, err):
+        error("Sending to %s failed: %s", self.address, err)
+        self.on_closed(self)
+
+    def send(self, message, event_ns=0):
+        """sends or queues message, raises OSError if the channel failed"""
+        last = self.last_reports.get(message[1])
+        if last is None:
+            self.last_reports[message[1]] = bytearray(message)
+        else:
+            last[:] = message
+        self.queue.send(message, event_ns)
+        self.reports += 1
+        self.bytes += len(message)
+
+    def close(self):
+        """closes both channels, queued reports stay in the queue"""
+        for watch in self.watches:
+            GLib.source_remove(watch)
+        self.watches = []
+        if self.queue is not None:
+            self.queue.detach()
+        for conn in (self.ccontrol, self.cinterrupt):
+            if conn is not None:
+                conn.close()
+        self.ccontrol = None
+        self.cinterrupt = None
+
+    def stats(self):
+        """throughput, queue counters and latency percentiles of this host"""
+        seconds = time.monotonic() - self.connected_at if self.connected_at else 0.0
+        result = {
+            "connected_seconds": seconds,
+            "reports": float(self.reports),
+            "bytes": float(self.bytes),
+            "reports_per_sec": self.reports / seconds if seconds else 0.0,
+            "bytes_per_sec": self.bytes / seconds if seconds else 0.0,
+            "boot_protocol": float(self.protocol == PROTOCOL_BOOT),
+            "leds": float(self.leds),
+            "hires_wheel": float(self.hires_wheel),
+        }
+        if self.queue is not None:
+            for name, value in self.queue.stats().items():
+                result["queue." + name] = float(value)
+        if self.latency is not None:
+            for key, summary in self.latency.summary().items():
+                for name in ("p50", "p99", "max"):
+                    result["latency.%s.%s" % (key, name)] = summary[name]
+        return result
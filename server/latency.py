@@ -0,0 +1,135 @@
+#
+# End-to-end input latency statistics for btk_server
+#
+# Clients that pass the kernel event timestamp along with a report let the
+# service split its latency into stages:
+#
+#   read    kernel event timestamp -> client read the event
+#   client  client read -> client handed the report to D-Bus / the socket
+#   ipc     client send -> service received the report
+#   queue   service received -> report written to the interrupt socket
+#   send    duration of the interrupt socket send() call
+#   total   kernel event timestamp -> socket send() returned
+#
+# read, client and ipc compare CLOCK_REALTIME stamps taken on the same
+# machine, queue and send are measured with the monotonic clock. Every
+# stage and report type gets a log scale histogram (4 buckets per octave
+# of microseconds), cheap enough to record on every report.
+#
+
+import math
+import os
+import struct
+from hid_report import REPORT_NAMES
+
+STAGES = ("read", "client", "ipc", "queue", "send", "total")
+
+# event, read and send CLOCK_REALTIME timestamps in ns, appended to a frame
+STAMPS = struct.Struct("<QQQ")
+
+BUCKETS_PER_OCTAVE = 4
+BUCKETS = 128
+
+
+class Histogram():
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.max = 0
+
+    def add(self, ns):
+        if ns < 0:
+            # the realtime clock was stepped between the two stamps
+            return
+        us = ns / 1000
+        index = 0
+        if us >= 1:
+            index = min(BUCKETS - 1,
+                        int(math.log2(us) * BUCKETS_PER_OCTAVE) + 1)
+        self.counts[index] += 1
+        self.count += 1
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, p):
+        """upper bound of the bucket holding the p-th percentile, in seconds"""
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                upper = 2 ** (index / BUCKETS_PER_OCTAVE) / 1e6
+                return min(upper, self.max / 1e9)
+        return self.max / 1e9
+
+
+class LatencyStats():
+
+    def __init__(self, parent=None):
+        """every value recorded is also recorded to parent, if given"""
+        self.parent = parent
+        self.histograms = {}
+        for report_id in REPORT_NAMES:
+            for stage in STAGES:
+                self.histograms[(report_id, stage)] = Histogram()
+
+    def record(self, report_id, stage, ns):
+        histogram = self.histograms.get((report_id, stage))
+        if histogram is not None:
+            histogram.add(ns)
+        if self.parent is not None:
+            self.parent.record(report_id, stage, ns)
+
+    def received(self, report_id, stamps, now_ns):
+        """records the client side stages from a frame's (event, read, send) stamps"""
+        event_ns, read_ns, send_ns = stamps
+        self.record(report_id, "read", read_ns - event_ns)
+        self.record(report_id, "client", send_ns - read_ns)
+        self.record(report_id, "ipc", now_ns - send_ns)
+
+    def sent(self, report_id, queue_ns, send_ns, event_ns, now_ns):
+        """records the service side stages once a report left the socket"""
+        self.record(report_id, "queue", queue_ns)
+        self.record(report_id, "send", send_ns)
+        if event_ns:
+            self.record(report_id, "total", now_ns - event_ns)
+
+    def summary(self):
+        """{"<report>.<stage>": {"count", "p50", "p99", "max"}}, times in seconds"""
+        result = {}
+        for (report_id, stage), histogram in self.histograms.items():
+            if histogram.count == 0:
+                continue
+            result["%s.%s" % (REPORT_NAMES[report_id], stage)] = {
+                "count": float(histogram.count),
+                "p50": histogram.percentile(50),
+                "p99": histogram.percentile(99),
+                "max": histogram.max / 1e9,
+            }
+        return result
+
+    def prometheus(self):
+        lines = [
+            "# HELP btk_latency_seconds Input latency per report type and stage.",
+            "# TYPE btk_latency_seconds summary",
+        ]
+        for (report_id, stage), histogram in self.histograms.items():
+            if histogram.count == 0:
+                continue
+            labels = 'report="%s",stage="%s"' % (REPORT_NAMES[report_id], stage)
+            for quantile, p in (("0.5", 50), ("0.99", 99), ("1", 100)):
+                value = histogram.max / 1e9 if p == 100 else histogram.percentile(p)
+                lines.append('btk_latency_seconds{%s,quantile="%s"} %g'
+                             % (labels, quantile, value))
+            lines.append("btk_latency_seconds_count{%s} %d" % (labels, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """writes the Prometheus text format atomically, for node_exporter"""
+        tmp = path + ".tmp"
+        with open(tmp, "w") as fh:
+            fh.write(self.prometheus())
+        os.replace(tmp, path)
@@ -0,0 +1,86 @@
+#
+# Backpressure pacing for typed text
+#
+# Instead of fixed key down / key up delays, paced reports are released as
+# fast as the interrupt channel drains: a report is held back while the
+# socket has more than MAX_IN_FLIGHT reports worth of bytes outstanding
+# (SIOCOUTQ) or the send queue is not empty, and a token bucket caps the
+# rate at a ceiling. For L2CAP sockets the kernel reports the free send
+# buffer space instead of the outstanding bytes, so those are taken from
+# SO_SNDBUF.
+#
+
+import fcntl
+import socket
+import struct
+import termios
+import time
+from adapter import AF_BLUETOOTH
+
+# SIOCOUTQ, the same ioctl as TIOCOUTQ
+SIOCOUTQ = termios.TIOCOUTQ
+_INT = struct.Struct("i")
+
+
+def outstanding(sock):
+    """bytes queued on sock that the peer has not taken yet, 0 if unknown"""
+    try:
+        value = _INT.unpack(fcntl.ioctl(sock.fileno(), SIOCOUTQ,
+                                        _INT.pack(0)))[0]
+        if sock.family == AF_BLUETOOTH:
+            sndbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+            return max(0, sndbuf - value)
+        return value
+    except OSError:
+        return 0
+
+
+class Pacer():
+    # reports allowed to sit in the socket before the next one is held
+    MAX_IN_FLIGHT = 2
+    # reports the token bucket lets through back to back
+    BURST = 4
+    # ms between two looks at a socket that is still draining
+    POLL_MS = 1
+
+    def __init__(self, max_rate):
+        """max_rate is the ceiling in reports per second"""
+        self.max_rate = max_rate
+        self.tokens = Pacer.BURST
+        self.stamp = time.monotonic()
+        # bytes one report takes in the socket, learnt from sends to an
+        # empty socket; 0 until then
+        self.report_cost = 0
+        self.empty_before = False
+        self.stalls = 0
+
+    def delay(self, queue, rate=0):
+        """ms to wait before the next paced report may go, 0 to send now
+
+        queue is the device's send queue, rate an optional lower ceiling
+        for this report. A 0 return takes a token, so the caller must send
+        the report."""
+        sock = queue.sock
+        if queue.entries:
+            self.stalls += 1
+            return Pacer.POLL_MS
+        queued = outstanding(sock) if sock is not None else 0
+        if self.report_cost and queued > self.report_cost * Pacer.MAX_IN_FLIGHT:
+            self.stalls += 1
+            return Pacer.POLL_MS
+        rate = min(rate, self.max_rate) if rate else self.max_rate
+        now = time.monotonic()
+        self.tokens = min(Pacer.BURST, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return max(1, int((1 - self.tokens) * 1000 / rate + 0.5))
+        self.tokens -= 1
+        self.empty_before = queued == 0
+        return 0
+
+    def sent(self, queue):
+        """learns the per report socket cost after a paced send"""
+        if self.empty_before and queue.sock is not None and not queue.entries:
+            cost = outstanding(queue.sock)
+            if cost > self.report_cost:
+                self.report_cost = cost
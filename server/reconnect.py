@@ -0,0 +1,247 @@
+#
+# Host cache and reconnect engine for btk_server
+#
+# Hosts that connected before are kept in a JSON cache, most recent
+# first. Whenever no host is connected the engine opens the HID control
+# and interrupt L2CAP channels to the cached hosts itself, one host at a
+# time with non-blocking connects. When every host refused it retries
+# after an exponential backoff. The listening sockets stay open all the
+# time, so a host that connects on its own is taken as well. The time
+# from losing a connected host to its next connection, and from starting
+# to the first connection, is recorded.
+#
+
+import errno
+import json
+import os
+import socket
+import time
+from logging import debug, info, error
+from gi.repository import GLib
+from adapter import AF_BLUETOOTH, BTPROTO_L2CAP
+
+DEFAULT_CACHE_PATH = "/var/lib/btkbservice/hosts.json"
+
+OUTBOUND = "outbound"
+INBOUND = "inbound"
+
+
+class HostCache():
+    # hosts kept, the least recently connected ones are dropped
+    MAX_HOSTS = 8
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        # address -> last connection as a unix time, 0 for seeded hosts
+        self.entries = {}
+        if path is None:
+            return
+        try:
+            with open(path) as fh:
+                self.entries = {str(address): float(stamp)
+                                for address, stamp in json.load(fh).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as err:
+            error("Could not read the host cache %s: %s", path, err)
+
+    def hosts(self):
+        """cached host addresses, most recently connected first"""
+        return sorted(self.entries, key=self.entries.get, reverse=True)
+
+    def seed(self, addresses):
+        """adds hosts that never connected through us (bonded, or given)"""
+        for address in addresses:
+            self.entries.setdefault(address.upper(), 0.0)
+
+    def forget(self, address):
+        if self.entries.pop(address.upper(), None) is not None:
+            self.save()
+
+    def remember(self, address):
+        self.entries[address.upper()] = time.time()
+        for old in self.hosts()[HostCache.MAX_HOSTS:]:
+            del self.entries[old]
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as fh:
+                json.dump(self.entries, fh, indent=2)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            error("Could not write the host cache %s: %s", self.path, err)
+
+
+class Reconnector():
+    # seconds before the first retry round, doubled up to BACKOFF_MAX
+    BACKOFF_MIN = 1
+    BACKOFF_MAX = 60
+    PSM_CTRL = 17
+    PSM_INTR = 19
+
+    def __init__(self, cache, on_connect, busy=lambda: (), local_address=None):
+        """on_connect(control, interrupt, host) takes over opened channels
+
+        busy() returns the hosts connected or connecting already, they are
+        left out of the rounds. With local_address the channels are opened
+        from that adapter."""
+        self.cache = cache
+        self.local_address = local_address
+        self.on_connect = on_connect
+        self.busy = busy
+        # hosts still to try in this round
+        self.pending = []
+        self.host = None
+        self.control = None
+        self.sock = None
+        self.watch = None
+        self.timer = None
+        self.backoff = Reconnector.BACKOFF_MIN
+        # when we started, None once a host connected
+        self.started_at = time.monotonic()
+        # address -> when that connected host was lost
+        self.lost_at = {}
+        self.reconnect_times = []
+        # when reconnect_times last grew
+        self.reconnected_at = 0.0
+        self.attempts = 0
+        self.connects = {OUTBOUND: 0, INBOUND: 0}
+
+    def start(self):
+        """a host slot is free: starts trying the cached hosts"""
+        self.cancel()
+        self.backoff = Reconnector.BACKOFF_MIN
+        self.round()
+
+    def round(self):
+        self.timer = None
+        busy = self.busy()
+        self.pending = [host for host in self.cache.hosts() if host not in busy]
+        if not self.pending:
+            debug("No cached hosts left, waiting for a host to connect")
+            return False
+        self.next_host()
+        return False
+
+    def next_host(self):
+        if not self.pending:
+            debug("No cached host reachable, retrying in %d s", self.backoff)
+            self.timer = GLib.timeout_add_seconds(self.backoff, self.round)
+            self.backoff = min(self.backoff * 2, Reconnector.BACKOFF_MAX)
+            return
+        self.host = self.pending.pop(0)
+        self.attempts += 1
+        self.open(Reconnector.PSM_CTRL)
+
+    def open(self, psm):
+        try:
+            sock = socket.socket(AF_BLUETOOTH, socket.SOCK_SEQPACKET,
+                                 BTPROTO_L2CAP)
+            sock.setblocking(False)
+            if self.local_address:
+                sock.bind((self.local_address, 0))
+            err = sock.connect_ex((self.host, psm))
+        except OSError as exc:
+            sock = None
+            err = exc.errno
+        if err not in (0, errno.EINPROGRESS, errno.EAGAIN):
+            debug("Connecting to %s failed: %s", self.host, os.strerror(err))
+            if sock is not None:
+                sock.close()
+            self.close_channels()
+            self.next_host()
+            return
+        self.sock = sock
+        self.watch = GLib.io_add_watch(
+            sock, GLib.PRIORITY_DEFAULT, GLib.IO_OUT | GLib.IO_HUP | GLib.IO_ERR,
+            self.opened)
+
+    def opened(self, sock, condition):
+        self.watch = None
+        self.sock = None
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            debug("Connecting to %s failed: %s", self.host, os.strerror(err))
+            sock.close()
+            self.close_channels()
+            self.next_host()
+            return False
+        if self.control is None:
+            self.control = sock
+            self.open(Reconnector.PSM_INTR)
+            return False
+        control, self.control = self.control, None
+        info("Reconnected to %s", self.host)
+        self.on_connect(control, sock, self.host)
+        return False
+
+    def connected(self, host, direction):
+        """a host is connected, either way: stops trying and records the time"""
+        self.cancel()
+        self.cache.remember(host)
+        self.connects[direction] += 1
+        since = self.lost_at.pop(host.upper(), self.started_at)
+        self.started_at = None
+        if since is not None:
+            self.reconnected_at = time.monotonic()
+            self.reconnect_times.append(self.reconnected_at - since)
+            info("Connected to %s (%s) after %.2f s", host, direction,
+                 self.reconnect_times[-1])
+
+    def lost(self, host):
+        """a connected host went away, its reconnect is timed from now"""
+        self.lost_at[host.upper()] = time.monotonic()
+
+    def forget(self, host):
+        """a lost host will not come back, its reconnect is not timed"""
+        self.lost_at.pop(host.upper(), None)
+
+    def close_channels(self):
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+
+    def cancel(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        if self.watch is not None:
+            GLib.source_remove(self.watch)
+            self.watch = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.close_channels()
+        self.pending = []
+
+    def stats(self):
+        return stats([self])
+
+
+def cache_path(path, adapter):
+    """host cache file of adapter: path itself for hci0, else with -hciN added"""
+    if path is None or adapter == "hci0":
+        return path
+    root, ext = os.path.splitext(path)
+    return "%s-%s%s" % (root, adapter, ext)
+
+
+def stats(reconnectors):
+    """reconnect count and times in seconds, connects per direction"""
+    times = [t for r in reconnectors for t in r.reconnect_times]
+    latest = max(reconnectors, key=lambda r: r.reconnected_at)
+    return {
+        "reconnects": float(len(times)),
+        "last_seconds": latest.reconnect_times[-1] if times else 0.0,
+        "mean_seconds": sum(times) / len(times) if times else 0.0,
+        "max_seconds": max(times, default=0.0),
+        "attempts": float(sum(r.attempts for r in reconnectors)),
+        "outbound": float(sum(r.connects[OUTBOUND] for r in reconnectors)),
+        "inbound": float(sum(r.connects[INBOUND] for r in reconnectors)),
+        "hosts": float(sum(len(r.cache.entries) for r in reconnectors)),
+    }
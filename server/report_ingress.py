@@ -0,0 +1,139 @@
+#
+# Local fast-path ingress for btk_server
+#
+# A unix SOCK_SEQPACKET listener for high rate report producers. Every
+# packet is one pre-encoded report (report ID first, no HIDP header), the
+# same frame format as send_reports, so there is no D-Bus marshalling or
+# dispatch per report. A frame may be followed by the client's latency
+# timestamps (latency.STAMPS). Addresses starting with "@" are in the
+# abstract namespace. The other way the service pushes the keyboard LED
+# output report (report ID, LED bits) to every client.
+#
+# A frame starting with ROUTE (report ID 0 is never used) sets where the
+# later reports of that connection go: the rest of the frame is the route
+# as set_route takes it, empty for the service's current route. A client
+# that sets an invalid route is disconnected.
+#
+
+import os
+import socket
+from logging import debug, info, warning, error
+from gi.repository import GLib
+from hid_report import ReportEncoder, REPORT_SIZES
+from latency import STAMPS
+
+DEFAULT_ADDRESS = "@btkbservice"
+# larger than any report, so an oversized frame is seen as such
+MAX_FRAME = 64
+# first byte of a route frame
+ROUTE = 0
+
+
+def socket_address(address):
+    if address.startswith("@"):
+        return "\0" + address[1:]
+    return address
+
+
+class ReportIngress():
+
+    def __init__(self, address, handler, check_route=None):
+        """listens on address and calls handler(frame, stamps, route) for
+        every valid frame
+
+        frame is a memoryview that is only valid during the call, stamps
+        the (event, read, send) timestamps or None, route the route the
+        client set or None. check_route(route) raises ValueError for a
+        route that cannot be used."""
+        self.address = address
+        self.handler = handler
+        self.check_route = check_route
+        self.buf = bytearray(MAX_FRAME)
+        self.view = memoryview(self.buf)
+        self.clients = {}
+        # fd -> route set by the client
+        self.routes = {}
+        path = socket_address(address)
+        if not path.startswith("\0") and os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.sock.setblocking(False)
+        GLib.io_add_watch(self.sock, GLib.PRIORITY_DEFAULT, GLib.IO_IN,
+                          self.accept)
+        info("Report ingress listening on %s", address)
+
+    def accept(self, sock, condition):
+        try:
+            conn, _ = sock.accept()
+        except BlockingIOError:
+            return True
+        conn.setblocking(False)
+        self.clients[conn.fileno()] = conn
+        GLib.io_add_watch(conn, GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.read)
+        debug("Report ingress client connected")
+        return True
+
+    def push(self, frame):
+        """sends frame to every client, dropped for clients that do not read"""
+        for conn in list(self.clients.values()):
+            try:
+                conn.send(frame)
+            except BlockingIOError:
+                pass
+            except OSError as err:
+                debug("Could not push to an ingress client: %s", err)
+
+    def read(self, conn, condition):
+        # drain every queued frame on this wakeup
+        while True:
+            try:
+                n = conn.recv_into(self.buf)
+            except BlockingIOError:
+                return True
+            except OSError as err:
+                error(err)
+                n = 0
+            if n == 0:
+                self.close_client(conn)
+                debug("Report ingress client disconnected")
+                return False
+            if self.buf[0] == ROUTE:
+                if not self.set_route(conn, bytes(self.buf[1:n])):
+                    self.close_client(conn)
+                    return False
+                continue
+            stamps = None
+            if n - STAMPS.size == REPORT_SIZES.get(self.buf[0]):
+                n -= STAMPS.size
+                stamps = STAMPS.unpack_from(self.buf, n)
+            frame = self.view[:n]
+            try:
+                ReportEncoder.check(frame)
+            except ValueError as err:
+                warning("Dropping ingress frame: %s", err)
+                continue
+            self.handler(frame, stamps, self.routes.get(conn.fileno()))
+
+    def set_route(self, conn, text):
+        """takes a route frame, False if the route is invalid"""
+        try:
+            route = text.decode("ascii") or None
+            if route is not None and self.check_route is not None:
+                self.check_route(route)
+        except ValueError as err:
+            warning("Dropping ingress client with a bad route: %s", err)
+            return False
+        if route is None:
+            self.routes.pop(conn.fileno(), None)
+        else:
+            self.routes[conn.fileno()] = route
+        debug("Report ingress client routed to %s", route or "the default")
+        return True
+
+    def close_client(self, conn):
+        self.clients.pop(conn.fileno(), None)
+        self.routes.pop(conn.fileno(), None)
+        conn.close()
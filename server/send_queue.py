@@ -0,0 +1,296 @@
+#
+# Bounded send queue for the non-blocking interrupt channel
+#
+# Reports are written straight to the socket while it accepts them. Once
+# the socket would block they are copied into a queue that a GLib IO_OUT
+# watch drains in order. Every report type has a capacity and an overflow
+# policy:
+#
+#   keep-all     never drop; the report is queued past the capacity and
+#                counted as an overflow (keyboard: a lost key up would
+#                leave a key stuck on the host)
+#   drop-newest  drop the incoming report
+#   latest-wins  drop the oldest queued report of the same type (mouse);
+#                a pointer report is only dropped when the next one has
+#                the same buttons, so no click is lost, and relative
+#                motion is folded into that next report, saturated at the
+#                report range when no queued report fits it whole; only
+#                when every queued report is a button transition is the
+#                report queued past the capacity
+#
+# Relative mouse reports (8 and 16 bit) are coalesced while they wait: a
+# report with the same button state as the mouse report of its type at
+# the tail of the queue has its motion added to that report, so button
+# transitions keep their order.
+# An absolute pointer report likewise replaces the position of the one at
+# the tail when the buttons match.
+#
+
+import struct
+import time
+from collections import deque
+from logging import debug, info, warning, error
+from gi.repository import GLib
+from hid_report import (REPORT_NAMES, REPORT_ID_MOUSE, REPORT_ID_MOUSE16,
+                        REPORT_ID_ABSOLUTE, RELATIVE_REPORTS, MOUSE16_MAX)
+
+KEEP_ALL = "keep-all"
+DROP_NEWEST = "drop-newest"
+LATEST_WINS = "latest-wins"
+POLICIES = (KEEP_ALL, DROP_NEWEST, LATEST_WINS)
+
+# report ID -> (x, y, wheel after the button byte, field limit)
+MOTION_FIELDS = {
+    REPORT_ID_MOUSE: (struct.Struct("bbb"), 127),
+    REPORT_ID_MOUSE16: (struct.Struct("<hhh"), MOUSE16_MAX),
+}
+# reports with the button byte first
+POINTER_REPORTS = RELATIVE_REPORTS + (REPORT_ID_ABSOLUTE,)
+
+
+class SendQueue():
+
+    def __init__(self, capacity, policies, on_error, coalesce=True):
+        """capacity is per report type, policies maps report ID -> policy
+
+        on_error(err) is called when a queued send fails with an error other
+        than the socket being full."""
+        self.capacity = capacity
+        self.policies = policies
+        self.on_error = on_error
+        self.coalesce = coalesce
+        # latency.LatencyStats when latency is being measured
+        self.latency = None
+        # applied to the reports with an ID in convert_ids as they are
+        # written, e.g. to send the boot protocol form; reports it returns
+        # None for are skipped. The others are written as they are.
+        # converted(report) is called once a converted report went out, so
+        # a conversion that carries state only commits it then: a report
+        # the socket did not take is converted again on the next try
+        self.convert = None
+        self.convert_ids = frozenset()
+        self.converted = None
+        self.sock = None
+        self.watch = None
+        # (report id, report bytes, queued at, event timestamp) in send order
+        self.entries = deque()
+        self.depth = dict.fromkeys(REPORT_NAMES, 0)
+        self.dropped = dict.fromkeys(REPORT_NAMES, 0)
+        self.overflow = dict.fromkeys(REPORT_NAMES, 0)
+        self.coalesced = dict.fromkeys(REPORT_NAMES, 0)
+        self.max_depth = 0
+
+    def attach(self, sock):
+        """starts sending on sock, which is switched to non-blocking"""
+        sock.setblocking(False)
+        self.sock = sock
+        if self.entries:
+            self.watch_out()
+
+    def detach(self):
+        """stops sending, queued reports are kept for the next attach()"""
+        if self.watch is not None:
+            GLib.source_remove(self.watch)
+            self.watch = None
+        self.sock = None
+
+    def send(self, report, event_ns=0):
+        """sends report (HIDP header first) now, or queues a copy of it
+
+        event_ns is the report's kernel event timestamp if the client sent
+        one. Raises OSError if the socket failed."""
+        if not self.entries and self.sock is not None:
+            try:
+                if self.latency is None:
+                    self.write(self.sock, report)
+                else:
+                    start = time.monotonic_ns()
+                    self.write(self.sock, report)
+                    self.latency.sent(report[1], 0,
+                                      time.monotonic_ns() - start, event_ns,
+                                      time.time_ns())
+                return
+            except BlockingIOError:
+                pass
+        self.enqueue(report, event_ns)
+        if self.sock is not None:
+            self.watch_out()
+
+    def write(self, sock, report):
+        if report[1] not in self.convert_ids:
+            sock.send(report)
+            return
+        message = self.convert(report)
+        if message is None:
+            return
+        sock.send(message)
+        if self.converted is not None:
+            self.converted(report)
+
+    def enqueue(self, report, event_ns=0):
+        report_id = report[1]
+        if report_id in RELATIVE_REPORTS and self.coalesce:
+            report = self.merge_mouse(report)
+            if report is None:
+                return
+        if report_id == REPORT_ID_ABSOLUTE and self.coalesce:
+            if self.merge_absolute(report):
+                return
+        if self.depth[report_id] >= self.capacity:
+            if report_id in POINTER_REPORTS:
+                # eviction may fold motion into it
+                report = bytearray(report)
+            policy = self.policies.get(report_id, KEEP_ALL)
+            if policy == DROP_NEWEST:
+                self.dropped[report_id] += 1
+                return
+            if policy == LATEST_WINS and self.remove_oldest(report):
+                self.dropped[report_id] += 1
+            else:
+                self.overflow[report_id] += 1
+        queued = time.monotonic_ns() if self.latency is not None else 0
+        if report_id in RELATIVE_REPORTS or report_id == REPORT_ID_ABSOLUTE:
+            # kept mutable so later reports can be merged into it
+            self.entries.append((report_id, bytearray(report), queued, event_ns))
+        else:
+            self.entries.append((report_id, bytes(report), queued, event_ns))
+        self.depth[report_id] += 1
+        if len(self.entries) > self.max_depth:
+            self.max_depth = len(self.entries)
+
+    def merge_mouse(self, report):
+        """adds the motion of report to the mouse report at the queue tail
+
+        Returns None when report was absorbed, otherwise the report still
+        to be queued: report itself, or what is left of its motion once the
+        tail report's fields are at the edge of their range."""
+        if not self.entries:
+            return report
+        report_id, tail = self.entries[-1][:2]
+        if report_id != report[1] or tail[2] != report[2]:
+            return report
+        fields, limit = MOTION_FIELDS[report_id]
+        parts = []
+        rests = []
+        for queued, value in zip(fields.unpack_from(tail, 3),
+                                 fields.unpack_from(report, 3)):
+            total = queued + max(-limit, value)
+            parts.append(min(limit, max(-limit, total)))
+            rests.append(total - parts[-1])
+        fields.pack_into(tail, 3, *parts)
+        if any(rests):
+            rest = bytearray(report)
+            fields.pack_into(rest, 3, *rests)
+            return rest
+        self.coalesced[report_id] += 1
+        return None
+
+    def merge_absolute(self, report):
+        """moves the absolute report at the queue tail to the position of
+        report, True if it had the same buttons"""
+        if not self.entries:
+            return False
+        report_id, tail = self.entries[-1][:2]
+        if report_id != REPORT_ID_ABSOLUTE or tail[2] != report[2]:
+            return False
+        tail[3:] = report[3:]
+        self.coalesced[report_id] += 1
+        return True
+
+    def remove_oldest(self, report):
+        """drops the oldest queued report of the type of report
+
+        A pointer report is only dropped when the next report of its type
+        (report itself for the last one) has the same buttons. Relative
+        motion is added to that next report: the oldest report whose motion
+        fits is dropped, else the oldest one that may be dropped at all,
+        with the sum saturated at the report range. Returns False when
+        nothing could be dropped."""
+        report_id = report[1]
+        queued = [i for i, entry in enumerate(self.entries)
+                  if entry[0] == report_id]
+        if report_id in POINTER_REPORTS:
+            following = [self.entries[i][1] for i in queued[1:]] + [report]
+            pairs = [(i, later) for i, later in zip(queued, following)
+                     if self.entries[i][1][2] == later[2]]
+            if not pairs:
+                return False
+            i, later = pairs[0]
+            if report_id in MOTION_FIELDS:
+                for pair in pairs:
+                    if self.fold(self.entries[pair[0]][1], pair[1]):
+                        i, later = pair
+                        break
+                else:
+                    self.fold(self.entries[i][1], later, saturate=True)
+        elif queued:
+            i = queued[0]
+        else:
+            return False
+        del self.entries[i]
+        self.depth[report_id] -= 1
+        return True
+
+    @staticmethod
+    def fold(report, later, saturate=False):
+        """adds the motion of report to later, False if it does not fit
+
+        With saturate the sum is clipped to the report range instead."""
+        fields, limit = MOTION_FIELDS[report[1]]
+        totals = [a + b for a, b in zip(fields.unpack_from(later, 3),
+                                        fields.unpack_from(report, 3))]
+        if any(abs(total) > limit for total in totals):
+            if not saturate:
+                return False
+            totals = [min(limit, max(-limit, total)) for total in totals]
+        fields.pack_into(later, 3, *totals)
+        return True
+
+    def watch_out(self):
+        if self.watch is None:
+            self.watch = GLib.io_add_watch(
+                self.sock, GLib.PRIORITY_DEFAULT, GLib.IO_OUT, self.drain)
+
+    def drain(self, sock, condition):
+        while self.entries:
+            report_id, report, queued, event_ns = self.entries[0]
+            try:
+                if self.latency is None:
+                    self.write(sock, report)
+                else:
+                    start = time.monotonic_ns()
+                    self.write(sock, report)
+                    self.latency.sent(report_id, start - queued,
+                                      time.monotonic_ns() - start, event_ns,
+                                      time.time_ns())
+            except BlockingIOError:
+                return True
+            except OSError as err:
+                self.watch = None
+                self.on_error(err)
+                return False
+            self.entries.popleft()
+            self.depth[report_id] -= 1
+        self.watch = None
+        return False
+
+    def drop(self, report):
+        """counts a report that was discarded before reaching the queue"""
+        self.dropped[report[1]] += 1
+
+    def clear(self):
+        for entry in self.entries:
+            self.dropped[entry[0]] += 1
+        self.entries.clear()
+        self.depth = dict.fromkeys(REPORT_NAMES, 0)
+
+    def stats(self):
+        """queue depth and drop counters, keyed "<report type>.<counter>\""""
+        result = {"depth": len(self.entries), "max_depth": self.max_depth,
+                  "capacity": self.capacity}
+        for report_id, name in REPORT_NAMES.items():
+            result[name + ".depth"] = self.depth[report_id]
+            result[name + ".dropped"] = self.dropped[report_id]
+            result[name + ".overflow"] = self.overflow[report_id]
+            result[name + ".coalesced"] = self.coalesced[report_id]
+        return result